@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_DIR = os.path.join(TOPDIR, 'modian-live-example')
+LWR = os.path.join(TOPDIR, 'modian-live-wrapper', 'lwr.py')
+LOCAL_REPO = os.path.join(TOPDIR, 'local_repo', 'local_repo.py')
+
+# Spans of the build trace that are measured, summing their durations if
+# they appear more than once
+METRICS = (
+    'build',
+    'debootstrap',
+    'ansible',
+    'mksquashfs',
+    'chroot digest',
+    'udebs',
+    'xorriso',
+    'cache extract',
+    'cache store',
+)
+
+
+def _get_first_docstring_line(obj):
+    try:
+        return obj.__doc__.split('\n')[1].strip()
+    except (AttributeError, IndexError):
+        return None
+
+
+def example_args(mirror, installer):
+    """
+    Return the modian-lwr arguments used by modian-live-example/build_example
+    """
+    args = [
+        '--architecture=amd64',
+        '--distribution=trixie',
+        '--mirror=' + mirror,
+        '--apt-mirror=' + mirror,
+        '--apt-mirror-components=main',
+        '--volume-id=modian-example',
+        '--description=Modian Example',
+        '--playbook=ansible/chroot.yaml',
+        '--ansible-extra-vars=ansible/extra_vars.yaml',
+        '--bootappend=consoleblank=0',
+        '--networkd',
+        '--boot-timeout=1',
+        '--customize-squashfs=customize/squashfs.sh',
+        '--squashfs-comp=lzo',
+    ]
+    if not installer:
+        args.append('--no-installer')
+    return args
+
+
+def trace_metrics(pathname):
+    """
+    Return the time in seconds spent in each of METRICS, from a build trace
+    """
+    with open(pathname, 'rt') as fd:
+        events = json.load(fd)['traceEvents']
+    res = {}
+    for event in events:
+        if event.get('ph') != 'X' or event.get('cat') == 'command':
+            continue
+        if event['name'] in METRICS:
+            res[event['name']] = res.get(event['name'], 0.0) + event['dur'] / 1000000
+    return res
+
+
+def git_commit():
+    """
+    Return the current commit of the repository, suffixed with -dirty if it
+    has uncommitted changes
+    """
+    commit = subprocess.run(
+        ['git', 'rev-parse', 'HEAD'],
+        cwd=TOPDIR, capture_output=True, text=True, check=True,
+    ).stdout.strip()
+    status = subprocess.run(
+        ['git', 'status', '--porcelain', '--untracked-files=no'],
+        cwd=TOPDIR, capture_output=True, text=True, check=True,
+    ).stdout.strip()
+    return commit + '-dirty' if status else commit
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('local mirror did not start on port {}'.format(port))
+
+
+class Benchmark:
+    """
+    Benchmark modian-live-example builds against an offline mirror
+    """
+    def __init__(self):
+        self.parser = self._get_parser()
+
+    def _get_parser(self):
+        parser = argparse.ArgumentParser(
+            description=_get_first_docstring_line(self)
+        )
+        parser.set_defaults(func=self.help)
+
+        # ****** Common options
+        parser.add_argument(
+            '--directory', '-d',
+            default='benchmark-data',
+            help='Path to a directory for the recorded mirror, the builds'
+                 + ' and the results (default: benchmark-data)',
+        )
+
+        # ****** Subcommands
+        subparsers = parser.add_subparsers()
+
+        # Record
+        rec_parser = subparsers.add_parser(
+            'record',
+            help=_get_first_docstring_line(self.record),
+        )
+        rec_parser.add_argument(
+            '--mirror', '-m',
+            default='http://deb.debian.org/debian',
+            help='http:// mirror to record (default:'
+                 + ' http://deb.debian.org/debian)',
+        )
+        rec_parser.add_argument(
+            '--installer',
+            action='store_true',
+            help='also record debian-installer files and udebs',
+        )
+        rec_parser.set_defaults(func=self.record)
+
+        # Run
+        run_parser = subparsers.add_parser(
+            'run',
+            help=_get_first_docstring_line(self.run),
+        )
+        run_parser.add_argument(
+            '--warm', '-w',
+            type=int,
+            default=1,
+            help='number of builds run with a warm cache (default: 1)',
+        )
+        run_parser.add_argument(
+            '--installer',
+            action='store_true',
+            help='include the debian-installer in the image',
+        )
+        run_parser.add_argument(
+            '--port', '-p',
+            type=int,
+            default=8098,
+            help='port for the local mirror (default: 8098)',
+        )
+        run_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=None,
+            help='number of build stages run at the same time'
+                 + ' (default: modian-lwr default)',
+        )
+        run_parser.add_argument(
+            '--lwr-option', '-o',
+            action='append',
+            default=[],
+            help='extra option for modian-lwr, like --lwr-option=--ansible-profile=fast'
+                 + ' (can be repeated)',
+        )
+        run_parser.add_argument(
+            '--label', '-l',
+            default=None,
+            help='suffix for the name of the results, to compare runs'
+                 + ' of the same commit with different options',
+        )
+        run_parser.set_defaults(func=self.run)
+
+        # Compare
+        cmp_parser = subparsers.add_parser(
+            'compare',
+            help=_get_first_docstring_line(self.compare),
+        )
+        cmp_parser.add_argument(
+            '--threshold', '-t',
+            type=float,
+            default=10,
+            help='slowdown in percent reported as a regression (default: 10)',
+        )
+        cmp_parser.add_argument(
+            '--min-delta',
+            type=float,
+            default=1,
+            help='ignore slowdowns shorter than this many seconds'
+                 + ' (default: 1)',
+        )
+        cmp_parser.add_argument(
+            'base',
+            help='commit (or unique prefix) of the reference results,'
+                 + ' followed by -label for labelled runs',
+        )
+        cmp_parser.add_argument(
+            'new',
+            nargs='?',
+            help='commit (or unique prefix) of the results to check,'
+                 + ' followed by -label for labelled runs'
+                 + ' (default: the current commit)',
+        )
+        cmp_parser.set_defaults(func=self.compare)
+
+        return parser
+
+    def main(self):
+        args = self.parser.parse_args()
+        # Builds run from the example directory
+        args.directory = os.path.abspath(args.directory)
+        sys.exit(args.func(args))
+
+    def help(self, args):
+        self.parser.print_help()
+
+    def lwr(self, work_dir, cache_dir, trace_file, extra):
+        """
+        Build modian-live-example in work_dir, saving its trace to trace_file
+        """
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        cmd = [
+            sys.executable, LWR,
+            '-o', os.path.join(work_dir, 'modian-example.iso'),
+            '--work-dir', os.path.join(work_dir, 'build'),
+            '--cache-dir', cache_dir,
+            '--trace-file', trace_file,
+        ] + extra
+        print('+', ' '.join(cmd), flush=True)
+        with open(os.path.join(work_dir, 'build.log'), 'wb') as log:
+            subprocess.run(cmd, cwd=EXAMPLE_DIR, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+    def record(self, args):
+        """
+        Record a mirror for offline builds, by building through the apt proxy
+        """
+        mirror_dir = os.path.join(args.directory, 'mirror')
+        if os.path.isdir(mirror_dir):
+            shutil.rmtree(mirror_dir)
+        os.makedirs(mirror_dir)
+        with tempfile.TemporaryDirectory(dir=args.directory) as tmp:
+            self.lwr(
+                work_dir=os.path.join(tmp, 'work'),
+                cache_dir=os.path.join(tmp, 'cache'),
+                trace_file=os.path.join(tmp, 'trace.json'),
+                extra=example_args(args.mirror, args.installer) + [
+                    '--apt-proxy',
+                    '--package-store', os.path.join(tmp, 'packages'),
+                    '--apt-proxy-record', mirror_dir,
+                ],
+            )
+        with open(os.path.join(mirror_dir, 'mirror.json'), 'wt') as fd:
+            json.dump({'mirror': args.mirror, 'installer': args.installer}, fd)
+
+    def run(self, args):
+        """
+        Build cold and warm against the recorded mirror and store the timings
+        """
+        mirror_dir = os.path.join(args.directory, 'mirror')
+        with open(os.path.join(mirror_dir, 'mirror.json'), 'rt') as fd:
+            recorded = json.load(fd)
+        if args.installer and not recorded['installer']:
+            print('The mirror was recorded without --installer', file=sys.stderr)
+            return 2
+        url = urllib.parse.urlsplit(recorded['mirror'])
+        mirror = 'http://127.0.0.1:{}{}'.format(args.port, url.path)
+        extra = example_args(mirror, args.installer)
+        if args.jobs:
+            extra.append('--jobs={}'.format(args.jobs))
+        extra += args.lwr_option
+
+        runs_dir = os.path.abspath(os.path.join(args.directory, 'runs'))
+        cache_dir = os.path.join(runs_dir, 'cache')
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.makedirs(cache_dir)
+
+        commit = git_commit()
+        result_name = commit + '-' + args.label if args.label else commit
+        timings = {'cold': [], 'warm': []}
+        server = subprocess.Popen([
+            sys.executable, LOCAL_REPO,
+            '--directory', os.path.join(mirror_dir, url.netloc),
+            'serve', '--port', str(args.port),
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.port)
+            names = ['cold'] + ['warm'] * args.warm
+            for idx, name in enumerate(names):
+                work_dir = os.path.join(runs_dir, '{}-{}'.format(name, idx))
+                trace_file = os.path.join(runs_dir, '{}-{}.json'.format(name, idx))
+                self.lwr(work_dir, cache_dir, trace_file, extra)
+                timings[name].append(trace_metrics(trace_file))
+        finally:
+            server.terminate()
+            server.wait()
+
+        results = {
+            'commit': commit,
+            'label': args.label,
+            'options': args.lwr_option,
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'installer': args.installer,
+            'runs': {},
+        }
+        for name, runs in timings.items():
+            if runs:
+                results['runs'][name] = {
+                    metric: statistics.median(run.get(metric, 0.0) for run in runs)
+                    for metric in METRICS
+                }
+        results_dir = os.path.join(args.directory, 'results')
+        os.makedirs(results_dir, exist_ok=True)
+        pathname = os.path.join(results_dir, result_name + '.json')
+        with open(pathname, 'wt') as fd:
+            json.dump(results, fd, indent=1)
+        print('Results saved to', pathname)
+        self.print_results(results)
+
+    def print_results(self, results):
+        print('{:15} {:>10} {:>10}'.format('', 'cold', 'warm'))
+        for metric in METRICS:
+            print('{:15} {:>9.1f}s {:>9.1f}s'.format(
+                metric,
+                results['runs'].get('cold', {}).get(metric, 0.0),
+                results['runs'].get('warm', {}).get(metric, 0.0),
+            ))
+
+    def load_results(self, directory, commit):
+        results_dir = os.path.join(directory, 'results')
+        names = [
+            n for n in os.listdir(results_dir)
+            if n.endswith('.json') and n.startswith(commit)
+        ]
+        if commit + '.json' in names:
+            names = [commit + '.json']
+        if len(names) != 1:
+            raise RuntimeError('{} results found for {}: {}'.format(
+                len(names), commit, ', '.join(sorted(names))))
+        with open(os.path.join(results_dir, names[0]), 'rt') as fd:
+            return json.load(fd)
+
+    def compare(self, args):
+        """
+        Compare the timings of two commits and report regressions
+        """
+        base = self.load_results(args.directory, args.base)
+        new = self.load_results(args.directory, args.new or git_commit())
+        print('{} -> {}'.format(
+            '-'.join(filter(None, (base['commit'][:12], base.get('label')))),
+            '-'.join(filter(None, (new['commit'][:12], new.get('label')))),
+        ))
+        print('{:15} {:5} {:>10} {:>10} {:>8}'.format(
+            '', '', 'base', 'new', 'change'))
+        regressions = 0
+        for name in 'cold', 'warm':
+            for metric in METRICS:
+                old_time = base['runs'].get(name, {}).get(metric)
+                new_time = new['runs'].get(name, {}).get(metric)
+                if not old_time or new_time is None:
+                    continue
+                change = (new_time - old_time) * 100 / old_time
+                flag = ''
+                if change > args.threshold and new_time - old_time > args.min_delta:
+                    flag = '  REGRESSION'
+                    regressions += 1
+                print('{:15} {:5} {:>9.1f}s {:>9.1f}s {:>+7.1f}%{}'.format(
+                    metric, name, old_time, new_time, change, flag))
+        return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    Benchmark().main()
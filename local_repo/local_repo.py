@@ -85,6 +85,7 @@ class Repo:
         )
         s_parser.add_argument(
             '--port', '-p',
+            type=int,
             default=8099,
             help='port for the local repository (default: 8099)',
         )
@@ -181,7 +182,7 @@ class Repo:
         Serve a reprepro repository
         """
         os.chdir(args.directory)
-        httpd = http.server.HTTPServer(
+        httpd = http.server.ThreadingHTTPServer(
             ('', args.port),
             http.server.SimpleHTTPRequestHandler,
         )
@@ -1,18 +1,140 @@
 from __future__ import annotations
+import collections
 import subprocess
 import json
+import os
+import shlex
+import threading
 from .component import Component
+from .utils import Fail
+
+# Directory with the callback plugin that streams the playbook events
+CALLBACK_PLUGINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "callback_plugins")
+
+# Name of the streaming stdout callback
+STDOUT_CALLBACK = "lwr_jsonl"
+
+# Settings of ansible.cfg for running playbooks in a chroot:
+#  * safe: ansible defaults
+#  * fast: pipelining, and facts cached across builds of the same chroot
+#  * mitogen: fast, with the mitogen strategy, which keeps a python
+#    interpreter running in the chroot instead of starting one per task
+ANSIBLE_PROFILES = ("safe", "fast", "mitogen")
+
+# Seconds for which cached facts are used
+FACT_CACHE_TIMEOUT = 86400
+
+# Name of the report written when the playbook fails
+FAILURE_REPORT = "ansible-failure.json"
+
+
+def ansible_python(ansible_playbook):
+    """
+    Return the command line of the python interpreter that runs
+    ansible_playbook, from its #! line
+    """
+    with open(ansible_playbook, "rb") as fd:
+        line = fd.readline().decode("utf8", "replace").strip()
+    if not line.startswith("#!"):
+        raise Fail("Cannot find the python interpreter of {}".format(ansible_playbook))
+    return shlex.split(line[2:])
+
+
+def mitogen_strategy_plugins(ansible_playbook):
+    """
+    Return the directory of the mitogen strategy plugins, or None if
+    mitogen is not installed for the python interpreter running
+    ansible_playbook
+    """
+    cmd = ansible_python(ansible_playbook) + [
+        "-c", "import importlib.util; spec = importlib.util.find_spec('ansible_mitogen');"
+              " print(spec.origin if spec is not None and spec.origin else '')"]
+    try:
+        res = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise Fail("Cannot run the python interpreter of {}: {}".format(ansible_playbook, e))
+    origin = res.stdout.strip()
+    if not origin:
+        return None
+    return os.path.join(os.path.dirname(origin), "plugins", "strategy")
+
+
+def ansible_config(profile, inventory, roles_path, fact_cache=None, ansible_playbook=None):
+    """
+    Return the contents of ansible.cfg for a profile in ANSIBLE_PROFILES, as
+    a dict of sections, each a dict of settings.
+
+    fact_cache is the directory where the fast profiles keep gathered facts.
+    ansible_playbook is the ansible-playbook command that the mitogen
+    profile looks up mitogen for.
+    """
+    if profile not in ANSIBLE_PROFILES:
+        raise Fail("Unknown ansible profile {}: use one of {}".format(profile, ", ".join(ANSIBLE_PROFILES)))
+    defaults = {
+        "nocows": "1",
+        "inventory": inventory,
+        "roles_path": ":".join(roles_path),
+    }
+    config = {"defaults": defaults}
+    if profile == "safe":
+        return config
+
+    defaults["retry_files_enabled"] = "False"
+    # Check for the end of tasks more often than the default 0.1s
+    defaults["internal_poll_interval"] = "0.005"
+    if fact_cache:
+        defaults["gathering"] = "smart"
+        defaults["fact_caching"] = "jsonfile"
+        defaults["fact_caching_connection"] = fact_cache
+        defaults["fact_caching_timeout"] = str(FACT_CACHE_TIMEOUT)
+    # Send modules through the stdin of the interpreter, instead of copying
+    # them to a temporary file first
+    config["connection"] = {"pipelining": "True"}
+
+    if profile == "mitogen":
+        if not ansible_playbook:
+            raise Fail("--ansible-profile=mitogen needs ansible-playbook")
+        strategy_plugins = mitogen_strategy_plugins(ansible_playbook)
+        if strategy_plugins is None:
+            raise Fail("--ansible-profile=mitogen needs mitogen for the python interpreter of {}:"
+                       " you may need to install python3-mitogen".format(ansible_playbook))
+        defaults["strategy_plugins"] = strategy_plugins
+        defaults["strategy"] = "mitogen_linear"
+    return config
 
 
 class TaskOutcome:
-    def __init__(self, host, name, status, data):
+    def __init__(self, host, name, status, data, duration=None):
         self.host = host
         self.name = name
         self.status = status
         self.data = data
+        self.duration = duration
+
+    def to_dict(self):
+        data = dict(self.data) if self.data else {}
+        data.pop("stdout_lines", None)
+        data.pop("stderr_lines", None)
+        return {
+            "host": self.host,
+            "task": self.name,
+            "status": self.status,
+            "duration": self.duration,
+            "result": data,
+        }
 
 
 class Ansible(Component):
+    """
+    Run ansible-playbook with the lwr_jsonl stdout callback, and follow its
+    events as they arrive
+    """
+    # Number of slowest tasks listed at the end of run_pretty
+    slowest_tasks = 10
+
+    # Number of lines of stderr kept for the failure report
+    stderr_lines = 200
+
     def __init__(self):
         super().__init__()
         self.result = None
@@ -20,47 +142,85 @@ class Ansible(Component):
         self.changed = 0
         self.unreachable = 0
         self.failed = 0
+        # Tasks started so far
+        self.tasks = 0
+        # Name and duration of each task, by task uuid, in order of
+        # execution
+        self.durations = collections.OrderedDict()
+        # Results of all tasks
+        self.outcomes = []
+        # Last lines written to stderr
+        self.stderr = collections.deque(maxlen=self.stderr_lines)
+
+    def _read_stderr(self, stream, lines):
+        for line in stream:
+            lines.append(line.rstrip("\n"))
 
     def run(self, cmd):
-        res = self.popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-
-        # Some parts of Ansible may sadly print warnings on stdout (instead of
-        # stderr!) before the JSON output, so we are preprocessing stdout to
-        # skim those warnings out
-        stdout, stderr = res.communicate()
-        stdout_lines = stdout.splitlines()
-        while stdout_lines and stdout_lines[0] != "{":
-            self.log.warn("ansible remarks: %s", stdout_lines.pop(0))
-        stdout = "\n".join(stdout_lines)
-
-        if stdout:
-            results = json.loads(stdout)
-            for stats in results["stats"].values():
-                self.ok += stats["ok"]
-                self.changed += stats["changed"]
-                self.unreachable += stats["unreachable"]
-                self.failed += stats["failures"]
-
-            for play in results["plays"]:
-                for task in play["tasks"]:
-                    for host, result in task["hosts"].items():
-                        status = "ok"
-                        if result.get("failed"):
-                            status = "failed"
-                        yield TaskOutcome(host, task["task"]["name"], status, result)
-        else:
+        stderr = self.stderr
+        results = 0
+        stats = None
+        with self.popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True) as res:
+            # Read stderr at the same time, so that ansible never blocks on it
+            reader = threading.Thread(target=self._read_stderr, args=(res.stderr, stderr), daemon=True)
+            reader.start()
+            for line in res.stdout:
+                line = line.rstrip("\n")
+                try:
+                    event = json.loads(line) if line.startswith("{") else None
+                except ValueError:
+                    event = None
+                if not isinstance(event, dict) or "event" not in event:
+                    # Some parts of Ansible may sadly print warnings on
+                    # stdout (instead of stderr!)
+                    if line.strip():
+                        self.log.warn("ansible remarks: %s", line)
+                    continue
+
+                if event["event"] == "task_start":
+                    self.tasks += 1
+                    self.log.debug("[%d] %s", self.tasks, event["task"])
+                elif event["event"] == "task_result":
+                    results += 1
+                    status = event["status"]
+                    if status == "failed" and event.get("ignore_errors"):
+                        status = "failed (ignored)"
+                    elif status == "unreachable":
+                        status = "failed"
+                    duration = event.get("duration")
+                    if duration is not None:
+                        # With several hosts, the task lasts until the last
+                        # result
+                        previous = self.durations.get(event["uuid"], (None, 0.0))[1]
+                        self.durations[event["uuid"]] = (event["task"], max(previous, duration))
+                    outcome = TaskOutcome(event["host"], event["task"], status, event["result"], duration)
+                    self.outcomes.append(outcome)
+                    yield outcome
+                elif event["event"] == "stats":
+                    stats = event["hosts"]
+            reader.join()
+
+        if stats is not None:
+            for host_stats in stats.values():
+                self.ok += host_stats["ok"]
+                self.changed += host_stats["changed"]
+                self.unreachable += host_stats["unreachable"]
+                self.failed += host_stats["failures"]
+        elif not results:
             self.log.warn("Ansible failed to start:")
-            self.log.warn(stderr)
+            for line in stderr:
+                self.log.warn("%s", line)
             yield TaskOutcome("", "", "failed", {'result': 'failed'})
 
-        self.result = res.wait()
+        self.result = res.returncode
 
     def run_pretty(self, cmd):
         for to in self.run(cmd):
-            if to.status == "ok":
-                self.log.info("%s: %s", to.name, to.status)
+            duration = " ({:.1f}s)".format(to.duration) if to.duration is not None else ""
+            if to.status != "failed":
+                self.log.info("[%d] %s: %s%s", self.tasks, to.name, to.status, duration)
             else:
-                self.log.warn("%s: %s", to.name, to.status)
+                self.log.warn("[%d] %s: %s%s", self.tasks, to.name, to.status, duration)
                 if to.data:
                     stdout = to.data.get("stdout")
                     if stdout:
@@ -70,6 +230,63 @@ class Ansible(Component):
                     if stderr:
                         for line in stderr.splitlines():
                             self.log.warn("err: %s", line)
-                    to.data.pop("stdout_lines", None)
-                    to.data.pop("stderr_lines", None)
-                    self.log.warn("other task data: %s", json.dumps(to.data))
+                    data = dict(to.data)
+                    data.pop("stdout_lines", None)
+                    data.pop("stderr_lines", None)
+                    self.log.warn("other task data: %s", json.dumps(data))
+        self.log_slowest_tasks()
+
+    def log_slowest_tasks(self):
+        """
+        Log the tasks that took the longest
+        """
+        if not self.durations:
+            return
+        total = sum(duration for name, duration in self.durations.values())
+        slowest = sorted(self.durations.values(), key=lambda item: item[1], reverse=True)[:self.slowest_tasks]
+        self.log.info("%d tasks run in %.1fs, slowest:", len(self.durations), total)
+        for name, duration in slowest:
+            self.log.info("%8.1fs %4.1f%%  %s", duration, duration * 100 / total if total else 0, name)
+
+    @property
+    def failed_task(self):
+        """
+        Name of the first task that failed, or None
+        """
+        for outcome in self.outcomes:
+            if outcome.status == "failed" and outcome.name:
+                return outcome.name
+        return None
+
+    def write_failure_report(self, pathname, **info):
+        """
+        Save the results of all tasks, the failed ones and the end of stderr
+        as JSON to pathname, together with info
+        """
+        report = dict(info)
+        report.update(
+            exit_code=self.result,
+            # If the playbook did not get to run any task, a resumed run
+            # still needs to start from the same task
+            failed_task=self.failed_task or info.get("start_at_task"),
+            stats={"ok": self.ok, "changed": self.changed, "unreachable": self.unreachable, "failed": self.failed},
+            failed=[outcome.to_dict() for outcome in self.outcomes if outcome.status == "failed"],
+            tasks=[outcome.to_dict() for outcome in self.outcomes],
+            stderr=list(self.stderr),
+        )
+        with open(pathname + ".tmp", "wt") as fd:
+            json.dump(report, fd, indent=1)
+        os.rename(pathname + ".tmp", pathname)
+
+
+def load_failure_report(pathname):
+    """
+    Return the contents of a failure report, or None if there is none
+    """
+    try:
+        with open(pathname, "rt") as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise Fail("Cannot read {}: {}".format(pathname, e))
@@ -0,0 +1,252 @@
+"""
+Generate the Packages and Release indices of the package pools on the
+image, without apt-ftparchive.
+
+The control data of each .deb and .udeb is read straight from its
+``control.tar.*`` ar member, and files are hashed in parallel. Both are kept
+in a persistent cache keyed by the SHA256 that apt verified when
+downloading the package, or by the device, inode, size and mtime of the
+file if it is not known, so that packages already indexed by a previous
+build are not read again. ``Packages`` and ``Packages.xz`` are written in one pass, hashing
+them as they are written, so that the Release file does not need to read
+them again.
+"""
+
+import concurrent.futures
+import hashlib
+import io
+import json
+import lzma
+import os
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from .component import Component
+from .utils import Fail
+
+READ_SIZE = 1024 * 1024
+
+
+def read_control(pathname):
+    """
+    Return the contents of the control file of a .deb or .udeb
+    """
+    with open(pathname, "rb") as fd:
+        if fd.read(8) != b"!<arch>\n":
+            raise Fail("{}: not a Debian package".format(pathname))
+        while True:
+            header = fd.read(60)
+            if len(header) < 60:
+                break
+            name = header[:16].decode("ascii", "replace").strip().rstrip("/")
+            size = int(header[48:58])
+            if name.startswith("control.tar"):
+                return _control_from_tar(pathname, name, fd.read(size))
+            # ar members are aligned to 2 bytes
+            fd.seek(size + size % 2, os.SEEK_CUR)
+    raise Fail("{}: control.tar not found".format(pathname))
+
+
+def _control_from_tar(pathname, name, data):
+    if name.endswith(".zst"):
+        # tarfile does not support zstd
+        data = subprocess.run(["zstd", "-dc"], input=data, stdout=subprocess.PIPE, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tar:
+        for member in tar:
+            if member.isfile() and member.name in ("./control", "control"):
+                return tar.extractfile(member).read().decode("utf8")
+    raise Fail("{}: control file not found in {}".format(pathname, name))
+
+
+def describe_package(pathname):
+    """
+    Return a dict with the control data, size and checksums of a package
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(pathname, "rb") as fd:
+        while True:
+            buf = fd.read(READ_SIZE)
+            if not buf:
+                break
+            md5.update(buf)
+            sha256.update(buf)
+            size += len(buf)
+    return {
+        "control": read_control(pathname),
+        "size": size,
+        "md5": md5.hexdigest(),
+        "sha256": sha256.hexdigest(),
+    }
+
+
+def packages_stanza(info, filename):
+    """
+    Return the Packages entry of a package described by describe_package
+    """
+    lines = info["control"].strip("\n").split("\n")
+    fields = [
+        "Filename: " + filename,
+        "Size: {}".format(info["size"]),
+        "MD5sum: " + info["md5"],
+        "SHA256: " + info["sha256"],
+    ]
+    # Keep the description last, like apt-ftparchive does
+    pos = next((idx for idx, line in enumerate(lines) if line.startswith("Description:")), len(lines))
+    return "\n".join(lines[:pos] + fields + lines[pos:]) + "\n\n"
+
+
+class HashingWriter:
+    """
+    Binary file wrapper that keeps the size and checksums of what is
+    written to it
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fd.write(data)
+
+    def flush(self):
+        self.fd.flush()
+
+    def info(self):
+        return {"size": self.size, "md5": self.md5.hexdigest(), "sha256": self.sha256.hexdigest()}
+
+
+class IndexCache:
+    """
+    Persistent cache of describe_package results, keyed by the SHA256 of the
+    file and validated with its size if the SHA256 is known, or keyed by
+    device and inode and validated with the size and mtime of the file.
+
+    Only the entries used since the cache was loaded are saved.
+    """
+    def __init__(self, pathname=None):
+        self.pathname = pathname
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+        if pathname and os.path.exists(pathname):
+            try:
+                with open(pathname, "rt") as fd:
+                    self.entries = json.load(fd)
+            except ValueError:
+                self.entries = {}
+
+    def describe(self, pathname, sha256=None):
+        st = os.stat(pathname)
+        if sha256 is not None:
+            # Packages are downloaded again by each build, as new inodes
+            key = "sha256:" + sha256
+            validate = [st.st_size]
+        else:
+            key = "{}:{}".format(st.st_dev, st.st_ino)
+            validate = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry["validate"] == validate:
+            with self.lock:
+                self.hits += 1
+                self.used[key] = entry
+            return entry["info"]
+        info = describe_package(pathname)
+        with self.lock:
+            self.used[key] = {"validate": validate, "info": info}
+        return info
+
+    def save(self):
+        if not self.pathname:
+            return
+        os.makedirs(os.path.dirname(self.pathname) or ".", exist_ok=True)
+        with self.lock:
+            entries = dict(self.used)
+        # The cache directory can be shared by concurrent builds
+        with tempfile.NamedTemporaryFile(
+                "wt", dir=os.path.dirname(self.pathname) or ".",
+                prefix=os.path.basename(self.pathname) + ".", suffix=".tmp", delete=False) as fd:
+            json.dump(entries, fd)
+        os.rename(fd.name, self.pathname)
+
+
+class PackageIndexer(Component):
+    """
+    Write Packages indices for package pools, and a Release file listing
+    them
+    """
+    def __init__(self, cache_path=None, threads=None):
+        super().__init__()
+        self.cache = IndexCache(cache_path)
+        self.threads = threads or os.cpu_count() or 1
+        # Size and checksums of the indices written, by pathname
+        self.indices = {}
+
+    def write_packages(self, archive_root, pool, extension, meta_dir, checksums=None):
+        """
+        Index all the packages with the given extension found in pool,
+        relative to archive_root, writing Packages and Packages.xz into
+        meta_dir. Filenames in the index are relative to archive_root.
+
+        checksums maps absolute pathnames to the SHA256 of the packages, when
+        it is already known and verified.
+        """
+        checksums = checksums or {}
+
+        def describe(pathname):
+            return self.cache.describe(pathname, checksums.get(os.path.abspath(pathname)))
+
+        files = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(archive_root, pool)):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith("." + extension):
+                    files.append(os.path.join(dirpath, name))
+
+        os.makedirs(meta_dir, exist_ok=True)
+        packages_path = os.path.join(meta_dir, "Packages")
+        hits = self.cache.hits
+        start = time.time()
+        with open(packages_path, "wb") as plain_fd, open(packages_path + ".xz", "wb") as xz_fd:
+            plain = HashingWriter(plain_fd)
+            xz_out = HashingWriter(xz_fd)
+            with lzma.open(xz_out, "wb", check=lzma.CHECK_CRC32) as xz:
+                with concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="index") as pool_exec:
+                    # map returns results in order, so entries are written
+                    # as soon as the packages before them are done
+                    for pathname, info in zip(files, pool_exec.map(describe, files)):
+                        stanza = packages_stanza(info, os.path.relpath(pathname, archive_root)).encode("utf8")
+                        plain.write(stanza)
+                        xz.write(stanza)
+        self.indices[packages_path] = plain.info()
+        self.indices[packages_path + ".xz"] = xz_out.info()
+        self.log.info("Indexed %d packages in %s in %.1fs, %d read from the cache",
+                      len(files), meta_dir, time.time() - start, self.cache.hits - hits)
+
+    def write_release(self, dists_dir, fields):
+        """
+        Write the Release file for the indices written inside dists_dir,
+        with the given fields in order
+        """
+        epoch = int(os.environ.get("SOURCE_DATE_EPOCH", time.time()))
+        lines = ["{}: {}".format(name, value) for name, value in fields]
+        lines.append("Date: " + time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime(epoch)))
+        indices = sorted(
+            (os.path.relpath(pathname, dists_dir), info) for pathname, info in self.indices.items()
+            if not os.path.relpath(pathname, dists_dir).startswith(".."))
+        for title, key in ("MD5Sum", "md5"), ("SHA256", "sha256"):
+            lines.append(title + ":")
+            for relpath, info in indices:
+                lines.append(" {} {:>16} {}".format(info[key], info["size"], relpath))
+        with open(os.path.join(dists_dir, "Release"), "wt") as fd:
+            fd.write("\n".join(lines) + "\n")
+        self.cache.save()
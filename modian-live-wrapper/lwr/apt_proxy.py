@@ -0,0 +1,366 @@
+"""
+Local caching HTTP proxy for apt, backed by a content-addressed store of
+packages.
+
+The proxy forwards all requests to the network, and looks into the
+``Packages`` indices that go through it to learn the SHA256 of each package.
+Packages with a known SHA256 are served from the store if present, or
+downloaded, verified and added to the store otherwise, so that they can be
+shared by all build stages and by concurrent builds.
+
+The proxy can also record every file it serves into a directory tree laid
+out like the mirrors they came from, which can later be served as a local
+mirror to run builds without network access.
+"""
+
+import contextlib
+import gzip
+import hashlib
+import http.server
+import lzma
+import os
+import tempfile
+import threading
+import urllib.parse
+import requests
+from .component import Component
+from .utils import transfer_file
+
+READ_SIZE = 1024 * 1024
+
+# Response headers passed on to the client
+FORWARD_RESPONSE_HEADERS = (
+    "Accept-Ranges", "Cache-Control", "Content-Encoding", "Content-Length",
+    "Content-Range", "Content-Type", "Date", "ETag", "Expires",
+    "Last-Modified", "Location",
+)
+
+# Request headers passed on to the server
+FORWARD_REQUEST_HEADERS = (
+    "Cache-Control", "If-Modified-Since", "If-None-Match", "If-Range", "Range", "User-Agent",
+)
+
+
+class PackageStore:
+    """
+    Store of package files, named after their SHA256
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, "by-sha256"), exist_ok=True)
+        os.makedirs(os.path.join(path, "by-url"), exist_ok=True)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.path, "by-sha256", sha256[:2], sha256)
+
+    def _url_path(self, url):
+        return os.path.join(self.path, "by-url", hashlib.sha1(url.encode()).hexdigest())
+
+    def lookup(self, url):
+        """
+        Return the SHA256 of a package previously stored from this url, or
+        None
+        """
+        try:
+            with open(self._url_path(url), "rt") as fd:
+                return fd.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def has(self, sha256):
+        return os.path.exists(self.blob_path(sha256))
+
+    def new_file(self):
+        """
+        Return an open temporary file in the store, to be added with add()
+        """
+        return tempfile.NamedTemporaryFile(dir=self.path, prefix=".partial-", delete=False)
+
+    def add(self, tmp_pathname, sha256, url):
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.chmod(tmp_pathname, 0o644)
+        os.rename(tmp_pathname, blob_path)
+        url_path = self._url_path(url)
+        # The store can be shared by concurrent builds
+        with tempfile.NamedTemporaryFile(
+                "wt", dir=os.path.dirname(url_path), prefix=".partial-", delete=False) as fd:
+            print(sha256, file=fd)
+        os.rename(fd.name, url_path)
+
+
+def is_package_url(url):
+    return url.endswith((".deb", ".udeb"))
+
+
+def is_packages_index_url(url):
+    if "/binary-" not in url:
+        return False
+    return os.path.basename(url).startswith("Packages") or "/by-hash/" in url
+
+
+def parse_packages_index(data):
+    """
+    Generate (Filename, SHA256) for each entry of a possibly compressed
+    Packages index
+    """
+    if data.startswith(b"\xfd7zXZ\x00"):
+        data = lzma.decompress(data)
+    elif data.startswith(b"\x1f\x8b"):
+        data = gzip.decompress(data)
+    filename = sha256 = None
+    for line in data.decode("utf8", errors="replace").splitlines():
+        if not line:
+            if filename and sha256:
+                yield filename, sha256
+            filename = sha256 = None
+        elif line.startswith("Filename:"):
+            filename = line[9:].strip()
+        elif line.startswith("SHA256:"):
+            sha256 = line[7:].strip()
+    if filename and sha256:
+        yield filename, sha256
+
+
+class AptProxy(Component):
+    """
+    Caching HTTP proxy for apt, debootstrap and python-apt.
+
+    If record_dir is set, all files successfully downloaded through the
+    proxy are also saved in it, as ``<record_dir>/<host>/<path>``.
+    """
+    def __init__(self, store_dir, record_dir=None):
+        super().__init__()
+        self.store = PackageStore(store_dir)
+        self.record_dir = record_dir
+        # Package URL -> SHA256, from the indices seen by this proxy
+        self.known = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        # Never go through ourselves, or any other proxy
+        self.session.trust_env = False
+        self.server = None
+        self.url = None
+        self.stats = {"store_hits": 0, "store_bytes": 0, "stored": 0, "network_bytes": 0}
+
+    @contextlib.contextmanager
+    def serve(self):
+        """
+        Run the proxy on a local port for the duration of the context
+        """
+        handler = type("Handler", (ProxyRequestHandler,), {"proxy": self})
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever, name="apt-proxy", daemon=True)
+        thread.start()
+        self.log.info("apt proxy listening on %s, storing packages in %s", self.url, self.store.path)
+        try:
+            yield self
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            thread.join()
+            self.log.info("apt proxy: %d packages (%d bytes) served from the store, %d packages added to it, %d bytes downloaded",
+                          self.stats["store_hits"], self.stats["store_bytes"], self.stats["stored"], self.stats["network_bytes"])
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def record_index(self, url, data):
+        base_url = url[:url.index("/dists/") + 1] if "/dists/" in url else None
+        if base_url is None:
+            return
+        try:
+            entries = {base_url + filename: sha256 for filename, sha256 in parse_packages_index(data)}
+        except (lzma.LZMAError, OSError, EOFError) as e:
+            self.log.warning("%s: cannot parse Packages index: %s", url, e)
+            return
+        with self.lock:
+            self.known.update(entries)
+        self.log.debug("%s: learned the checksums of %d packages", url, len(entries))
+
+    def record_path(self, url):
+        """
+        Return the pathname where url is recorded, or None if the proxy is
+        not recording or url cannot be mapped to a file
+        """
+        if self.record_dir is None or url is None:
+            return None
+        parsed = urllib.parse.urlsplit(url)
+        parts = [p for p in parsed.path.split("/") if p]
+        if not parts or parsed.query or any(p in (".", "..") for p in parts) or parsed.path.endswith("/"):
+            return None
+        return os.path.join(self.record_dir, parsed.netloc, *parts)
+
+    def record_file(self, url, pathname):
+        """
+        Record url with the contents of an existing file
+        """
+        dest = self.record_path(url)
+        if dest is None:
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # The same url can be recorded by concurrent requests
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(dest), prefix=".partial-", delete=False) as tmp:
+            pass
+        try:
+            # Files in the store are never changed in place
+            transfer_file(pathname, tmp.name, link=True)
+            os.rename(tmp.name, dest)
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+
+    @contextlib.contextmanager
+    def recorder(self, url):
+        """
+        Return an open file where the contents of url can be written, or
+        None if url is not recorded. The file is recorded only if the
+        context exits without errors.
+        """
+        dest = self.record_path(url)
+        if dest is None:
+            yield None
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(dest), prefix=".partial-", delete=False)
+        try:
+            with tmp:
+                yield tmp
+            os.chmod(tmp.name, 0o644)
+            os.rename(tmp.name, dest)
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+
+    def expected_sha256(self, url):
+        with self.lock:
+            sha256 = self.known.get(url)
+        if sha256 is None:
+            sha256 = self.store.lookup(url)
+        return sha256
+
+
+class ProxyRequestHandler(http.server.BaseHTTPRequestHandler):
+    proxy = None
+
+    def log_message(self, format, *args):
+        self.proxy.log.debug("%s: %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def handle_request(self, head):
+        url = self.path
+        if not url.startswith("http://"):
+            self.send_error(400, "Only proxy requests for http:// URLs are supported")
+            return
+        try:
+            if not head and is_package_url(url) and "Range" not in self.headers:
+                self.send_package(url)
+            else:
+                self.forward(url, head=head)
+        except (BrokenPipeError, ConnectionResetError):
+            self.proxy.log.debug("%s: client disconnected", url)
+        except requests.RequestException as e:
+            self.proxy.log.warning("%s: %s", url, e)
+            self.send_error(502, str(e))
+
+    def start_response(self, res):
+        self.send_response(res.status_code)
+        for name in FORWARD_RESPONSE_HEADERS:
+            if name in res.headers:
+                self.send_header(name, res.headers[name])
+        self.end_headers()
+
+    def read_body(self, res):
+        """
+        Generate the body of res as sent by the server, without decoding
+        its Content-Encoding, which is forwarded to the client
+        """
+        while True:
+            data = res.raw.read(READ_SIZE, decode_content=False)
+            if not data:
+                break
+            yield data
+
+    def forward(self, url, head):
+        headers = {name: self.headers[name] for name in FORWARD_REQUEST_HEADERS if name in self.headers}
+        method = self.proxy.session.head if head else self.proxy.session.get
+        with method(url, headers=headers, stream=True, allow_redirects=False, timeout=60) as res:
+            self.start_response(res)
+            if head:
+                return
+            complete = res.status_code == 200 and res.headers.get("Content-Encoding") is None
+            index = bytearray() if complete and is_packages_index_url(url) else None
+            with self.proxy.recorder(url if complete else None) as record:
+                for data in self.read_body(res):
+                    self.proxy.count("network_bytes", len(data))
+                    self.wfile.write(data)
+                    if index is not None:
+                        index += data
+                    if record is not None:
+                        record.write(data)
+        if index is not None:
+            self.proxy.record_index(url, bytes(index))
+
+    def send_package(self, url):
+        store = self.proxy.store
+        sha256 = self.proxy.expected_sha256(url)
+        if sha256 and store.has(sha256):
+            self.send_stored(store.blob_path(sha256))
+            self.proxy.record_file(url, store.blob_path(sha256))
+            return
+
+        with self.proxy.session.get(url, stream=True, allow_redirects=False, timeout=60) as res:
+            self.start_response(res)
+            complete = res.status_code == 200 and res.headers.get("Content-Encoding") is None
+            if not complete or not sha256:
+                # Without a checksum to verify it against, the package is not
+                # stored
+                with self.proxy.recorder(url if complete else None) as record:
+                    for data in self.read_body(res):
+                        self.proxy.count("network_bytes", len(data))
+                        self.wfile.write(data)
+                        if record is not None:
+                            record.write(data)
+                return
+
+            sha = hashlib.sha256()
+            tmp = store.new_file()
+            try:
+                with tmp:
+                    for data in self.read_body(res):
+                        self.proxy.count("network_bytes", len(data))
+                        sha.update(data)
+                        tmp.write(data)
+                        self.wfile.write(data)
+                if sha.hexdigest() == sha256:
+                    store.add(tmp.name, sha256, url)
+                    self.proxy.count("stored")
+                    self.proxy.record_file(url, store.blob_path(sha256))
+                else:
+                    self.proxy.log.warning("%s: checksum mismatch, not storing it", url)
+            finally:
+                if os.path.exists(tmp.name):
+                    os.unlink(tmp.name)
+
+    def send_stored(self, pathname):
+        size = os.path.getsize(pathname)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.debian.binary-package")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        with open(pathname, "rb") as fd:
+            while True:
+                data = fd.read(READ_SIZE)
+                if not data:
+                    break
+                self.wfile.write(data)
+        self.proxy.count("store_hits")
+        self.proxy.count("store_bytes", size)
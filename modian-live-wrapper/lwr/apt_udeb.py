@@ -6,16 +6,23 @@
 
 # depends debian-archive-keyring vmdebootstrap python-apt
 
+import fcntl
+import hashlib
 import os
 import shutil
 import tempfile
+import threading
+import time
 import logging
 import apt
+import apt.progress.base
 import apt_pkg
 from lwr.utils import copytree, copy_files, Fail
-from subprocess import check_output
 import distro_info
+from .apt_index import PackageIndexer
 from .component import Component
+from .digest import file_digest
+from .udeb_closure import udeb_closure
 
 # handle a list of package names (udebs)
 # handle a list of excluded package names
@@ -23,40 +30,112 @@ from .component import Component
 # unique sort the combined package names
 
 
-class AptUdebDownloader(Component):
+class PackageFetcher(Component):
+    """
+    Download a batch of packages through a single apt acquire queue.
 
-    def __init__(self, destdir):
+    Files already present with the right checksum are not downloaded again.
+    """
+    def __init__(self, jobs):
         super().__init__()
-        self.architecture = 'armhf'
-        self.mirror = None
-        self.codename = None
-        self.components = [
-            'main/debian-installer', 'contrib/debian-installer',
-            'non-free/debian-installer']
-        self.dirlist = []
-        self.cache = None
-        self.destdir = destdir
+        self.jobs = jobs
+        self.acquire = None
+        self.items = []
+        self.skipped = 0
+        # SHA256 of the queued packages, by absolute pathname
+        self.checksums = {}
 
-    def prepare_apt(self):
-        distroinfo = distro_info.DebianDistroInfo()
-        if distroinfo.testing() == self.codename:
-            self.suite = "testing"
-        elif self.codename == "sid":
-            self.suite = "unstable"
+    def add(self, version, destdir):
+        """
+        Queue the download of a package version into destdir, and return the
+        pathname it will have
+        """
+        with apt_lock:
+            filename = os.path.join(destdir, os.path.basename(version.record['Filename']))
+        self.checksums[os.path.abspath(filename)] = version.sha256
+        if (os.path.exists(filename) and os.path.getsize(filename) == version.size
+                and file_digest(filename) == version.sha256):
+            self.log.debug("Reusing existing %s", filename)
+            self.skipped += 1
+            return filename
+        with apt_lock:
+            # Allow as many parallel connections to the same mirror as jobs
+            apt_pkg.config["Acquire::QueueHost::Limit"] = str(self.jobs)  # pylint: disable=no-member
+            if self.acquire is None:
+                self.acquire = apt_pkg.Acquire(apt.progress.base.AcquireProgress())
+            hashes = apt_pkg.HashStringList()
+            hashes.append(apt_pkg.HashString("SHA256", version.sha256))
+            item = apt_pkg.AcquireFile(
+                    self.acquire, uri=version.uri, hash=hashes, size=version.size,
+                    descr=version.package.name, short_descr=version.package.name,
+                    destfile=filename)
+        self.items.append((version, filename, item))
+        return filename
+
+    def run(self):
+        """
+        Download all queued packages.
+
+        Returns the list of (version, error message) for the packages that
+        could not be downloaded.
+        """
+        failed = []
+        if self.items:
+            # The items carry their URI, checksum and destination, so the
+            # acquire runs without the lock, and fetchers of stages running
+            # in parallel download at the same time
+            start = time.time()
+            self.acquire.run()
+            elapsed = time.time() - start
+            size = 0
+            for version, filename, item in self.items:
+                if item.status == item.STAT_DONE:
+                    size += version.size
+                else:
+                    failed.append((version, item.error_text))
+            self.log.info("Downloaded %d packages (%d bytes) in %.1fs with up to %d connections, %d already present, %d failed",
+                          len(self.items) - len(failed), size, elapsed, self.jobs, self.skipped, len(failed))
+        elif self.skipped:
+            self.log.info("All %d packages already present", self.skipped)
+        self.acquire = None
+        self.items = []
+        self.skipped = 0
+        return failed
+
+
+class AptState(Component):
+    """
+    apt configuration, lists and package cache for a set of sources.
+
+    If state_root is set, they are kept in a directory under it, so that
+    later builds only need to check that the indices have not changed.
+    Otherwise they are kept in temporary directories, removed by remove().
+    """
+    # Directory where apt state persists across builds
+    state_root = None
+
+    def __init__(self, mirror, codename, architecture, components):
+        super().__init__()
+        self.mirror = mirror
+        self.codename = codename
+        self.architecture = architecture
+        self.components = components
+        self.temporary = self.state_root is None
+        if self.temporary:
+            self.path = tempfile.mkdtemp()
         else:
-            self.suite = "stable"
-        if not self.codename or not self.mirror:
-            raise Fail("Misconfiguration: no codename or mirror set")
-        state_dir = tempfile.mkdtemp()
-        os.mkdir(os.path.join(state_dir, 'lists'))
-        self.dirlist.append(state_dir)
-        cache_dir = tempfile.mkdtemp()
-        os.makedirs(os.path.join(cache_dir, 'archives', 'partial'))
-        self.dirlist.append(cache_dir)
-        etc_dir = tempfile.mkdtemp()
-        os.mkdir(os.path.join(etc_dir, 'apt.conf.d'))
-        os.mkdir(os.path.join(etc_dir, 'preferences.d'))
-        os.mkdir(os.path.join(etc_dir, 'trusted.gpg.d'))
+            key = hashlib.sha1(" ".join([mirror, codename, architecture] + components).encode()).hexdigest()
+            self.path = os.path.join(self.state_root, "{}-{}-{}".format(codename, architecture, key[:12]))
+        self.cache = None
+
+    def open(self):
+        state_dir = os.path.join(self.path, 'state')
+        cache_dir = os.path.join(self.path, 'cache')
+        etc_dir = os.path.join(self.path, 'etc')
+        os.makedirs(os.path.join(state_dir, 'lists'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'archives', 'partial'), exist_ok=True)
+        for name in 'apt.conf.d', 'preferences.d', 'trusted.gpg.d':
+            os.makedirs(os.path.join(etc_dir, name), exist_ok=True)
         copy_files(
             '/etc/apt/trusted.gpg.d',
             os.path.join(etc_dir, 'trusted.gpg.d')
@@ -64,13 +143,16 @@ class AptUdebDownloader(Component):
         with open(os.path.join(etc_dir, 'sources.list'), 'w') as sources:
             sources.write('deb %s %s %s\n' % (
                 self.mirror, self.codename, ' '.join(self.components)))
-        self.dirlist.append(etc_dir)
         updates = {
             'APT::Architecture': str(self.architecture),
             'APT::Architectures': str(self.architecture),
             'Dir::State': state_dir,
             'Dir::Cache': cache_dir,
             'Dir::Etc': etc_dir,
+            # Fetch indices by hash when the mirror supports it, so that
+            # updates of persistent lists never mix old and new files
+            'Acquire::By-Hash': 'yes',
+            'Acquire::Languages': 'none',
         }
         for key, value in updates.items():
             try:
@@ -79,60 +161,138 @@ class AptUdebDownloader(Component):
                 print(key, value, exc)
             continue
 
-        self.cache = apt.cache.Cache()
-        try:
-            self.cache.update()
-            self.cache.open()
-        except apt.cache.FetchFailedException as exc:
-            raise Fail('Unable to update cache: %s' % exc)
+        # Persistent lists can be shared by concurrent builds: update them
+        # one at a time. Lists that are already there are only downloaded
+        # again if they changed on the mirror.
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            start = time.time()
+            self.cache = apt.cache.Cache()
+            try:
+                self.cache.update()
+                self.cache.open()
+            except apt.cache.FetchFailedException as exc:
+                raise Fail('Unable to update cache: %s' % exc)
+        self.log.info("apt lists for %s %s %s updated in %.1fs in %s",
+                      self.mirror, self.codename, " ".join(self.components), time.time() - start, self.path)
+
+    def remove(self):
+        self.cache = None
+        if self.temporary and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+# Open apt states, by (mirror, codename, architecture, components)
+_apt_states = {}
+
+# apt_pkg.config is global to the process: hold this lock while
+# configuring apt and queueing acquire items, so that stages running in
+# parallel do not change the configuration under each other
+apt_lock = threading.RLock()
+
+
+def get_apt_state(mirror, codename, architecture, components):
+    """
+    Return the opened AptState for the given sources, opening it the first
+    time it is needed
+    """
+    key = (mirror, codename, architecture, tuple(components))
+    with apt_lock:
+        state = _apt_states.get(key)
+        if state is None:
+            state = AptState(mirror, codename, architecture, list(components))
+            state.open()
+            _apt_states[key] = state
+    return state
+
+
+def release_apt_states():
+    """
+    Forget all open apt states, removing the temporary ones
+    """
+    with apt_lock:
+        for state in _apt_states.values():
+            state.remove()
+        _apt_states.clear()
+
+
+class AptUdebDownloader(Component):
+    # Maximum number of parallel downloads
+    download_jobs = 8
+
+    # File where to keep the control data and checksums of the indexed
+    # packages across builds
+    index_cache = None
+
+    def __init__(self, destdir):
+        super().__init__()
+        self.architecture = 'armhf'
+        self.mirror = None
+        self.codename = None
+        self.components = [
+            'main/debian-installer', 'contrib/debian-installer',
+            'non-free/debian-installer']
+        self.cache = None
+        self.destdir = destdir
+        self.indexer = None
+        # SHA256 of the packages downloaded into pools, by absolute
+        # pathname, verified by apt
+        self.checksums = {}
+
+    def prepare_apt(self):
+        distroinfo = distro_info.DebianDistroInfo()
+        if distroinfo.testing() == self.codename:
+            self.suite = "testing"
+        elif self.codename == "sid":
+            self.suite = "unstable"
+        else:
+            self.suite = "stable"
+        if not self.codename or not self.mirror:
+            raise Fail("Misconfiguration: no codename or mirror set")
+        self.cache = get_apt_state(self.mirror, self.codename, self.architecture, self.components).cache
         if not os.path.exists(self.destdir):
             raise Fail('Destination directory %s does not exist' % self.destdir)
 
-    def download_package(self, name, destdir):
+    def find_version(self, name, fatal=True):
+        """
+        Return the highest downloadable version of a package.
+
+        If the package cannot be downloaded, raise Fail if fatal is True, or
+        return None otherwise.
+        """
         if not self.cache:
             raise Fail('No cache available.')
         if name not in self.cache:
-            raise Fail('%s is not available' % name)
-        pkg = self.cache[name]
-        if not hasattr(pkg, 'versions'):
-            raise Fail('%s has no available versions.' % name)
+            if fatal:
+                raise Fail('%s is not available' % name)
+            return None
         # Pick the highest version of the package, in case there are >1
-        versions = [v for v in pkg.versions if v.uri]
+        versions = [v for v in self.cache[name].versions if v.uri]
         if not versions:
-            raise Fail('No downloadable version of {} found'.format(name))
-        version = max(versions)
-        if not version.uri:
-            raise Fail('Not able to download %s' % name)
-        filename = os.path.join(destdir, os.path.basename(version.record['Filename']))
-        if os.path.exists(filename):
-            self.log.info("Reusing existing %s", filename)
-            return filename
-        try:
-            version.fetch_binary(destdir=destdir)
-        except TypeError as exc:
-            self.log.exception("fetch_binary failed")
+            if fatal:
+                raise Fail('No downloadable version of {} found'.format(name))
             return None
-        except apt.package.FetchError as exc:
-            raise Fail('Unable to fetch %s: %s' % (name, exc))
-        if os.path.exists(filename):
-            return filename
-        self.log.error("Downloading to %s did not produce file %s", destdir, os.path.basename(version.record['Filename']))
-        return None
+        return max(versions)
 
-    def download_apt_file(self, pkg_name, pool_dir, fatal):
-        if not self.cache:
-            raise Fail('No cache available.')
-        pkg = self.cache[pkg_name]
-        if not hasattr(pkg, 'versions'):
-            if fatal:
-                raise Fail('%s has no available versions.' % pkg_name)
-            return
-        # Pick the highest version of the package, in case there are >1
-        version = max(pkg.versions)
-        if not version.uri:
-            if fatal:
-                raise Fail('Not able to download %s' % pkg_name)
-            return
+    def download_packages(self, names, destdir):
+        """
+        Download the given packages into destdir, and return their pathnames
+        """
+        fetcher = PackageFetcher(self.download_jobs)
+        filenames = [fetcher.add(self.find_version(name), destdir) for name in names]
+        failed = fetcher.run()
+        if failed:
+            raise Fail('Unable to fetch %s' % ", ".join(
+                "{}: {}".format(version.package.name, error) for version, error in failed))
+        return filenames
+
+    def download_package(self, name, destdir):
+        return self.download_packages([name], destdir)[0]
+
+    def pool_dir(self, pool_dir, version):
+        """
+        Return the directory for a package in a pool, creating it if needed
+        """
         prefix = version.source_name[0]
         # pool_dir is just a base, need to add main/[index]/[name]
         if version.source_name[:3] == 'lib':
@@ -140,24 +300,74 @@ class AptUdebDownloader(Component):
         pkg_dir = os.path.join(pool_dir, prefix, version.source_name)
         if not os.path.exists(pkg_dir):
             os.makedirs(pkg_dir)
-        try:
-            version.fetch_binary(destdir=pkg_dir)
-        except TypeError as exc:
-            return
-        except apt.package.FetchError as exc:
-            raise Fail('Unable to fetch %s: %s' % (pkg_name, exc))
-
-    def download_udebs(self, exclude_list):
+        return pkg_dir
+
+    def download_to_pool(self, pkg_names, pool_dir, fatal):
+        fetcher = PackageFetcher(self.download_jobs)
+        for pkg_name in pkg_names:
+            version = self.find_version(pkg_name, fatal)
+            if version is None:
+                continue
+            fetcher.add(version, self.pool_dir(pool_dir, version))
+        failed = fetcher.run()
+        self.checksums.update(fetcher.checksums)
+        for version, error in failed:
+            if fatal:
+                raise Fail('Unable to fetch %s: %s' % (version.package.name, error))
+            self.log.warning("Unable to fetch %s: %s", version.package.name, error)
+
+    def udeb_packages(self):
+        """
+        Describe the downloadable udebs for udeb_closure
+        """
+        packages = {}
+        with apt_lock:
+            for name in self.cache.keys():
+                version = self.find_version(name, fatal=False)
+                if version is None:
+                    continue
+                packages[name] = {
+                    "depends": [[dep.name for dep in dependency.or_dependencies]
+                                for dependency in version.dependencies],
+                    "provides": list(version.provides),
+                    "priority": version.priority,
+                    "kernel_version": version.record.get('Kernel-Version'),
+                    "size": version.size,
+                }
+        return packages
+
+    def minimal_udebs(self, seeds, installed=(), kernel_version=None):
+        """
+        Return the names of the udebs needed by the installer, as computed by
+        udeb_closure, logging how much is saved compared to downloading all
+        of them
+        """
+        packages = self.udeb_packages()
+        selected, missing = udeb_closure(packages, seeds, installed, kernel_version)
+        for name in sorted(missing):
+            self.log.warning("udeb dependency %s cannot be satisfied", name)
+        total = sum(info["size"] for info in packages.values())
+        size = sum(packages[name]["size"] for name in selected)
+        self.log.info("Fetching %d of %d udebs for kernel %s: %d of %d bytes, saving %d bytes",
+                      len(selected), len(packages), kernel_version or "(any)", size, total, total - size)
+        return sorted(selected)
+
+    def download_udebs(self, exclude_list, names=None):
+        """
+        Download the udebs in names, or all the udebs if it is None, except
+        those in exclude_list
+        """
         # HACK HACK HACK
         # Setting up a separate pool for udebs, as apt-ftparchive
         # isn't generating separate Packages files
         pool_dir = os.path.join(self.destdir, '..', 'udeb', 'pool', 'main')
         if not os.path.exists(pool_dir):
             os.makedirs(pool_dir)
-        for pkg_name in self.cache.keys():
-            if pkg_name in exclude_list:
-                continue
-            self.download_apt_file(pkg_name, pool_dir, False)
+        if names is None:
+            names = self.cache.keys()
+        self.download_to_pool(
+                [name for name in names if name not in exclude_list],
+                pool_dir, False)
 
     def download_base_debs(self, pkg_list):
         # HACK HACK HACK
@@ -166,8 +376,7 @@ class AptUdebDownloader(Component):
         pool_dir = os.path.join(self.destdir, '..', 'deb', 'pool', 'main')
         if not os.path.exists(pool_dir):
             os.makedirs(pool_dir)
-        for pkg_name in pkg_list:
-            self.download_apt_file(pkg_name, pool_dir, True)
+        self.download_to_pool(pkg_list, pool_dir, True)
 
     def generate_packages_file(self, style='udeb'):
         meta_dir = os.path.normpath(os.path.join(self.destdir, '..', 'dists',
@@ -181,47 +390,47 @@ class AptUdebDownloader(Component):
                                                      'debian-installer',
                                                      'binary-%s' % (self.architecture,)))
 
-        current_dir = os.getcwd()
-        os.chdir(os.path.join(self.destdir, '..', style))
-        packages = check_output(['apt-ftparchive', '-o', 'Default::Packages::Extensions=.%s' % style,
-                                 'packages', os.path.join('pool', 'main')])
-        if not os.path.exists(meta_dir):
-            os.makedirs(meta_dir)
-        with open(os.path.join(meta_dir, 'Packages'), 'w') as pkgout:
-            pkgout.write(packages)
-        os.chdir(current_dir)
+        if self.indexer is None:
+            self.indexer = PackageIndexer(self.index_cache)
+        self.indexer.write_packages(os.path.join(self.destdir, '..', style), os.path.join('pool', 'main'),
+                                    style, meta_dir, checksums=self.checksums)
 
     # HACK HACK HACK
     # Move all the separate trees of debs, udebs and Packages files into the right place
     def merge_pools(self, sources):
         for source in sources:
-            copytree(os.path.join(self.destdir, '..', source, 'pool'),
-                     os.path.join(self.destdir, '..', 'pool'))
+            # The source pools are removed afterwards: move their files
+            copied = copytree(os.path.join(self.destdir, '..', source, 'pool'),
+                              os.path.join(self.destdir, '..', 'pool'), move=True)
+            if copied:
+                logging.debug("Copied %d bytes merging the %s pool", copied, source)
             shutil.rmtree(os.path.join(self.destdir, '..', source))
 
     def generate_release_file(self):
-        release = check_output([
-                'apt-ftparchive',
-                '-o', 'APT::FTPArchive::Release::Origin=Debian',
-                '-o', 'APT::FTPArchive::Release::Label=Debian',
-                '-o', 'APT::FTPArchive::Release::Suite=%s' % (self.suite,),
-                '-o', 'APT::FTPArchive::Release::Codename=%s' % (self.codename,),
-                '-o', 'APT::FTPArchive::Release::Architectures=%s' % (self.architecture,),
-                '-o', 'APT::FTPArchive::Release::Components=main',
-                'release', os.path.abspath(os.path.join(self.destdir, '..', 'dists', self.codename))])
-        with open(os.path.join(self.destdir, '..', 'dists', self.codename, 'Release'), 'w') as relout:
-            relout.write(release)
+        if self.indexer is None:
+            self.indexer = PackageIndexer(self.index_cache)
+        self.indexer.write_release(os.path.join(self.destdir, '..', 'dists', self.codename), [
+            ('Origin', 'Debian'),
+            ('Label', 'Debian'),
+            ('Suite', self.suite),
+            ('Codename', self.codename),
+            ('Architectures', self.architecture),
+            ('Components', 'main'),
+        ])
         logging.info("Release file generated for CD-ROM pool.")
         # End mess ----------------------------------------------------
 
     def clean_up_apt(self):
-        for clean in self.dirlist:
-            if os.path.exists(clean):
-                shutil.rmtree(clean)
+        """
+        Stop using the apt cache. The apt state stays pooled for other
+        handlers until release_apt_states() is called.
+        """
 
 
-def get_apt_handler(destdir, mirror, codename, architecture):
+def get_apt_handler(destdir, mirror, codename, architecture, download_jobs=None):
     apt_handler = AptUdebDownloader(destdir)
+    if download_jobs:
+        apt_handler.download_jobs = download_jobs
     apt_handler.mirror = mirror
     apt_handler.architecture = architecture
     apt_handler.codename = codename
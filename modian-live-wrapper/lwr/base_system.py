@@ -1,10 +1,18 @@
 import hashlib
+import fcntl
 import json
 import shutil
 import os
 import contextlib
+import tempfile
+from .ansible import FAILURE_REPORT
 from .component import Component
 from .squashfs import Squashfs
+from .cache_archive import CODECS, ChunkedArchive
+from .digest import DigestMemo, file_digest
+from .playbook import PlaybookInputs
+from .squashfs_tune import compression_args
+from .trace import tracer
 
 
 class BaseSystem(Component):
@@ -38,18 +46,89 @@ class BaseSystem(Component):
     # Name (without version) of the kernel package to use
     kernel_package = None
 
-    # Compression to use for the squashfs
+    # Compression to use for the squashfs, or "auto" to choose it by trying
+    # them on a sample of the chroot
     squashfs_compression = "lzo"  # TODO: default to xz
 
+    # Squashfs block size, like "128K" or "1M" (by default, use the
+    # mksquashfs default)
+    squashfs_block_size = None
+
+    # Compression level for the squashfs (by default, use the compressor
+    # default)
+    squashfs_compression_level = None
+
+    # Number of CPUs and amount of memory used by mksquashfs (by default,
+    # use the mksquashfs defaults)
+    squashfs_processors = None
+    squashfs_mem = None
+
+    # With "auto" compression, choose the smallest image whose estimated
+    # decompression time is within this many seconds
+    squashfs_max_decompress_time = None
+
+    # With "auto" compression, number of bytes of the chroot to try
+    # compressions on
+    squashfs_tune_sample = 128 * 1024 * 1024
+
     # Enable systemd-networkd
     networkd = False
 
     # Directory where partial artifacts can be cached
     cache_dir = None
 
+    # How stages are stored in cache_dir: "tar" for compressed tarballs,
+    # "layer" for directory trees cloned with reflinks where supported
+    cache_backend = "tar"
+
+    # Compression of tar cache archives: "gzip", "zstd" or "none"
+    cache_codec = "gzip"
+
+    # Compression level for cache archives (by default, use the codec default)
+    cache_codec_level = None
+
+    # Number of threads used to compress cache archives (by default, one per
+    # CPU)
+    cache_threads = None
+
+    # Run ansible on a cached chroot even if it was built with the same
+    # ansible inputs
+    force_ansible = False
+
+    # ansible.cfg settings to use, one of lwr.ansible.ANSIBLE_PROFILES
+    ansible_profile = "safe"
+
+    # If ansible failed on the chroot of a previous build, run it again on
+    # that chroot, starting from the failed task
+    ansible_resume = False
+
+    # URL of a local apt proxy to use while building the chroot
+    apt_proxy = None
+
     # Script to run before generating the squashfs
     customize_squashfs = None
 
+    # Hardlink the squashfs and boot files between the destination directory
+    # and the cache. Disable it if they can be changed in place after the
+    # build, like by a --customize-iso script
+    squashfs_link = True
+
+    # Trace of the files accessed at boot, to place them first in the
+    # squashfs
+    squashfs_sort_trace = None
+
+    # Directory where to record the squashfs as a base for later delta
+    # images
+    squashfs_record_base = None
+
+    # Directory with a recorded base: if set, only the changes since the
+    # base are compressed, into a squashfs layer stacked on top of it
+    squashfs_delta_base = None
+
+    # StageManifest of the work directory, to skip the chroot and squashfs
+    # generation if they are already done
+    manifest = None
+
     # Chroot working directory (by default, use a temporary directory)
     chroot_dir = None
 
@@ -64,6 +143,53 @@ class BaseSystem(Component):
         self.packages.append("eatmydata")  # to run ansible under eatmydata
         self.packages.append("live-boot")  # required for booting
         self.packages = sorted(set(self.packages))
+        self._cache_id_ansible = None
+
+    @property
+    def roles_path(self):
+        """
+        Directories where ansible looks for roles
+        """
+        return [
+            "roles",
+            "/usr/share/modian-live-wrapper/roles",
+            os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "roles")),
+        ]
+
+    @property
+    def ansible_failure_report(self):
+        """
+        Pathname of the report written when ansible fails, in the ansible
+        directory, or None if the ansible directory is not kept
+        """
+        if not self.ansible_dir:
+            return None
+        return os.path.join(self.ansible_dir, FAILURE_REPORT)
+
+    @property
+    def cache_id_ansible(self):
+        """
+        Digest of everything that goes into the ansible run: the contents of
+        the playbook, of the roles and files it uses, of the extra variables
+        file, and the variables passed in the inventory
+        """
+        if self._cache_id_ansible is None:
+            memo = DigestMemo(os.path.join(self.cache_dir, "digest-memo.json") if self.cache_dir else None)
+            playbook = PlaybookInputs(self.playbook, self.roles_path, memo=memo).resolve()
+            self.log.debug("ansible inputs: %s, roles: %s", playbook.files, playbook.roles)
+            info = {
+                "playbook": playbook.digest(),
+                "extra_vars": memo.file_digest(self.ansible_extra_vars) if os.path.exists(self.ansible_extra_vars) else None,
+                "vars": self.to_dict(exclude=("cache_dir", "packages")),
+            }
+            if self.cache_dir:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                memo.save()
+            sha = hashlib.sha1()
+            self.log.debug("cache key for ansible: %s", json.dumps(info, sort_keys=True))
+            sha.update(json.dumps(info, sort_keys=True).encode("utf8"))
+            self._cache_id_ansible = sha.hexdigest()
+        return self._cache_id_ansible
 
     @property
     def cache_id_debootstrap(self):
@@ -76,19 +202,65 @@ class BaseSystem(Component):
     @property
     def cache_id_chroot(self):
         info = {"debootstrap": self.cache_id_debootstrap,
-                "playbook": self.playbook}
+                "ansible": self.cache_id_ansible}
         sha = hashlib.sha1()
         self.log.debug("cache key for chroot: %s", json.dumps(info, sort_keys=True))
         sha.update(json.dumps(info, sort_keys=True).encode("utf8"))
         return sha.hexdigest()
 
+    @property
+    def checkpoint_inputs_chroot(self):
+        """
+        Everything the contents of the chroot depend on, including the steps
+        run after the cached chroot is restored
+        """
+        return {
+            "chroot": self.cache_id_chroot,
+            "installed_mirror_components": self.installed_mirror_components,
+            "networkd": self.networkd,
+            "customize": file_digest(self.customize_squashfs) if self.customize_squashfs else None,
+        }
+
+    @property
+    def squashfs_options(self):
+        """
+        Options passed to mksquashfs that influence the generated image.
+
+        With "auto" compression, the options are only known once the chroot
+        is built, and this describes how they are chosen instead.
+        """
+        if self.squashfs_compression == "auto":
+            return ["-comp", "auto", "-b", self.squashfs_block_size,
+                    "-max-decompress-time", self.squashfs_max_decompress_time,
+                    "-sample", self.squashfs_tune_sample]
+        return compression_args(self.squashfs_compression, self.squashfs_compression_level, self.squashfs_block_size)
+
+    @property
+    def mksquashfs_resource_options(self):
+        """
+        Options passed to mksquashfs that do not influence the generated
+        image
+        """
+        args = []
+        if self.squashfs_processors:
+            args += ["-processors", str(self.squashfs_processors)]
+        if self.squashfs_mem:
+            args += ["-mem", str(self.squashfs_mem)]
+        return args
+
     @property
     def cache_id_squashfs(self):
-        info = {"debootstrap": self.cache_id_debootstrap,
-                "im": self.installed_mirror, "playbook": self.playbook,
-                "comp": self.squashfs_compression, "networkd": self.networkd}
+        """
+        Cache key for the mksquashfs options: the squashfs cache also needs
+        the digest of the chroot contents, which is only known at build time
+        """
+        info = {"options": self.squashfs_options,
+                "customize": file_digest(self.customize_squashfs) if self.customize_squashfs else None,
+                "sort_trace": file_digest(self.squashfs_sort_trace) if self.squashfs_sort_trace else None,
+                "delta_base": file_digest(os.path.join(self.squashfs_delta_base, "manifest.json"))
+                if self.squashfs_delta_base else None}
         sha = hashlib.sha1()
-        self.log.debug("cache key for squashfs: %s", json.dumps(info, sort_keys=True))
+        self.log.debug("cache key for squashfs options: %s", json.dumps(info, sort_keys=True))
         sha.update(json.dumps(info, sort_keys=True).encode("utf8"))
         return sha.hexdigest()
 
@@ -109,14 +281,17 @@ class BaseSystem(Component):
             return
 
         os.makedirs(self.cache_dir, exist_ok=True)
-        cacher = Cacher(self, os.path.join(self.cache_dir, name + "-" + cache_id + ".tar.gz"), path)
+        if self.cache_backend == "layer":
+            cacher = LayerCacher(self, os.path.join(self.cache_dir, "layers", name + "-" + cache_id), path)
+        else:
+            cacher = Cacher(self, os.path.join(self.cache_dir, name + "-" + cache_id), path)
 
         if cacher.hit:
-            self.log.info("%s found: reusing it", cacher.tarball_name)
+            self.log.info("%s found: reusing it", cacher.location)
             cacher.extract()
             yield cacher
         else:
-            self.log.info("%s not found: (re)creating it", cacher.tarball_name)
+            self.log.info("%s not found: (re)creating it", cacher.location)
             yield cacher
             cacher.store()
 
@@ -130,6 +305,7 @@ class NullCacher:
     def __init__(self, path):
         self.path = path
         self.hit = False
+        self.meta = {}
 
     def extract(self):
         pass
@@ -137,22 +313,135 @@ class NullCacher:
     def store(self):
         pass
 
+    def save_meta(self):
+        pass
+
+
+class MetaMixin:
+    """
+    Information about how a cached stage was built, stored as JSON next to
+    it
+    """
+    def load_meta(self, pathname):
+        self.meta_pathname = pathname
+        self.meta = {}
+        if self.hit and os.path.exists(pathname):
+            with open(pathname, "rt") as fd:
+                self.meta = json.load(fd)
+
+    def save_meta(self):
+        # The cache directory can be shared by concurrent builds
+        with tempfile.NamedTemporaryFile(
+                "wt", dir=os.path.dirname(self.meta_pathname) or ".",
+                prefix=os.path.basename(self.meta_pathname) + ".", suffix=".tmp", delete=False) as fd:
+            json.dump(self.meta, fd, sort_keys=True)
+        os.rename(fd.name, self.meta_pathname)
+
+
+class Cacher(MetaMixin):
+    """
+    Store a stage as a tar archive in the cache.
 
-class Cacher:
-    def __init__(self, sysdesc, tarball_name, path):
+    Archives are written with the configured codec; existing archives
+    written with a different codec, like the ``.tar.gz`` files of previous
+    versions, are still used on a cache hit.
+    """
+    def __init__(self, sysdesc, basename, path):
         self.sysdesc = sysdesc
-        self.tarball_name = tarball_name
         self.path = path
-        self.hit = os.path.exists(self.tarball_name)
+        codec = CODECS[sysdesc.cache_codec]
+        # Archive written by store()
+        self.target = ChunkedArchive(
+                basename + codec.extension, codec,
+                level=sysdesc.cache_codec_level, threads=sysdesc.cache_threads)
+        # Archive read by extract()
+        self.archive = self.target
+        if not os.path.exists(self.target.pathname):
+            for other in CODECS.values():
+                if other is not codec and os.path.exists(basename + other.extension):
+                    self.archive = ChunkedArchive(basename + other.extension, other, threads=sysdesc.cache_threads)
+                    break
+        self.hit = os.path.exists(self.archive.pathname)
+        self.load_meta(basename + ".meta.json")
+
+    @property
+    def tarball_name(self):
+        return self.archive.pathname
+
+    @property
+    def location(self):
+        return self.archive.pathname
 
     def extract(self):
         if os.path.isdir(self.path):
             shutil.rmtree(self.path)
         os.makedirs(self.path)
-        self.sysdesc.run_cmd(["tar", "-C", self.path, "-zxf", self.tarball_name], eatmydata=False)
+        with tracer.span("cache extract", "step"):
+            self.sysdesc.run_cmd(self.archive.extract_args(self.path), eatmydata=False)
+
+    def store(self):
+        self.sysdesc.log.info("Storing %s", self.target.pathname)
+        with tracer.span("cache store", "step"):
+            self.target.create(self.path)
+        if self.archive.pathname != self.target.pathname:
+            self.archive.remove()
+            self.archive = self.target
+        self.save_meta()
+
+
+class LayerCacher(MetaMixin):
+    """
+    Store a stage as a directory tree in the cache.
+
+    The tree is named after the cache id, and it is cloned in and out of the
+    cache with ``cp --reflink=auto``: on filesystems supporting reflinks
+    (btrfs, xfs) this only shares extents, and a cache hit does not need to
+    decompress or rewrite the chroot contents.
+    """
+    def __init__(self, sysdesc, layer_dir, path):
+        self.sysdesc = sysdesc
+        self.layer_dir = layer_dir
+        self.location = layer_dir
+        self.path = path
+        self.hit = os.path.isdir(self.layer_dir)
+        self.load_meta(layer_dir + ".meta.json")
+
+    def clone(self, src, dest):
+        os.makedirs(dest, exist_ok=True)
+        self.sysdesc.run_cmd(["cp", "-a", "--reflink=auto", "--", os.path.join(src, "."), dest], eatmydata=False)
+
+    def extract(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        with tracer.span("cache extract", "step"):
+            self.clone(self.layer_dir, self.path)
 
     def store(self):
-        self.sysdesc.run_cmd(["tar", "-C", self.path, "-zcf", self.tarball_name, "."], eatmydata=False)
+        # Build the new layer next to the old one and swap them, so that an
+        # interrupted store never leaves a partial layer under the final name.
+        # Concurrent builds may store the same layer: temporary names are
+        # unique, and the swap is done holding a lock on the layer
+        parent = os.path.dirname(self.layer_dir)
+        prefix = os.path.basename(self.layer_dir) + "."
+        os.makedirs(parent, exist_ok=True)
+        new_dir = tempfile.mkdtemp(dir=parent, prefix=prefix, suffix=".new")
+        try:
+            with tracer.span("cache store", "step"):
+                self.clone(self.path, new_dir)
+        except BaseException:
+            shutil.rmtree(new_dir)
+            raise
+        old_dir = None
+        with open(self.layer_dir + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(self.layer_dir):
+                # rename() replaces the empty directory made by mkdtemp
+                old_dir = tempfile.mkdtemp(dir=parent, prefix=prefix, suffix=".old")
+                os.rename(self.layer_dir, old_dir)
+            os.rename(new_dir, self.layer_dir)
+            self.save_meta()
+        if old_dir is not None:
+            shutil.rmtree(old_dir)
 
 
 @contextlib.contextmanager
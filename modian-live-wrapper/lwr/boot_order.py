@@ -0,0 +1,96 @@
+"""
+Place the files read at boot at the start of the squashfs image, using a
+trace of the files accessed while booting a previous image.
+
+Reading files in the order they are stored avoids seeking on slow boot
+media, like USB sticks: mksquashfs stores files with a higher priority in
+its ``-sort`` file first, so the files in the trace are given decreasing
+priorities in the order they were first accessed.
+"""
+
+import os
+
+# Highest priority accepted by mksquashfs
+MAX_PRIORITY = 32767
+
+# Filesystems that are not part of the image
+VIRTUAL_DIRS = ("proc", "sys", "dev", "run", "tmp")
+
+
+def read_boot_trace(pathname):
+    """
+    Generate the absolute paths listed in a boot trace, in order.
+
+    Each line of the trace is expected to end with an absolute path, like
+    a plain list of paths or the output of ``fatrace``; empty lines and
+    lines starting with ``#`` are ignored.
+    """
+    with open(pathname, "rt", errors="surrogateescape") as fd:
+        for line in fd:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = line.split()[-1]
+            if path.startswith("/"):
+                yield path
+
+
+def resolve_in_root(root, path, max_links=40):
+    """
+    Resolve symlinks in path as if root was the root directory, returning
+    the resolved path relative to root, or None if there are too many
+    levels of symlinks
+    """
+    parts = [p for p in path.split("/") if p and p != "."]
+    resolved = []
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        candidate = os.path.join(root, *resolved, part)
+        if os.path.islink(candidate):
+            links += 1
+            if links > max_links:
+                return None
+            target = os.readlink(candidate)
+            if target.startswith("/"):
+                resolved = []
+            parts = [p for p in target.split("/") if p and p != "."] + parts
+            continue
+        resolved.append(part)
+    return "/".join(resolved)
+
+
+def boot_order(trace, root):
+    """
+    Return the regular files of the tree at root that are listed in the
+    trace, relative to root, in order of first access
+    """
+    res = []
+    seen = set()
+    for path in read_boot_trace(trace):
+        relpath = resolve_in_root(root, path)
+        if not relpath or relpath in seen or relpath.split("/")[0] in VIRTUAL_DIRS:
+            continue
+        # The sort file cannot represent names with whitespace
+        if any(c.isspace() for c in relpath):
+            continue
+        pathname = os.path.join(root, relpath)
+        if os.path.isfile(pathname) and not os.path.islink(pathname):
+            seen.add(relpath)
+            res.append(relpath)
+    return res
+
+
+def write_sort_file(trace, root, fd):
+    """
+    Write to fd a mksquashfs sort file placing the files in trace first, in
+    the order they were accessed. Return the number of files listed.
+    """
+    files = boot_order(trace, root)
+    for idx, relpath in enumerate(files):
+        print(relpath, max(MAX_PRIORITY - idx, 1), file=fd)
+    return len(files)
@@ -0,0 +1,158 @@
+"""
+Chunked tar archives for the build cache.
+
+The tar stream of a directory is split into fixed size chunks, and each chunk
+is compressed independently as a gzip member or a zstd frame. The
+concatenation of the compressed chunks is still a valid ``.tar.gz`` or
+``.tar.zst`` file that tar can extract as usual, but chunks can be compressed
+in parallel.
+"""
+
+import collections
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import tempfile
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Uncompressed size of each independently compressed chunk
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class Codec:
+    """
+    Compression used for the chunks of a cache archive
+    """
+    name = None
+    extension = None
+    default_level = None
+    # Uncompressed size of each chunk
+    chunk_size = CHUNK_SIZE
+
+    def compress(self, data, level):
+        raise NotImplementedError("compress")
+
+    def tar_args(self, threads):
+        """
+        Return the tar arguments to decompress a whole archive
+        """
+        raise NotImplementedError("tar_args")
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    extension = ".tar.gz"
+    default_level = 6
+
+    def compress(self, data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def tar_args(self, threads):
+        pigz = shutil.which("pigz")
+        if pigz:
+            return ["-I", "{} -p {}".format(pigz, threads)]
+        return ["-z"]
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    extension = ".tar.zst"
+    default_level = 3
+    # Without the zstandard module, each chunk is compressed by running zstd:
+    # use larger chunks, to run it less often
+    chunk_size = CHUNK_SIZE if zstandard is not None else 8 * CHUNK_SIZE
+
+    def compress(self, data, level):
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=level).compress(data)
+        args = ["zstd", "-q", "-c", "-{}".format(level)]
+        if level > 19:
+            args.append("--ultra")
+        return subprocess.run(args, input=data, stdout=subprocess.PIPE, check=True).stdout
+
+    def tar_args(self, threads):
+        return ["-I", "zstd -T{}".format(threads)]
+
+
+class NoneCodec(Codec):
+    name = "none"
+    extension = ".tar"
+    default_level = 0
+
+    def compress(self, data, level):
+        return data
+
+    def tar_args(self, threads):
+        return []
+
+
+CODECS = {codec.name: codec for codec in (GzipCodec(), ZstdCodec(), NoneCodec())}
+
+
+class ChunkedArchive:
+    """
+    Cache archive stored as independently compressed chunks of a tar stream
+    """
+    def __init__(self, pathname, codec, level=None, threads=None, chunk_size=None):
+        self.pathname = pathname
+        self.codec = codec
+        self.level = level if level is not None else codec.default_level
+        self.threads = threads or os.cpu_count() or 1
+        self.chunk_size = chunk_size or codec.chunk_size
+
+    def create(self, src):
+        """
+        Archive the contents of the directory src
+        """
+        # The cache directory can be shared by concurrent builds storing the
+        # same archive: write to a unique temporary file
+        fd, tmp_archive = tempfile.mkstemp(
+                dir=os.path.dirname(self.pathname) or ".",
+                prefix=os.path.basename(self.pathname) + ".", suffix=".tmp")
+        try:
+            self._write(src, fd)
+        except BaseException:
+            os.unlink(tmp_archive)
+            raise
+        os.rename(tmp_archive, self.pathname)
+
+    def _write(self, src, fd):
+        """
+        Write the compressed tar stream of src to the file descriptor fd
+        """
+        tar = subprocess.Popen(["tar", "-C", src, "-cf", "-", "."], stdout=subprocess.PIPE)
+        with open(fd, "wb") as out, concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+            pending = collections.deque()
+
+            def write_chunks(limit):
+                # Write compressed chunks in order, keeping at most limit
+                # chunks in flight to bound memory usage
+                while len(pending) > limit:
+                    out.write(pending.popleft().result())
+
+            while True:
+                chunk = tar.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                pending.append(pool.submit(self.codec.compress, chunk, self.level))
+                write_chunks(self.threads * 2)
+            write_chunks(0)
+
+        if tar.wait() != 0:
+            raise subprocess.CalledProcessError(tar.returncode, tar.args)
+
+    def extract_args(self, dest):
+        """
+        Return the tar command line to extract the whole archive into dest
+        """
+        return ["tar", "-C", dest] + self.codec.tar_args(self.threads) + ["-xf", self.pathname]
+
+    def remove(self):
+        if os.path.exists(self.pathname):
+            os.unlink(self.pathname)
@@ -0,0 +1,92 @@
+"""
+Ansible stdout callback used by modian-live-wrapper: it writes one JSON
+object per line for each playbook event, as soon as it happens, so that
+progress can be followed while the playbook runs.
+
+Each line has an ``event`` field, one of ``playbook_start``,
+``play_start``, ``task_start``, ``task_result`` or ``stats``, and a
+``time`` field with the time of the event.
+"""
+
+from __future__ import annotations
+
+DOCUMENTATION = """
+    name: lwr_jsonl
+    type: stdout
+    short_description: one JSON object per line for each playbook event
+    description:
+      - Used by modian-live-wrapper to follow the progress of the playbook
+        and time its tasks.
+"""
+
+import json  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from ansible.parsing.ajson import AnsibleJSONEncoder  # noqa: E402
+from ansible.plugins.callback import CallbackBase  # noqa: E402
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "stdout"
+    CALLBACK_NAME = "lwr_jsonl"
+
+    def __init__(self, display=None):
+        super().__init__(display)
+        # Start time of the running tasks, by task uuid
+        self.task_start = {}
+
+    def emit(self, event, **kw):
+        kw["event"] = event
+        kw["time"] = time.time()
+        try:
+            line = json.dumps(kw, cls=AnsibleJSONEncoder, sort_keys=True)
+        except (TypeError, ValueError):
+            line = json.dumps(kw, default=repr, sort_keys=True)
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+    def v2_playbook_on_start(self, playbook):
+        self.emit("playbook_start", playbook=playbook._file_name)
+
+    def v2_playbook_on_play_start(self, play):
+        self.emit("play_start", name=play.get_name())
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.task_start[task._uuid] = time.time()
+        self.emit("task_start", task=task.get_name(), uuid=task._uuid, action=task.action)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.task_start[task._uuid] = time.time()
+        self.emit("task_start", task=task.get_name(), uuid=task._uuid, action=task.action, handler=True)
+
+    def emit_result(self, result, status, **kw):
+        task = result._task
+        data = dict(result._result)
+        self._clean_results(data, task.action)
+        start = self.task_start.get(task._uuid)
+        self.emit(
+            "task_result",
+            host=result._host.get_name(),
+            task=task.get_name(),
+            uuid=task._uuid,
+            action=task.action,
+            status=status,
+            duration=time.time() - start if start is not None else None,
+            result=data,
+            **kw)
+
+    def v2_runner_on_ok(self, result):
+        self.emit_result(result, "changed" if result._result.get("changed") else "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.emit_result(result, "failed", ignore_errors=ignore_errors)
+
+    def v2_runner_on_skipped(self, result):
+        self.emit_result(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self.emit_result(result, "unreachable")
+
+    def v2_playbook_on_stats(self, stats):
+        self.emit("stats", hosts={host: stats.summarize(host) for host in sorted(stats.processed)})
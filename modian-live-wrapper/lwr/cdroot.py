@@ -7,6 +7,7 @@
 import os
 import shutil
 import tempfile
+from lwr.utils import transfer_file
 
 
 class CDRoot(object):
@@ -28,3 +29,31 @@ class CDRoot(object):
     def __del__(self):
         if self.delete:
             shutil.rmtree(self.path)
+
+
+# Directories of the cdroot that are not changed after they are created,
+# and can be shared by hardlinks between copies
+SHARED_DIRS = ("live", "d-i", "pool", "firmware")
+
+
+def clone_cdroot(src, dest, share=True):
+    """
+    Copy the contents of a cdroot to dest, hardlinking the files in
+    SHARED_DIRS instead of copying them.
+
+    With share=False, for copies that may be changed in place, the files in
+    SHARED_DIRS are reflinked where the filesystem supports it, and copied
+    otherwise.
+    """
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    os.makedirs(dest)
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dest_path = os.path.join(dest, name)
+        if not os.path.isdir(src_path) or os.path.islink(src_path):
+            shutil.copy2(src_path, dest_path, follow_symlinks=False)
+        elif name in SHARED_DIRS:
+            shutil.copytree(src_path, dest_path, symlinks=True, copy_function=os.link if share else transfer_file)
+        else:
+            shutil.copytree(src_path, dest_path, symlinks=True)
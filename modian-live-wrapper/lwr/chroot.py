@@ -6,7 +6,9 @@ import subprocess
 from contextlib import contextmanager
 from .component import Component
 from .debootstrap import Debootstrap
-from .ansible import Ansible
+from .ansible import CALLBACK_PLUGINS, STDOUT_CALLBACK, Ansible, ansible_config
+from .trace import tracer
+from .utils import copy_files
 
 
 class Chroot(Component):
@@ -16,9 +18,20 @@ class Chroot(Component):
         super().__init__()
         self.sysdesc = sysdesc
 
-    def build(self, dest):
-        if os.path.isdir(os.path.join(dest, "etc")):
-            self.log.info("%s already exists: reusing it", dest)
+    def build(self, dest, start_at_task=None):
+        """
+        Build the chroot in dest.
+
+        If start_at_task is set, dest contains a chroot where ansible failed
+        at that task: only run the playbook again starting from it, without
+        storing the result in the cache.
+        """
+        if start_at_task is not None:
+            self.log.info("Resuming ansible on %s at task %r", dest, start_at_task)
+            self.run_ansible(self.sysdesc, dest, start_at_task=start_at_task)
+            self.update_initramfs(dest)
+            self.set_target_apt_mirror(dest)
+            self.enable_networkd(dest)
             return
 
         with self.sysdesc.cache(dest, "chroot", self.sysdesc.cache_id_chroot) as cache:
@@ -27,20 +40,30 @@ class Chroot(Component):
                 debootstrap.build(dest)
                 # self.remove_udev_persistent_rules(dest)  # FIXME: is this needed?
                 self.run_ansible(self.sysdesc, dest)
+                cache.meta["ansible_inputs"] = self.sysdesc.cache_id_ansible
+            elif (not self.sysdesc.force_ansible
+                  and cache.meta.get("ansible_inputs") == self.sysdesc.cache_id_ansible):
+                self.log.info("Cached chroot was customized with the same ansible inputs: skipping ansible")
             else:
-                if self.run_ansible(self.sysdesc, dest):
+                changed = self.run_ansible(self.sysdesc, dest)
+                cache.meta["ansible_inputs"] = self.sysdesc.cache_id_ansible
+                if changed:
                     # Run cache.store() only if ansible changed anything
                     cache.store()
                 else:
                     self.log.info("Ansible did not change anything: keep previous cache")
+                    cache.save_meta()
 
         self.update_initramfs(dest)
         self.set_target_apt_mirror(dest)
         self.enable_networkd(dest)
 
-    def run_ansible(self, sysdesc, dest):
+    def run_ansible(self, sysdesc, dest, start_at_task=None):
         """
-        Run ansible and return True if it changed something
+        Run ansible and return True if it changed something.
+
+        If ansible fails, write the results of its tasks to
+        sysdesc.ansible_failure_report, if set.
         """
         self.log.info("Customizing %s with %s", dest, sysdesc.playbook)
         vars = sysdesc.to_dict(exclude=("cache_dir", "packages"))
@@ -54,18 +77,23 @@ class Chroot(Component):
                         " ".join("{}={}".format(k, v) for k, v in vars.items())),
                       file=fd)
 
+            # Facts describe the contents of the chroot, so they are only
+            # shared with builds of a chroot with the same cache id, that is
+            # from the same debootstrap and ansible inputs
+            if sysdesc.cache_dir:
+                fact_cache = os.path.join(os.path.abspath(sysdesc.cache_dir), "ansible-facts", sysdesc.cache_id_chroot)
+            else:
+                fact_cache = os.path.join(workdir, "facts")
+            config = ansible_config(sysdesc.ansible_profile, os.path.abspath(ansible_inventory), sysdesc.roles_path,
+                                    fact_cache=fact_cache, ansible_playbook=self.ansible_playbook)
+            self.log.debug("ansible profile %s: %s", sysdesc.ansible_profile, config)
+
             ansible_cfg = os.path.join(workdir, "ansible.cfg")
             with open(ansible_cfg, "wt") as fd:
-                print("[defaults]", file=fd)
-                print("nocows = 1", file=fd)
-                print("inventory = {}".format(os.path.abspath(ansible_inventory)), file=fd)
-                print("roles_path = roles:{}:{}/roles".format(
-                    "/usr/share/modian-live-wrapper/roles",
-                    os.path.abspath(os.path.join(
-                        os.path.dirname(__file__),
-                        "../",
-                    ))
-                ), file=fd)
+                for section, settings in config.items():
+                    print("[{}]".format(section), file=fd)
+                    for key, value in settings.items():
+                        print("{} = {}".format(key, value), file=fd)
 
             args = [
                 self.ansible_playbook,
@@ -75,23 +103,33 @@ class Chroot(Component):
                 ),
                 os.path.abspath(sysdesc.playbook)
             ]
+            if start_at_task is not None:
+                args += ["--start-at-task", start_at_task]
             ansible_sh = os.path.join(workdir, "ansible.sh")
             with open(ansible_sh, "wt") as fd:
                 print("#!/bin/sh", file=fd)
                 print("set -xue", file=fd)
                 print("export ANSIBLE_CONFIG={}".format(shlex.quote(ansible_cfg)), file=fd)
-                print("export ANSIBLE_STDOUT_CALLBACK=json", file=fd)
+                print("export ANSIBLE_STDOUT_CALLBACK={}".format(STDOUT_CALLBACK), file=fd)
+                print("export ANSIBLE_CALLBACK_PLUGINS={}".format(shlex.quote(CALLBACK_PLUGINS)), file=fd)
                 print(" ".join(shlex.quote(x) for x in args), file=fd)
             os.chmod(ansible_sh, 0o755)
 
-            with self.prepare_ansible_chroot(dest):
+            with tracer.span("ansible", "step"), self.prepare_ansible_chroot(dest):
                 res = self._run_ansible([ansible_sh])
+            report = sysdesc.ansible_failure_report
             if res.result != 0:
-                self.log.warn("Rerunning ansible to check what fails")
-                self._run_ansible([ansible_sh])
-                raise RuntimeError("ansible exited with result {}".format(res.result))
+                if report is not None:
+                    res.write_failure_report(
+                            report, playbook=os.path.abspath(sysdesc.playbook), chroot=os.path.abspath(dest),
+                            command=args, start_at_task=start_at_task)
+                    self.log.warn("Results of the ansible tasks saved to %s", report)
+                raise RuntimeError("ansible exited with result {}{}".format(
+                    res.result, ", failing at task {!r}".format(res.failed_task) if res.failed_task else ""))
             else:
-                return res.changed == 0 and res.unreachable == 0 and res.failed == 0
+                if report is not None and os.path.exists(report):
+                    os.unlink(report)
+                return res.changed > 0
 
     def _run_ansible(self, cmd):
         ansible = Ansible()
@@ -102,10 +140,30 @@ class Chroot(Component):
     def prepare_ansible_chroot(self, dest):
         subprocess.run(["mount", "-o", "ro", "-t", "proc", "none", os.path.abspath(os.path.join(dest, "proc"))], check=True)
         try:
-            yield
+            with self.use_apt_proxy(dest):
+                yield
         finally:
             subprocess.run(["umount", os.path.abspath(os.path.join(dest, "proc"))], check=True)
 
+    @contextmanager
+    def use_apt_proxy(self, dest):
+        """
+        Configure apt in the chroot to use the local apt proxy, if any.
+
+        The configuration is removed afterwards, so that it does not end up
+        in the cached chroot or in the image.
+        """
+        if not self.sysdesc.apt_proxy:
+            yield
+            return
+        proxy_conf = os.path.join(dest, "etc", "apt", "apt.conf.d", "00lwr-proxy")
+        with open(proxy_conf, "wt") as fd:
+            print('Acquire::http::Proxy "{}";'.format(self.sysdesc.apt_proxy), file=fd)
+        try:
+            yield
+        finally:
+            os.unlink(proxy_conf)
+
     def remove_udev_persistent_rules(self, dest):
         self.log.info('Removing udev persistent cd and net rules')
         for rule in '70-persistent-cd.rules', '70-persistent-net.rules':
@@ -120,19 +178,18 @@ class Chroot(Component):
         cmd = os.path.join('usr', 'sbin', 'update-initramfs')
         if os.path.exists(os.path.join(dest, cmd)):
             self.log.info("Updating the initramfs")
-            self.run_cmd(['chroot', dest, cmd, '-u'])
+            # Build a reproducible initramfs, so that an unchanged chroot
+            # keeps the same contents and can reuse the cached squashfs
+            env = dict(os.environ)
+            env["SOURCE_DATE_EPOCH"] = str(int(os.path.getmtime(os.path.join(dest, "var", "lib", "dpkg", "status"))))
+            self.run_cmd(['chroot', dest, cmd, '-u'], env=env)
 
     def copy_files(self, src, dest):
         """
-        Copy all files in src to dest
+        Copy all files in src to dest, returning the number of bytes
+        actually copied
         """
-        for filename in os.listdir(src):
-            src_path = os.path.join(src, filename)
-            if os.path.isdir(src_path) or os.path.islink(src_path):
-                continue
-            shutil.copyfile(
-                src_path,
-                os.path.join(dest, filename))
+        return copy_files(src, dest, link=False)
 
     def set_target_apt_mirror(self, dest):
         """
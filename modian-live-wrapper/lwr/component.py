@@ -6,6 +6,7 @@ import subprocess
 import tempfile
 import contextlib
 import logging
+from .trace import TracedPopen
 
 
 class Component:
@@ -20,17 +21,31 @@ class Component:
             self.name = self.__class__.__name__.lower()
         self.log = logging.getLogger(self.name)
 
-    def run_cmd(self, args, check=True, eatmydata=True, **kw):
-        if eatmydata and self.eatmydata:
-            args = [self.eatmydata] + args
-        self.log.debug("run: %s", " ".join(shlex.quote(x) for x in args))
-        return subprocess.run(args, check=check, **kw)
+    def run_cmd(self, args, check=True, eatmydata=True, input=None, timeout=None, **kw):
+        """
+        Run a command like subprocess.run, tracing its resource usage
+        """
+        if input is not None:
+            kw["stdin"] = subprocess.PIPE
+        with self.popen(args, eatmydata=eatmydata, **kw) as proc:
+            try:
+                stdout, stderr = proc.communicate(input, timeout=timeout)
+            except BaseException:
+                proc.kill()
+                raise
+        if check and proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, output=stdout, stderr=stderr)
+        return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
 
     def popen(self, args, eatmydata=True, **kw):
+        """
+        Start a command like subprocess.Popen, tracing its resource usage
+        once it is waited for
+        """
         if eatmydata and self.eatmydata:
             args = [self.eatmydata] + args
         self.log.debug("run: %s", " ".join(shlex.quote(x) for x in args))
-        return subprocess.Popen(args, **kw)
+        return TracedPopen(args, **kw)
 
     @contextlib.contextmanager
     def work_dir(self, existing=None):
@@ -1,4 +1,5 @@
 from .component import Component
+from .trace import tracer
 
 
 class Debootstrap(Component):
@@ -10,13 +11,14 @@ class Debootstrap(Component):
         self.log.info("Debootstrapping %s [%s]", self.sysdesc.distribution, self.sysdesc.architecture)
         with self.sysdesc.cache(dest, "debootstrap", self.sysdesc.cache_id_debootstrap) as cache:
             if not cache.hit:
-                args = ['debootstrap', '--arch=' + self.sysdesc.architecture]
-                if self.sysdesc.packages:
-                    args.append('--include=' + ','.join(sorted(self.sysdesc.packages)))
-                args += [self.sysdesc.distribution, cache.path, self.sysdesc.build_mirror]
-                self.log.debug("debootstrap arguments: %s", args)
-                self.run_cmd(args)
-                self.apt_clean_cache(cache.path)
+                with tracer.span("debootstrap", "step"):
+                    args = ['debootstrap', '--arch=' + self.sysdesc.architecture]
+                    if self.sysdesc.packages:
+                        args.append('--include=' + ','.join(sorted(self.sysdesc.packages)))
+                    args += [self.sysdesc.distribution, cache.path, self.sysdesc.build_mirror]
+                    self.log.debug("debootstrap arguments: %s", args)
+                    self.run_cmd(args)
+                    self.apt_clean_cache(cache.path)
 
     def apt_clean_cache(self, dest):
         self.run_cmd(['chroot', dest, 'apt-get', 'clean'])
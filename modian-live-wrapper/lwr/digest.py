@@ -0,0 +1,130 @@
+"""
+Content digests of files and directory trees, used to compute cache keys.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+
+READ_SIZE = 1024 * 1024
+
+
+def json_digest(data):
+    """
+    Return the SHA256 hex digest of a JSON-serializable value
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def file_digest(pathname):
+    """
+    Return the SHA256 hex digest of the contents of a file
+    """
+    sha = hashlib.sha256()
+    with open(pathname, "rb") as fd:
+        while True:
+            buf = fd.read(READ_SIZE)
+            if not buf:
+                break
+            sha.update(buf)
+    return sha.hexdigest()
+
+
+class DigestMemo:
+    """
+    Persistent memo of file digests, keyed by path and validated with the
+    device, inode, size, mtime and ctime of the file, so that unchanged files
+    are not read again
+    """
+    def __init__(self, pathname=None):
+        self.pathname = pathname
+        self.entries = {}
+        self.lock = threading.Lock()
+        if pathname and os.path.exists(pathname):
+            try:
+                with open(pathname, "rt") as fd:
+                    self.entries = json.load(fd)
+            except ValueError:
+                self.entries = {}
+
+    def file_digest(self, pathname):
+        pathname = os.path.abspath(pathname)
+        st = os.stat(pathname)
+        key = [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+        with self.lock:
+            entry = self.entries.get(pathname)
+        if entry is not None and entry[:-1] == key:
+            return entry[-1]
+        digest = file_digest(pathname)
+        with self.lock:
+            self.entries[pathname] = key + [digest]
+        return digest
+
+    def save(self):
+        if not self.pathname:
+            return
+        with self.lock:
+            # Forget files that have disappeared
+            entries = {k: v for k, v in self.entries.items() if os.path.exists(k)}
+        # The memo in the cache directory can be saved by concurrent builds
+        with tempfile.NamedTemporaryFile(
+                "wt", dir=os.path.dirname(self.pathname) or ".",
+                prefix=os.path.basename(self.pathname) + ".", suffix=".tmp", delete=False) as fd:
+            json.dump(entries, fd)
+        os.rename(fd.name, self.pathname)
+
+
+def walk_tree(root):
+    """
+    Generate (relative path, lstat result) for everything inside root, in a
+    stable order
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            pathname = os.path.join(dirpath, name)
+            yield os.path.relpath(pathname, root), os.lstat(pathname)
+
+
+def tree_manifest(root, threads=None, memo=None):
+    """
+    Describe the type, permissions, ownership and contents of everything
+    inside root.
+
+    Returns a dict mapping relative paths to dicts of attributes. The
+    contents of regular files are hashed in parallel, using memo if given.
+    """
+    manifest = {}
+    files = []
+    for relpath, st in walk_tree(root):
+        entry = {"mode": st.st_mode, "uid": st.st_uid, "gid": st.st_gid}
+        if stat.S_ISREG(st.st_mode):
+            entry["size"] = st.st_size
+            entry["nlink"] = st.st_nlink
+            files.append(relpath)
+        elif stat.S_ISLNK(st.st_mode):
+            entry["target"] = os.readlink(os.path.join(root, relpath))
+        elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            entry["rdev"] = st.st_rdev
+        manifest[relpath] = entry
+
+    # hashlib releases the GIL while hashing, so threads hash in parallel
+    with concurrent.futures.ThreadPoolExecutor(threads or (os.cpu_count() or 1)) as pool:
+        digests = pool.map(
+                memo.file_digest if memo else file_digest,
+                (os.path.join(root, relpath) for relpath in files))
+        for relpath, digest in zip(files, digests):
+            manifest[relpath]["sha256"] = digest
+
+    return manifest
+
+
+def tree_digest(root, threads=None, memo=None):
+    """
+    Return a SHA256 hex digest of everything inside root
+    """
+    return json_digest(tree_manifest(root, threads=threads, memo=memo))
@@ -12,6 +12,10 @@ the cdroot.
 import os
 from datetime import datetime
 
+# udebs that the installer loads from the image in addition to those of
+# standard priority
+UDEB_INCLUDE = ("netcfg", "ethdetect", "pcmciautils-udeb", "live-installer")
+
 
 def get_default_description(distribution):
     distribution = distribution if distribution else "dist"
@@ -21,10 +25,11 @@ def get_default_description(distribution):
         return "Unofficial Debian GNU/Linux '%s' Live" % (distribution,)
 
 
-def install_disk_info(cdroot, description, xorriso_args):
+def install_disk_info(cdroot, description, xorriso_args, udeb_include=()):
     """
     This function creates the .disk/ metadata and installs it into the
-    specified cdroot.
+    specified cdroot. udeb_include lists udebs to load in addition to
+    UDEB_INCLUDE.
     """
 
     timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M")
@@ -32,7 +37,8 @@ def install_disk_info(cdroot, description, xorriso_args):
     with open(os.path.join(metadir, "info"), "w") as i:
         i.write("%s %s" % (description, timestamp,))
     with open(os.path.join(metadir, "udeb_include"), "w") as i:
-        i.write("netcfg\nethdetect\npcmciautils-udeb\nlive-installer\n")
+        for name in UDEB_INCLUDE + tuple(n for n in udeb_include if n not in UDEB_INCLUDE):
+            i.write(name + "\n")
     with open(os.path.join(metadir, "cd_type"), "w") as i:
         i.write("live")
     with open(os.path.join(metadir, "base_installable"), "w") as i:
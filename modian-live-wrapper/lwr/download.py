@@ -0,0 +1,170 @@
+"""
+Verified, resumable downloads of debian-installer files, optionally cached
+across builds.
+"""
+
+import fcntl
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import pycurl
+from .component import Component
+from .digest import file_digest
+from .utils import Fail, transfer_file
+
+
+class Downloader(Component):
+    """
+    Download files, verifying them against the SHA256SUMS file published
+    with them.
+
+    If path is set, verified files are kept there named after their SHA256,
+    and SHA256SUMS files are reused for sums_ttl seconds, so that files
+    downloaded by a previous build do not need the network at all.
+    """
+    def __init__(self, path=None, sums_ttl=86400):
+        super().__init__()
+        self.path = path
+        self.sums_ttl = sums_ttl
+        # SHA256SUMS contents by URL
+        self.sums = {}
+        self.lock = threading.Lock()
+        if path:
+            for name in "by-sha256", "partial", "sums":
+                os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    def checksums(self, sums_url):
+        """
+        Return a dict mapping the names listed in a SHA256SUMS file, like
+        ``./cdrom/vmlinuz``, to their SHA256
+        """
+        with self.lock:
+            if sums_url in self.sums:
+                return self.sums[sums_url]
+
+        cached = None
+        if self.path:
+            cached = os.path.join(self.path, "sums", hashlib.sha1(sums_url.encode()).hexdigest())
+        if cached and os.path.exists(cached) and time.time() - os.path.getmtime(cached) < self.sums_ttl:
+            self.log.debug("%s: using cached copy %s", sums_url, cached)
+            with open(cached, "rt") as fd:
+                text = fd.read()
+        else:
+            try:
+                buf = io.BytesIO()
+                self.perform(sums_url, buf)
+                text = buf.getvalue().decode()
+            except Fail as e:
+                if cached and os.path.exists(cached):
+                    self.log.warning("%s, using the previously downloaded copy", e)
+                    with open(cached, "rt") as fd:
+                        text = fd.read()
+                else:
+                    self.log.warning("%s, downloads from there will not be verified", e)
+                    text = ""
+            else:
+                if cached:
+                    # The cache directory can be shared by concurrent builds
+                    with tempfile.NamedTemporaryFile(
+                            "wt", dir=os.path.dirname(cached), prefix=os.path.basename(cached) + ".",
+                            suffix=".tmp", delete=False) as fd:
+                        fd.write(text)
+                    os.rename(fd.name, cached)
+
+        sums = {}
+        for line in text.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                sums[parts[1]] = parts[0]
+        with self.lock:
+            self.sums[sums_url] = sums
+        return sums
+
+    def expected_sha256(self, url, sums_url):
+        """
+        Return the SHA256 of url from the SHA256SUMS file at sums_url, or
+        None if it is not listed there
+        """
+        base_url = sums_url.rsplit("/", 1)[0] + "/"
+        if not url.startswith(base_url):
+            return None
+        return self.checksums(sums_url).get("./" + url[len(base_url):])
+
+    def perform(self, url, fd, offset=0):
+        """
+        Download url, writing it to the file object fd, starting from the
+        given offset
+        """
+        curl = pycurl.Curl()
+        try:
+            curl.setopt(curl.URL, url)
+            curl.setopt(curl.WRITEDATA, fd)
+            curl.setopt(curl.FOLLOWLOCATION, True)
+            curl.setopt(curl.MAXREDIRS, 8)
+            curl.setopt(curl.FAILONERROR, True)
+            if offset:
+                curl.setopt(curl.RESUME_FROM_LARGE, offset)
+            curl.perform()
+        except pycurl.error as e:
+            raise Fail("Failed to fetch {}: {}".format(url, e.args[-1]))
+        finally:
+            curl.close()
+
+    def download(self, url, pathname, resume=False):
+        """
+        Download url to pathname, continuing a previous partial download if
+        resume is True
+        """
+        offset = os.path.getsize(pathname) if resume and os.path.exists(pathname) else 0
+        if offset:
+            self.log.info("%s: resuming download from byte %d", url, offset)
+            try:
+                with open(pathname, "ab") as fd:
+                    self.perform(url, fd, offset)
+                return
+            except Fail as e:
+                self.log.info("%s, downloading it again from the start", e)
+        with open(pathname, "wb") as fd:
+            self.perform(url, fd)
+
+    def fetch(self, url, dest, sums_url=None):
+        """
+        Download url to the file dest, verifying it against the SHA256SUMS
+        file at sums_url, and going through the cache if available
+        """
+        sha256 = self.expected_sha256(url, sums_url) if sums_url else None
+        if sha256 is None:
+            self.log.info("%s: downloading without verification", url)
+            self.download(url, dest)
+            return
+
+        if not self.path:
+            self.download(url, dest)
+            self.verify(url, dest, sha256)
+            return
+
+        cached = os.path.join(self.path, "by-sha256", sha256)
+        if os.path.exists(cached):
+            self.log.info("%s: reusing cached %s", url, cached)
+        else:
+            partial = os.path.join(self.path, "partial", sha256)
+            # Concurrent builds may be downloading the same file
+            with open(partial + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(cached):
+                    if not os.path.exists(partial) or file_digest(partial) != sha256:
+                        self.download(url, partial, resume=True)
+                    if file_digest(partial) != sha256:
+                        self.log.warning("%s: checksum mismatch, downloading it again from the start", url)
+                        self.download(url, partial)
+                    self.verify(url, partial, sha256)
+                    os.rename(partial, cached)
+        transfer_file(cached, dest)
+
+    def verify(self, url, pathname, sha256):
+        if file_digest(pathname) != sha256:
+            os.unlink(pathname)
+            raise Fail("{}: checksum mismatch".format(url))
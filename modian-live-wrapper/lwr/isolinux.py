@@ -15,10 +15,9 @@ stdmenu.cfg vesamenu.c32
 """
 
 import os
-import shutil
 import tempfile
 import re
-from lwr.utils import Fail
+from lwr.utils import Fail, transfer_file
 from lwr.apt_udeb import get_apt_handler
 from lwr.component import Component
 
@@ -26,6 +25,15 @@ from lwr.component import Component
 
 
 class Isolinux(Component):
+    # syslinux-common files put directly into cdroot/isolinux
+    syslinux_files = [
+        'ldlinux.c32', 'libcom32.c32', 'vesamenu.c32',
+        'libutil.c32', 'libmenu.c32', 'libgpl.c32', 'hdt.c32'
+    ]
+
+    # All the files put into cdroot/isolinux by fetch()
+    fetched_files = syslinux_files + ['memdisk', 'isolinux.bin']
+
     def __init__(self, work_dir=None):
         super().__init__()
         self.work_dir_path = work_dir
@@ -68,7 +76,7 @@ class Isolinux(Component):
 
         return ret
 
-    def install(self, cdroot, mirror, suite, architecture, bootconfig):
+    def fetch(self, cdroot, mirror, suite, architecture):
         """
         Download and unpack the correct syslinux-common
         and isolinux packages for isolinux support.
@@ -81,23 +89,18 @@ class Isolinux(Component):
             if not filename:
                 handler.clean_up_apt()
                 raise Fail('Unable to download syslinux-common')
-            # these files are put directly into cdroot/isolinux
-            syslinux_files = [
-                'ldlinux.c32', 'libcom32.c32', 'vesamenu.c32',
-                'libutil.c32', 'libmenu.c32', 'libgpl.c32', 'hdt.c32'
-            ]
             self.run_cmd(['dpkg', '-x', filename, destdir])
-            for syslinux_file in syslinux_files:
-                shutil.copyfile(
+            for syslinux_file in self.syslinux_files:
+                transfer_file(
                     os.path.join(destdir, "usr/lib/syslinux/modules/bios/%s" % syslinux_file),
                     "%s/%s" % (cdroot, syslinux_file))
-            shutil.copyfile(
+            transfer_file(
                 os.path.join(destdir, "usr/lib/syslinux/memdisk"),
                 "%s/memdisk" % (cdroot,))
             filename = handler.download_package('isolinux', destdir)
             if filename:
                 self.run_cmd(['dpkg', '-x', filename, destdir])
-                shutil.copyfile(
+                transfer_file(
                     os.path.join(destdir, "usr/lib/ISOLINUX/isolinux.bin"),
                     "%s/isolinux.bin" % cdroot)
             else:
@@ -105,20 +108,25 @@ class Isolinux(Component):
                 raise Fail('Unable to download isolinux')
             handler.clean_up_apt()
 
-            cfg = self.generate_cfg(bootconfig)
-            with open("%s/%s" % (cdroot, "menu.cfg"), "w") as cfgout:
-                cfgout.write(cfg)
+    def install(self, cdroot, bootconfig):
+        """
+        Write the isolinux menu for bootconfig into cdroot, and apply its
+        timeout to isolinux.cfg
+        """
+        cfg = self.generate_cfg(bootconfig)
+        with open("%s/%s" % (cdroot, "menu.cfg"), "w") as cfgout:
+            cfgout.write(cfg)
 
-            if bootconfig.timeout is not None:
-                isolinux_cfg = os.path.join(cdroot, "isolinux.cfg")
-                with open(isolinux_cfg, "rt") as fd:
-                    cfg = fd.read()
-                cfg1 = re.sub(r"timeout\s+\d+", "timeout {}".format(bootconfig.timeout * 10), cfg, flags=re.IGNORECASE)
-                if cfg1 == cfg:
-                    cfg1 = cfg + "\ntimeout {}\n".format(bootconfig.timeout * 10)
-                with open(isolinux_cfg, "wt") as fd:
-                    fd.write(cfg1)
+        if bootconfig.timeout is not None:
+            isolinux_cfg = os.path.join(cdroot, "isolinux.cfg")
+            with open(isolinux_cfg, "rt") as fd:
+                cfg = fd.read()
+            cfg1 = re.sub(r"timeout\s+\d+", "timeout {}".format(bootconfig.timeout * 10), cfg, flags=re.IGNORECASE)
+            if cfg1 == cfg:
+                cfg1 = cfg + "\ntimeout {}\n".format(bootconfig.timeout * 10)
+            with open(isolinux_cfg, "wt") as fd:
+                fd.write(cfg1)
 
-            # Fix the menu display size in stdmeny.cfg (#861421)
-            self.run_cmd(['sed', '-i', 's,menu rows 12,menu rows 8,g',
-                          os.path.join(cdroot, 'stdmenu.cfg')])
+        # Fix the menu display size in stdmeny.cfg (#861421)
+        self.run_cmd(['sed', '-i', 's,menu rows 12,menu rows 8,g',
+                      os.path.join(cdroot, 'stdmenu.cfg')])
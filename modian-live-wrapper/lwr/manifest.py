@@ -0,0 +1,82 @@
+"""
+Record of the build stages completed in a work directory, used by
+``--retry`` to skip the stages that do not need to run again.
+"""
+
+import json
+import os
+import threading
+from .digest import DigestMemo, json_digest, tree_digest
+
+
+class StageManifest:
+    """
+    Digests of the inputs and outputs of each completed stage.
+
+    A stage is done if it was recorded with the same inputs, and its outputs
+    still have the digests they had when it completed.
+    """
+    def __init__(self, pathname, memo=None):
+        self.pathname = pathname
+        self.memo = memo if memo is not None else DigestMemo()
+        self.stages = {}
+        self.lock = threading.Lock()
+        if os.path.exists(pathname):
+            try:
+                with open(pathname, "rt") as fd:
+                    self.stages = json.load(fd).get("stages", {})
+            except ValueError:
+                self.stages = {}
+
+    def output_digest(self, pathname):
+        """
+        Return the digest of a file or directory tree, or None if it does
+        not exist
+        """
+        if os.path.isdir(pathname):
+            return tree_digest(pathname, memo=self.memo)
+        if os.path.exists(pathname):
+            return self.memo.file_digest(pathname)
+        return None
+
+    def is_done(self, name, inputs):
+        """
+        Check if the stage was completed with the same inputs, and its
+        outputs are intact
+        """
+        with self.lock:
+            entry = self.stages.get(name)
+        if entry is None or entry["inputs"] != json_digest(inputs):
+            return False
+        for pathname, digest in entry["outputs"].items():
+            if digest is None or self.output_digest(pathname) != digest:
+                return False
+        return True
+
+    def record(self, name, inputs, outputs):
+        """
+        Record that the stage completed with the given inputs, producing the
+        given files or directories
+        """
+        entry = {
+            "inputs": json_digest(inputs),
+            "outputs": {os.path.abspath(pathname): self.output_digest(pathname) for pathname in outputs},
+        }
+        with self.lock:
+            self.stages[name] = entry
+            self.save()
+
+    def invalidate(self, name):
+        """
+        Forget that a stage was completed
+        """
+        with self.lock:
+            if self.stages.pop(name, None) is not None:
+                self.save()
+
+    def save(self):
+        tmp_pathname = self.pathname + ".tmp"
+        with open(tmp_pathname, "wt") as fd:
+            json.dump({"stages": self.stages}, fd, indent=1, sort_keys=True)
+        os.rename(tmp_pathname, self.pathname)
+        self.memo.save()
@@ -0,0 +1,251 @@
+"""
+Build several variants of an image from one invocation, like the same
+system for different distributions or architectures, or images of the
+same system with different boot options.
+
+Each variant of a matrix build is built by a separate modian-lwr process, with its own work
+directory, output image and log, since a build changes process-wide state
+like the environment and the apt configuration. The variants share the
+cache directory and the apt proxy, so packages and indices are only
+downloaded once.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import subprocess
+import sys
+import yaml
+from .component import Component
+from .trace import tracer
+from .utils import Fail
+
+# Options that are set by the matrix build for each variant
+MATRIX_DESTS = ("matrix", "matrix_jobs")
+
+# Options that ISO variants can change, since they do not affect the live
+# system
+ISO_VARIANT_OPTIONS = ("bootappend", "boot_timeout", "volume_id", "description", "customize_iso", "image_output")
+
+
+def find_action(parser, key):
+    """
+    Return the parser action for an option name like ``no-installer``, or
+    for an option destination like ``installer``
+    """
+    for action in parser._actions:
+        if "--" + key in action.option_strings:
+            return action
+    for action in parser._actions:
+        if action.option_strings and action.dest == key.replace("-", "_"):
+            return action
+    return None
+
+
+def command_line(parser, args):
+    """
+    Return the command line arguments that parse into args, omitting those
+    with their default value
+    """
+    argv = []
+    for action in parser._actions:
+        if not action.option_strings:
+            continue
+        value = getattr(args, action.dest, action.default)
+        if value is None or value == action.default:
+            continue
+        # Use --option=value, since values could start with a dash
+        option = next(o for o in action.option_strings if o.startswith("--"))
+        if action.nargs == 0:
+            if value == action.const:
+                argv.append(option)
+        elif isinstance(value, list):
+            argv += ["{}={}".format(option, item) for item in value]
+        else:
+            argv.append("{}={}".format(option, value))
+    return argv
+
+
+class Variant:
+    """
+    One image of a matrix build, with the options that differ from the
+    command line
+    """
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+
+    def __repr__(self):
+        return "Variant({})".format(self.name)
+
+
+def cross_variants(distributions, architectures):
+    """
+    Return a variant for each combination of distribution and architecture
+    """
+    return [
+        Variant("{}-{}".format(distribution, architecture),
+                {"distribution": [distribution], "architecture": [architecture]})
+        for distribution in distributions for architecture in architectures
+    ]
+
+
+def load_variants(pathname, parser, args, options=None):
+    """
+    Load variants from a YAML file, containing a list of mappings from long
+    option names to their values for each variant, like::
+
+        - distribution: bookworm
+          volume-id: MODIAN BOOKWORM
+        - distribution: trixie
+          architecture: arm64
+          no-installer: true
+
+    Each variant can also have a ``name``, which defaults to
+    ``<distribution>-<architecture>``.
+
+    If options is set, variants can only change the options with those
+    destinations, and need a name.
+    """
+    try:
+        with open(pathname, "rt") as fd:
+            data = yaml.safe_load(fd)
+    except (OSError, yaml.YAMLError) as e:
+        raise Fail("Cannot read matrix file {}: {}".format(pathname, e))
+    if isinstance(data, dict):
+        data = data.get("variants")
+    if not isinstance(data, list) or not all(isinstance(v, dict) for v in data):
+        raise Fail("{}: expected a list of variants, each with a mapping of options".format(pathname))
+
+    variants = []
+    for entry in data:
+        entry = dict(entry)
+        name = entry.pop("name", None)
+        values = {}
+        for key, value in entry.items():
+            action = find_action(parser, str(key))
+            if action is None or action.dest in MATRIX_DESTS or action.dest in ("help", "version"):
+                raise Fail("{}: unknown option {!r}".format(pathname, key))
+            if options is not None and action.dest not in options:
+                raise Fail("{}: option {!r} cannot be changed by a variant".format(pathname, key))
+            if action.nargs == 0:
+                value = action.const if value else action.default
+            elif isinstance(getattr(args, action.dest), list) and not isinstance(value, list):
+                value = [value]
+            values[action.dest] = value
+        if name is None:
+            if options is not None:
+                raise Fail("{}: all variants need a name".format(pathname))
+            name = "{}-{}".format(
+                values.get("distribution", args.distribution)[0],
+                values.get("architecture", args.architecture)[0])
+        variants.append(Variant(str(name), values))
+
+    names = [v.name for v in variants]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise Fail("{}: duplicate variant names: {}".format(pathname, ", ".join(duplicates)))
+    return variants
+
+
+def with_suffix(pathname, suffix):
+    """
+    Add a suffix to a file name, before its extension
+    """
+    base, ext = os.path.splitext(pathname)
+    return "{}-{}{}".format(base, suffix, ext)
+
+
+def variant_args(args, variant):
+    """
+    Return a copy of the parsed options args, changed for a variant, with
+    the variant name added to the name of the output image
+    """
+    res = argparse.Namespace(**vars(args))
+    res.image_output = with_suffix(args.image_output, variant.name)
+    for dest, value in variant.options.items():
+        setattr(res, dest, value)
+    return res
+
+
+class MatrixBuild(Component):
+    """
+    Run the builds of several variants, at most jobs at a time
+    """
+    def __init__(self, parser, args, variants, jobs=None):
+        super().__init__()
+        self.parser = parser
+        self.args = args
+        self.variants = variants
+        self.jobs = jobs or 1
+
+    def variant_args(self, variant, apt_proxy_url=None):
+        """
+        Return the parsed options for building a variant
+        """
+        args = argparse.Namespace(**vars(self.args))
+        for dest in MATRIX_DESTS:
+            setattr(args, dest, None)
+        if self.args.work_dir:
+            args.work_dir = os.path.join(self.args.work_dir, variant.name)
+        if self.args.trace_file:
+            args.trace_file = with_suffix(self.args.trace_file, variant.name)
+        if self.args.log not in ("stderr", "none"):
+            args.log = with_suffix(self.args.log, variant.name)
+        if apt_proxy_url:
+            # All variants use the proxy of the matrix build
+            args.apt_proxy = False
+            args.apt_proxy_url = apt_proxy_url
+            args.package_store = None
+            args.apt_proxy_record = None
+        return variant_args(args, variant)
+
+    def command(self, variant, apt_proxy_url=None):
+        """
+        Return the command line that builds a variant
+        """
+        return [sys.executable, os.path.abspath(sys.argv[0])] + command_line(
+                self.parser, self.variant_args(variant, apt_proxy_url))
+
+    def check(self):
+        """
+        Check that no variant would overwrite an existing image
+        """
+        for variant in self.variants:
+            output = self.variant_args(variant).image_output
+            if os.path.exists(output):
+                raise Fail("Image '{}' already exists".format(output))
+
+    def run_variant(self, variant, apt_proxy_url, parents):
+        """
+        Build a variant, prefixing its output with the variant name
+        """
+        cmd = self.command(variant, apt_proxy_url)
+        self.log.info("%s: started", variant.name)
+        with tracer.span(variant.name, parents=parents) as span:
+            with self.popen(cmd, eatmydata=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, errors="replace") as proc:
+                for line in proc.stdout:
+                    sys.stdout.write("{}: {}".format(variant.name, line))
+                    sys.stdout.flush()
+        if proc.returncode != 0:
+            raise Fail("{}: build failed with exit code {}".format(variant.name, proc.returncode))
+        self.log.info("%s: built %s in %.1fs", variant.name, self.variant_args(variant).image_output, span.wall)
+
+    def run(self, apt_proxy_url=None):
+        """
+        Build all variants, and raise Fail at the end if any of them failed
+        """
+        parents = tracer.current_spans()
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(self.jobs, thread_name_prefix="variant") as pool:
+            futures = {pool.submit(self.run_variant, variant, apt_proxy_url, parents): variant
+                       for variant in self.variants}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Fail as e:
+                    self.log.error("%s", e)
+                    failed.append(futures[future].name)
+        if failed:
+            raise Fail("Failed variants: {}".format(", ".join(sorted(failed))))
@@ -0,0 +1,121 @@
+"""
+Find the files an ansible playbook depends on, to compute cache keys from
+their contents.
+"""
+
+import os
+import yaml
+from .digest import DigestMemo, json_digest, tree_digest
+
+# Task keywords including a role by name
+ROLE_KEYWORDS = (
+    "include_role", "import_role",
+    "ansible.builtin.include_role", "ansible.builtin.import_role",
+)
+
+# Task and play keywords referring to other files, relative to the file
+# containing them
+FILE_KEYWORDS = (
+    "vars_files", "include_vars", "include_tasks", "import_tasks", "import_playbook",
+    "ansible.builtin.include_vars", "ansible.builtin.include_tasks",
+    "ansible.builtin.import_tasks", "ansible.builtin.import_playbook",
+)
+
+
+class PlaybookInputs:
+    """
+    Resolve the files and roles used by a playbook, and digest their contents
+    """
+    def __init__(self, playbook, roles_path, memo=None):
+        self.playbook = os.path.abspath(playbook)
+        # Ansible looks for roles next to the playbook first
+        self.roles_path = [os.path.join(os.path.dirname(self.playbook), "roles")]
+        self.roles_path += [os.path.abspath(path) for path in roles_path]
+        self.memo = memo if memo is not None else DigestMemo()
+        self.files = []
+        self.roles = {}
+
+    def resolve(self):
+        """
+        Fill self.files and self.roles with what the playbook refers to
+        """
+        self._add_file(self.playbook)
+        return self
+
+    def digest(self):
+        """
+        Return a digest of the contents of the playbook, and of the files and
+        roles it uses.
+
+        Roles and files are hashed in parallel, and file digests are looked
+        up in the memo first.
+        """
+        basedir = os.path.dirname(self.playbook)
+        info = {
+            "files": {os.path.relpath(path, basedir): self.memo.file_digest(path) for path in self.files},
+            "roles": {name: tree_digest(path, memo=self.memo) if path else None for name, path in self.roles.items()},
+        }
+        return json_digest(info)
+
+    def _add_file(self, pathname):
+        if pathname in self.files or not os.path.isfile(pathname):
+            return
+        self.files.append(pathname)
+        self._scan(self._load(pathname), os.path.dirname(pathname))
+
+    def _add_role(self, name):
+        if not isinstance(name, str) or name in self.roles or "{{" in name:
+            return
+        self.roles[name] = None
+        for path in self.roles_path:
+            role_dir = os.path.join(path, name)
+            if os.path.isdir(role_dir):
+                self.roles[name] = role_dir
+                break
+        else:
+            return
+
+        # Roles can pull in other roles, from their dependencies or their
+        # tasks
+        for dirpath, dirnames, filenames in os.walk(self.roles[name]):
+            for filename in filenames:
+                if filename.endswith((".yaml", ".yml")):
+                    self._scan(self._load(os.path.join(dirpath, filename)), None)
+
+    def _load(self, pathname):
+        try:
+            with open(pathname, "rt") as fd:
+                return yaml.safe_load(fd)
+        except (yaml.YAMLError, UnicodeDecodeError):
+            # Not something we can follow: its contents are still hashed
+            return None
+
+    def _scan(self, data, basedir):
+        """
+        Look for role and file references in parsed YAML data
+        """
+        if isinstance(data, list):
+            for item in data:
+                self._scan(item, basedir)
+            return
+        if not isinstance(data, dict):
+            return
+
+        for key, value in data.items():
+            if key in ("roles", "dependencies") and isinstance(value, list):
+                for role in value:
+                    if isinstance(role, dict):
+                        role = role.get("role", role.get("name"))
+                    self._add_role(role)
+            elif key in ROLE_KEYWORDS:
+                if isinstance(value, dict):
+                    self._add_role(value.get("name"))
+            elif key in FILE_KEYWORDS and basedir is not None:
+                names = value if isinstance(value, list) else [value]
+                for name in names:
+                    if isinstance(name, dict):
+                        name = name.get("file")
+                    if isinstance(name, str) and "{{" not in name:
+                        self._add_file(os.path.join(basedir, name))
+            else:
+                self._scan(value, basedir)
@@ -14,27 +14,38 @@ See live-wrapper(8) for more information.
 import sys
 import os
 import argparse
+import concurrent.futures
+import contextlib
+import functools
 import logging
-import pycurl
 import shutil
 import subprocess
 from tarfile import TarFile
 from lwr.isolinux import Isolinux
 from lwr.bootloader import BootloaderConfig
-from lwr.disk import install_disk_info, get_default_description
+from lwr.disk import UDEB_INCLUDE, install_disk_info, get_default_description
 from lwr.grub import install_grub
 from lwr.xorriso import Xorriso
-from lwr.apt_udeb import AptUdebDownloader, get_apt_handler
-from lwr.utils import cdrom_image_url, KERNEL, RAMDISK, Fail
-from lwr.cdroot import CDRoot
+from lwr.apt_udeb import AptState, AptUdebDownloader, get_apt_handler, release_apt_states
+from lwr.ansible import ANSIBLE_PROFILES
+from lwr.apt_proxy import AptProxy
+from lwr.udeb_closure import read_initrd
+from lwr.download import Downloader
+from lwr.utils import cdrom_image_url, check_url_async, installer_sums_url, KERNEL, RAMDISK, Fail
+from lwr.cdroot import CDRoot, clone_cdroot
 from lwr.base_system import BaseSystem
 from lwr.component import Component
+from lwr.stages import StageScheduler
+from lwr.manifest import StageManifest
+from lwr.digest import DigestMemo
+from lwr.trace import tracer
 from lwr.codenames import Codenames
+from lwr.matrix import ISO_VARIANT_OPTIONS, MatrixBuild, cross_variants, load_variants, variant_args
 
 __version__ = '0.8'
 
 
-def run_vmdebootstrap(args, dest):
+def run_vmdebootstrap(args, dest, apt_proxy=None, manifest=None):
     # TODO: "hostname": "debian",
     packages = []
     packages.extend(args.tasks.split())
@@ -56,8 +67,29 @@ def run_vmdebootstrap(args, dest):
         "ansible_extra_vars": args.ansible_extra_vars,
         "networkd": args.networkd,
         "cache_dir": args.cache_dir,
+        "cache_backend": args.cache_backend,
+        "cache_codec": args.cache_codec,
+        "cache_codec_level": args.cache_codec_level,
+        "cache_threads": args.cache_threads,
         "customize_squashfs": args.customize_squashfs,
+        # A --customize-iso script runs on the live directory of the build
+        # itself only without ISO variants
+        "squashfs_link": not (args.customize_iso and not args.iso_variants),
+        "force_ansible": args.force_ansible,
+        "ansible_profile": args.ansible_profile,
+        "ansible_resume": args.ansible_resume,
+        "apt_proxy": apt_proxy,
+        "manifest": manifest,
         "squashfs_compression": args.squashfs_comp,
+        "squashfs_block_size": args.squashfs_block_size,
+        "squashfs_compression_level": args.squashfs_comp_level,
+        "squashfs_processors": args.squashfs_processors,
+        "squashfs_mem": args.squashfs_mem,
+        "squashfs_max_decompress_time": args.squashfs_max_decompress_time,
+        "squashfs_tune_sample": args.squashfs_tune_sample * 1024 * 1024,
+        "squashfs_sort_trace": args.squashfs_sort_trace,
+        "squashfs_record_base": args.squashfs_record_base,
+        "squashfs_delta_base": args.squashfs_delta_base,
         "packages": packages,
         "kernel_package": kernel_package,
     }
@@ -77,18 +109,24 @@ class LiveWrapper(Component):
     ramdisk_path = None
     gtk_kernel_path = None
     gtk_ramdisk_path = None
+    apt_proxy_url = None  # URL of the local apt proxy, if running
+    isolinux = None  # Isolinux component, fetching and configuring isolinux
+    iso_variants = None  # ISO variants built from the same live system
 
     def __init__(self, version=__version__):
         super().__init__()
         self.version = version
 
     def add_settings(self, parser):
-        default_arch = subprocess.check_output(["dpkg", "--print-architecture"], universal_newlines=True).strip()
+        self.default_architecture = subprocess.check_output(
+                ["dpkg", "--print-architecture"], universal_newlines=True).strip()
         distro = parser.add_argument_group(title="Distribution Settings")
-        distro.add_argument("--distribution", "-d", action="store", metavar="NAME", default="trixie",
-                            help='Debian release to use')
-        distro.add_argument("--architecture", action="store", metavar="ARCH", default=default_arch,
-                            help='architecture to use')
+        distro.add_argument("--distribution", "-d", action="append", metavar="NAME", default=None,
+                            help='Debian release to use (default: trixie). If given more than once, an image is built'
+                                 ' for each release')
+        distro.add_argument("--architecture", action="append", metavar="ARCH", default=None,
+                            help='architecture to use (default: {}). If given more than once, an image is built for'
+                                 ' each architecture'.format(self.default_architecture))
         distro.add_argument("--apt-mirror", action="store", metavar="mirror_url", default="http://deb.debian.org/debian/",
                             help='Mirror to configure in the built image')
         distro.add_argument("--apt-mirror-components", action="store", metavar="main [contrib [..]]", default="main",
@@ -102,6 +140,17 @@ class LiveWrapper(Component):
             default="extra_vars.yaml",
             help='Extra variables passed to the ansible playbook',
         )
+        distro.add_argument("--force-ansible", action="store_true",
+                            help="Run ansible on a cached chroot even if it was customized with the same playbook, roles and"
+                                 " variables")
+        distro.add_argument("--ansible-profile", action="store", choices=ANSIBLE_PROFILES, default="safe",
+                            help="ansible settings: 'safe' (the default) uses the ansible defaults, 'fast' enables"
+                                 " pipelining and caches facts across builds of the same chroot, 'mitogen' also uses"
+                                 " the mitogen strategy, keeping a python interpreter running in the chroot")
+        distro.add_argument("--ansible-resume", action="store_true",
+                            help="If ansible failed in the previous build in the same --work-dir, run it again on the"
+                                 " same chroot starting from the failed task, instead of rebuilding the chroot."
+                                 " Implies --retry")
         distro.add_argument("--networkd", action="store_true",
                             help='Enable systemd-networkd and systemd-resolved')
         distro.add_argument("--tasks", "-t", action="store", metavar='"task-TASK1 task-TASK2 ..."', default="",
@@ -123,10 +172,45 @@ class LiveWrapper(Component):
                           help='Mirror to use for image creation')
         base.add_argument("--cache-dir", action="store", metavar="path", default=None,
                           help='If set, cache intermediate data in this directory')
+        base.add_argument("--cache-backend", action="store", choices=("tar", "layer"), default="tar",
+                          help="How to store cached stages: 'tar' uses compressed tarballs, 'layer' uses directory trees"
+                               " that are cloned with reflinks if the filesystem supports them")
+        base.add_argument("--cache-codec", action="store", choices=("gzip", "zstd", "none"), default="gzip",
+                          help="Compression used for tar cache archives")
+        base.add_argument("--cache-codec-level", action="store", type=int, metavar="N", default=None,
+                          help="Compression level for tar cache archives (default: codec default)")
+        base.add_argument("--cache-threads", action="store", type=int, metavar="N", default=None,
+                          help="Number of threads used to compress tar cache archives (default: one per CPU)")
         base.add_argument("--work-dir", action="store", metavar="path", default=None,
                           help="If set, work in this directory instead of a temporary directory")
+        base.add_argument("--apt-proxy", action="store_true",
+                          help="Run a local caching proxy for the duration of the build, and use it for all package"
+                               " downloads from http:// mirrors")
+        base.add_argument("--package-store", action="store", metavar="path", default=None,
+                          help="Directory where the apt proxy stores downloaded packages, which can be shared by"
+                               " concurrent builds (default: packages/ in the cache directory)")
+        base.add_argument("--apt-proxy-record", action="store", metavar="path", default=None,
+                          help="Also save all files downloaded through the apt proxy in this directory, as"
+                               " <host>/<path>, to be served later as an offline mirror")
+        base.add_argument("--apt-proxy-url", action="store", metavar="url", default=None,
+                          help="Use an apt proxy that is already running, instead of starting one")
+        base.add_argument("--download-jobs", action="store", type=int, metavar="N", default=8,
+                          help="Maximum number of parallel package downloads")
+        base.add_argument("--download-cache-ttl", action="store", type=int, metavar="seconds", default=86400,
+                          help="How long the installer SHA256SUMS files in the cache directory are trusted before"
+                               " checking the mirror again (default: %(default)s)")
+        base.add_argument("--jobs", "-j", action="store", type=int, metavar="N", default=4,
+                          help="Maximum number of build stages to run at the same time (default: %(default)s)")
+        base.add_argument("--trace-file", action="store", metavar="file.json", default=None,
+                          help="Save the time and resources used by each build stage and command to this file,"
+                               " in Chrome trace event format")
         base.add_argument("--retry", action="store_true",
-                          help="Keep the existing work dir, and skip steps for which output already exists")
+                          help="Keep the existing work dir, and skip the steps that already completed with the same"
+                               " inputs and whose output is intact")
+        base.add_argument("--matrix", action="store", metavar="variants.yaml", default=None,
+                          help="Build an image for each variant listed in this file, each with its own options")
+        base.add_argument("--matrix-jobs", action="store", type=int, metavar="N", default=2,
+                          help="Maximum number of images built at the same time, when building more than one")
 
         iso = parser.add_argument_group(title="ISO Settings")
         iso.add_argument("--volume-id", action="store", metavar="VOLID", default="DEBIAN LIVE",
@@ -152,32 +236,56 @@ class LiveWrapper(Component):
                          help='Use the daily Debian Installer builds not releases')
         iso.add_argument("--base-debs", action="store", metavar='"PKG1 PKG2 ..."', default="",
                          help='Base packages for the installer')
-        iso.add_argument("--squashfs-comp", action="store", metavar="gzip|lzo|gz", default="lzo",
-                         help="Squashfs compression algorithm")
+        iso.add_argument("--minimal-udebs", action="store_true",
+                         help="Only put on the image the udebs that the installer loads by default and their"
+                              " dependencies, instead of the whole debian-installer component")
+        iso.add_argument("--udeb-include", action="store", metavar='"PKG1 PKG2 ..."', default="",
+                         help="Additional udebs for the installer to load from the image")
+        iso.add_argument("--squashfs-comp", action="store", metavar="gzip|lzo|lz4|xz|zstd|auto", default="lzo",
+                         help="Squashfs compression algorithm. 'auto' tries them on a sample of the chroot, and uses the"
+                              " one giving the smallest image, within --squashfs-max-decompress-time if set")
+        iso.add_argument("--squashfs-comp-level", action="store", type=int, metavar="N", default=None,
+                         help="Squashfs compression level, for gzip, lzo and zstd; for lz4, any level enables high"
+                              " compression (default: compressor default)")
+        iso.add_argument("--squashfs-block-size", action="store", metavar="SIZE", default=None,
+                         help="Squashfs block size, like 128K or 1M (default: mksquashfs default)")
+        iso.add_argument("--squashfs-processors", action="store", type=int, metavar="N", default=None,
+                         help="Number of CPUs used by mksquashfs (default: all)")
+        iso.add_argument("--squashfs-mem", action="store", metavar="SIZE", default=None,
+                         help="Memory used by mksquashfs for caches, like 2G (default: mksquashfs default)")
+        iso.add_argument("--squashfs-max-decompress-time", action="store", type=float, metavar="seconds", default=None,
+                         help="With --squashfs-comp=auto, use the smallest image whose estimated single-threaded"
+                              " decompression time is within this limit")
+        iso.add_argument("--squashfs-tune-sample", action="store", type=int, metavar="MiB", default=128,
+                         help="With --squashfs-comp=auto, amount of the chroot contents used to try compressions")
+        iso.add_argument("--squashfs-sort-trace", action="store", metavar="trace.txt", default=None,
+                         help="List of the files accessed while booting, one absolute path at the end of each line"
+                              " (like the output of fatrace): they are stored first in the squashfs, in the same"
+                              " order, to reduce seeking on slow boot media")
+        iso.add_argument("--squashfs-record-base", action="store", metavar="dir", default=None,
+                         help="Record the squashfs image and a description of the live system in this directory,"
+                              " to use as a base for later --squashfs-delta-base builds")
+        iso.add_argument("--squashfs-delta-base", action="store", metavar="dir", default=None,
+                         help="Only compress the changes to the live system since the base recorded in this"
+                              " directory, in a squashfs layer that live-boot stacks on top of the base image")
         iso.add_argument("--customize-iso", action="store", metavar="script.sh", default=None,
                          help="If set, run this script with the path to the iso contents as argument before running xorriso")
-
-    def download_file(self, url, filehandle):
-        try:
-            curl = pycurl.Curl()
-            curl.setopt(curl.URL, url)
-            curl.setopt(curl.WRITEDATA, filehandle)
-            curl.setopt(curl.FOLLOWLOCATION, True)
-            curl.setopt(curl.MAXREDIRS, 8)
-            curl.perform()
-            curl.close()
-        except pycurl.error:
-            self.log.critical("Failed to fetch %s. Cannot continue!", url)
-            sys.exit(1)
+        iso.add_argument("--iso-variants", action="store", metavar="variants.yaml", default=None,
+                         help="Build an image for each variant listed in this file, which can change the ISO"
+                              " settings: all images share the same live system")
 
     def fetch_di_helpers(self, mirror, suite, architecture):
         bootdir = self.cdroot['boot'].path
-        with self.work_file("di-helpers.tar.gz", self.args.work_dir, reuse=True) as ditar:
-            if os.fstat(ditar.fileno()).st_size == 0:
+        inputs = {"mirror": mirror, "distribution": suite, "architecture": architecture, "daily": self.args.di_daily}
+        reuse = self.manifest is not None and self.manifest.is_done("di-helpers", inputs)
+        with self.work_file("di-helpers.tar.gz", self.args.work_dir, reuse=reuse) as ditar:
+            if not reuse:
                 self.log.info("Downloading helper files from debian-installer team...")
-                urls = cdrom_image_url(mirror, suite, architecture, gtk=False, daily=self.args.di_daily)
-                self.download_file(urls[3], ditar)
-                ditar.flush()
+                urls = cdrom_image_url(mirror, suite, architecture, gtk=False, daily=self.args.di_daily,
+                                       check=not self.downloads.path)
+                self.downloads.fetch(urls[3], ditar.name, installer_sums_url(urls[0]))
+                if self.manifest is not None:
+                    self.manifest.record("di-helpers", inputs, [ditar.name])
             else:
                 self.log.info("Reusing existing helper tarball")
             info = TarFile.open(ditar.name, 'r:gz')
@@ -196,29 +304,39 @@ class LiveWrapper(Component):
     def fetch_di_installer(self, mirror, suite, architecture):
         self.log.info("Downloading installer files from debian-installer team...")
         if self.args.installer:
-            self.log.debug("Created d-i kernel and ramdisk directory at %s", self.cdroot['d-i'].path)
-            self.log.debug("Created d-i GTK kernel and ramdisk directory at %s", self.cdroot['d-i']['gtk'].path)
-            self.kernel_path = os.path.join(self.cdroot['d-i'].path, KERNEL)
-            self.ramdisk_path = os.path.join(self.cdroot['d-i'].path, RAMDISK)
-
-        if self.args.installer:
-            # fetch debian-installer
-            urls = cdrom_image_url(mirror, suite, architecture, gtk=False, daily=self.args.di_daily)
-            with open(self.kernel_path, 'w') as kernel:
-                self.download_file(urls[1], kernel)
-            with open(self.ramdisk_path, 'w') as ramdisk:
-                self.download_file(urls[2], ramdisk)
-
-            # Now get the graphical installer.
-            urls = cdrom_image_url(mirror, suite, architecture, gtk=True, daily=self.args.di_daily)
-            self.gtk_kernel_path = os.path.join(self.cdroot['d-i']['gtk'].path, KERNEL)
-            self.gtk_ramdisk_path = os.path.join(self.cdroot['d-i']['gtk'].path, RAMDISK)
-            with open(self.gtk_kernel_path, 'w') as kernel:
-                self.download_file(urls[1], kernel)
-            with open(self.gtk_ramdisk_path, 'w') as ramdisk:
-                self.download_file(urls[2], ramdisk)
-
-    def start_ops(self):  # pylint: disable=too-many-statements
+            # fetch debian-installer and the graphical installer. Files
+            # verified against SHA256SUMS do not need the URLs to be checked
+            # beforehand
+            check = not self.downloads.path
+            urls = cdrom_image_url(mirror, suite, architecture, gtk=False, daily=self.args.di_daily, check=check)
+            gtk_urls = cdrom_image_url(mirror, suite, architecture, gtk=True, daily=self.args.di_daily, check=check)
+            sums_url = installer_sums_url(urls[0])
+            downloads = [
+                (urls[1], self.kernel_path),
+                (urls[2], self.ramdisk_path),
+                (gtk_urls[1], self.gtk_kernel_path),
+                (gtk_urls[2], self.gtk_ramdisk_path),
+            ]
+            with concurrent.futures.ThreadPoolExecutor(len(downloads)) as pool:
+                futures = [pool.submit(self.downloads.fetch, url, dest, sums_url) for url, dest in downloads]
+                for future in futures:
+                    future.result()
+
+    def probe_di_urls(self):
+        """
+        Start checking the debian-installer URLs in the background, so that
+        the results are ready by the time they are needed
+        """
+        if self.downloads.path:
+            # Cached downloads are verified instead
+            return
+        for gtk in (False, True) if self.args.installer else (False,):
+            urls = cdrom_image_url(self.args.mirror, self.args.distribution, self.args.architecture,
+                                   gtk=gtk, daily=self.args.di_daily, check=False)
+            for url in urls[:3]:
+                check_url_async(url)
+
+    def start_ops(self):
         """
         This function creates the live image using the settings determined by
         the arguments passed on the command line.
@@ -238,6 +356,34 @@ class LiveWrapper(Component):
         # all other directories are based off cdroot
         self.log.debug("Created temporary work directory (cdroot) at %s.", self.cdroot.path)
 
+        # Set up here what later stages need, since on --retry the stages
+        # that would set it up can be skipped
+        if self.args.installer:
+            self.log.debug("Created d-i kernel and ramdisk directory at %s", self.cdroot['d-i'].path)
+            self.log.debug("Created d-i GTK kernel and ramdisk directory at %s", self.cdroot['d-i']['gtk'].path)
+            self.kernel_path = os.path.join(self.cdroot['d-i'].path, KERNEL)
+            self.ramdisk_path = os.path.join(self.cdroot['d-i'].path, RAMDISK)
+            self.gtk_kernel_path = os.path.join(self.cdroot['d-i']['gtk'].path, KERNEL)
+            self.gtk_ramdisk_path = os.path.join(self.cdroot['d-i']['gtk'].path, RAMDISK)
+        self.isolinux = Isolinux(os.path.join(self.args.work_dir, "isolinux") if self.args.work_dir else None)
+
+        # Digests of the inputs and outputs of the stages already done, to
+        # skip them on --retry
+        self.manifest = None
+        if self.args.work_dir:
+            self.manifest = StageManifest(
+                    os.path.join(self.args.work_dir, "manifest.json"),
+                    memo=DigestMemo(os.path.join(self.args.work_dir, "digest-memo.json")))
+
+        # Downloads from the debian-installer team
+        self.downloads = Downloader(
+                os.path.join(self.args.cache_dir, "downloads") if self.args.cache_dir else None,
+                sums_ttl=self.args.download_cache_ttl)
+
+        # Keep apt lists across builds
+        if self.args.cache_dir:
+            AptState.state_root = os.path.join(self.args.cache_dir, "apt")
+
         # Make options available to customise hooks
         os.environ['LWR_MIRROR'] = self.args.mirror
         os.environ['LWR_DISTRIBUTION'] = self.args.distribution
@@ -250,154 +396,327 @@ class LiveWrapper(Component):
             if envvar.startswith('LWR_'):
                 self.log.debug("environment: %s = '%s'", envvar, os.environ[envvar])
 
-        # Run vmdebootstrap, putting files in /live/
+        # Check the mirror while vmdebootstrap runs
+        self.probe_di_urls()
+
+        # Downloads do not depend on the live system, and run while it is
+        # being built; only the bootloader configuration and the image need
+        # everything to be in place
+        stages = StageScheduler(jobs=self.args.jobs, manifest=self.manifest)
+        # The live stage checks the manifest for the chroot and the squashfs
+        # by itself
+        stages.add("live", self.build_live)
+        stages.add("di-helpers", self.stage_di_helpers)
+        sources = {
+            "mirror": self.args.mirror,
+            "distribution": self.args.distribution,
+            "architecture": self.args.architecture,
+        }
+        if self.args.installer:
+            stages.add("di-installer", self.stage_di_installer,
+                       inputs=dict(sources, daily=self.args.di_daily),
+                       outputs=[os.path.join(self.cdroot['d-i'].path, name) for name in (KERNEL, RAMDISK)]
+                       + [os.path.join(self.cdroot['d-i']['gtk'].path, name) for name in (KERNEL, RAMDISK)])
+            stages.add("udebs", self.fetch_udebs,
+                       inputs=dict(sources, base_debs=self.args.base_debs, base_debs_list=self.base_debs_list(),
+                                   minimal_udebs=self.args.minimal_udebs, udeb_include=self.args.udeb_include.split()),
+                       # The minimal udebs depend on the contents of the initrd
+                       deps=["di-installer"] if self.args.minimal_udebs else (),
+                       outputs=[os.path.join(self.cdroot.path, name) for name in ("pool", "dists")])
+        if len(self.args.firmware) > 0:
+            stages.add("firmware", self.fetch_firmware,
+                       inputs=dict(sources, firmware=self.args.firmware.split()),
+                       outputs=[os.path.join(self.cdroot.path, "firmware")])
+        if self.args.isolinux:
+            stages.add("isolinux", self.fetch_isolinux,
+                       inputs=sources,
+                       outputs=[os.path.join(self.cdroot['isolinux'].path, name) for name in Isolinux.fetched_files])
+        if self.iso_variants:
+            # Each variant gets its own boot configuration and image, out of
+            # the same squashfs and downloads
+            deps = list(stages.stages)
+            for variant in self.iso_variants:
+                stages.add("iso-" + variant.name, functools.partial(self.build_iso_variant, variant), deps=deps)
+        else:
+            stages.add("bootloaders", self.install_bootloaders, deps=["live", "di-helpers", "di-installer", "isolinux"])
+            stages.add("iso", self.build_iso, deps=list(stages.stages))
+        stages.run()
+
+        print("If using qemu-system to test the image, use the -cdrom option.")
+
+    def build_live(self):
+        """
+        Run vmdebootstrap, putting files in /live/
+        """
         if os.environ.get("LWR_DEBUG") and "skipvm" in os.environ.get('LWR_DEBUG'):
             self.log.warning("The debug option to skip running vmdebootstrap was enabled.")
             self.log.info("Creating a dummy live/ directory at %s, but not installing a live system.", self.cdroot['live'].path)
         else:
             self.log.info("Running vmdebootstrap...")
-            run_vmdebootstrap(self.args, self.cdroot["live"].path)
+            run_vmdebootstrap(self.args, self.cdroot["live"].path, apt_proxy=self.apt_proxy_url, manifest=self.manifest)
 
-        # Initialise menu
-        # Fetch D-I helper archive
+    def stage_di_helpers(self):
+        """
+        Fetch D-I helper archive
+        """
         self.fetch_di_helpers(
             self.args.mirror,
             self.args.distribution,
             self.args.architecture)
 
-        # Fetch D-I installers if needed???
-        if self.args.installer:
-            print("Fetching Debian Installer")
-            self.fetch_di_installer(
-                self.args.mirror,
-                self.args.distribution,
-                self.args.architecture)
-
-        # Download the udebs
-        if self.args.installer:
-            print("Downloading udebs for Debian Installer...")  # FIXME: self.message()
-            self.log.info("Downloading udebs for Debian Installer...")
-            # FIXME: get exclude_list from user
-            exclude_list = []
-            # FIXME: may need a change to the download location
-            di_root = self.cdroot['d-i'].path
-            apt_udeb = AptUdebDownloader(destdir=di_root)
-            apt_udeb.mirror = self.args.mirror
-            apt_udeb.architecture = self.args.architecture
-            apt_udeb.codename = self.args.distribution
-            self.log.debug("Updating local cache for %s %s...", apt_udeb.architecture, apt_udeb.codename)
-            apt_udeb.prepare_apt()
-            # FIXME: add support for a custom apt source on top.
+    def stage_di_installer(self):
+        """
+        Fetch D-I installers
+        """
+        print("Fetching Debian Installer")
+        self.fetch_di_installer(
+            self.args.mirror,
+            self.args.distribution,
+            self.args.architecture)
 
+    def fetch_udebs(self):
+        """
+        Download the udebs and base debs for Debian Installer, and generate
+        their metadata
+        """
+        print("Downloading udebs for Debian Installer...")  # FIXME: self.message()
+        self.log.info("Downloading udebs for Debian Installer...")
+        # FIXME: get exclude_list from user
+        exclude_list = []
+        # FIXME: may need a change to the download location
+        di_root = self.cdroot['d-i'].path
+        apt_udeb = AptUdebDownloader(destdir=di_root)
+        apt_udeb.mirror = self.args.mirror
+        apt_udeb.architecture = self.args.architecture
+        apt_udeb.codename = self.args.distribution
+        apt_udeb.download_jobs = self.args.download_jobs
+        if self.args.cache_dir:
+            apt_udeb.index_cache = os.path.join(
+                self.args.cache_dir, "apt", "index-{}-{}.json".format(apt_udeb.codename, apt_udeb.architecture))
+        self.log.debug("Updating local cache for %s %s...", apt_udeb.architecture, apt_udeb.codename)
+        apt_udeb.prepare_apt()
+        # FIXME: add support for a custom apt source on top.
+
+        if self.args.minimal_udebs:
+            ramdisk = os.path.join(self.cdroot['d-i'].path, RAMDISK)
+            installed, kernel_version = read_initrd(ramdisk)
+            if kernel_version is None:
+                self.log.warning("%s: cannot find the installer kernel version: including udebs for all kernels",
+                                 ramdisk)
+            names = apt_udeb.minimal_udebs(UDEB_INCLUDE + tuple(self.args.udeb_include.split()),
+                                           installed, kernel_version)
+            apt_udeb.download_udebs(exclude_list, names)
+        else:
             # download all udebs in the suite, except exclude_list
             apt_udeb.download_udebs(exclude_list)
 
-            # Now we've downloaded all the d-i bits we need, clean up the metadata we used
-            apt_udeb.clean_up_apt()
-            print("... completed udeb downloads")
-            self.log.info("... completed udeb downloads")
-
-            # download the basic debs needed - bootloaders and tools they depend on
-            if os.path.exists('base_debs.list'):
-                pkg_list = []
-                with open('base_debs.list', 'r') as f:
-                    for line in f.readlines():
-                        pkg_list.append(line.rstrip())
-                di_root = self.cdroot['d-i'].path
-                handler = get_apt_handler(di_root,
-                                          self.args.mirror,
-                                          self.args.distribution,
-                                          self.args.architecture)
-                handler.download_base_debs(pkg_list)
-                handler.clean_up_apt()
-                apt_udeb.download_base_debs(exclude_list)
-
-                print("... completed deb downloads")
-                self.log.info("... completed deb downloads")
-
-            # Generate Packages and Release files for the udebs and downloaded debs
-            apt_udeb.generate_packages_file('udeb')
-            if len(self.args.base_debs) > 1:
-                apt_udeb.generate_packages_file('deb')
-                apt_udeb.merge_pools(['deb', 'udeb'])
-            else:
-                apt_udeb.merge_pools(['udeb'])
-            apt_udeb.generate_release_file()
-
-            print("... completed generating metadata files")
-            self.log.info("... completed generating metadata files")
+        # Now we've downloaded all the d-i bits we need, clean up the metadata we used
+        apt_udeb.clean_up_apt()
+        print("... completed udeb downloads")
+        self.log.info("... completed udeb downloads")
 
-        # Download the firmware debs if desired
-        if len(self.args.firmware) > 0:
-            self.log.info("Downloading firmware debs...")
-
-            # FIXME: may need a change to the download location
-            fw_root = self.cdroot['firmware'].path
-            handler = get_apt_handler(fw_root,
+        # download the basic debs needed - bootloaders and tools they depend on
+        pkg_list = self.base_debs_list()
+        if pkg_list is not None:
+            di_root = self.cdroot['d-i'].path
+            handler = get_apt_handler(di_root,
                                       self.args.mirror,
                                       self.args.distribution,
-                                      self.args.architecture)
-            for pkg in self.args.firmware.split(' '):
-                handler.download_package(pkg, fw_root)
+                                      self.args.architecture,
+                                      download_jobs=self.args.download_jobs)
+            handler.download_base_debs(pkg_list)
             handler.clean_up_apt()
-            self.log.info("... firmware deb downloads")
+            apt_udeb.checksums.update(handler.checksums)
+            apt_udeb.download_base_debs(exclude_list)
+
+            print("... completed deb downloads")
+            self.log.info("... completed deb downloads")
+
+        # Generate Packages and Release files for the udebs and downloaded debs
+        apt_udeb.generate_packages_file('udeb')
+        if len(self.args.base_debs) > 1:
+            apt_udeb.generate_packages_file('deb')
+            apt_udeb.merge_pools(['deb', 'udeb'])
+        else:
+            apt_udeb.merge_pools(['udeb'])
+        apt_udeb.generate_release_file()
+
+        print("... completed generating metadata files")
+        self.log.info("... completed generating metadata files")
+
+    def base_debs_list(self):
+        """
+        Return the list of base debs to add to the installer pool, or None
+        """
+        if not os.path.exists('base_debs.list'):
+            return None
+        pkg_list = []
+        with open('base_debs.list', 'r') as f:
+            for line in f.readlines():
+                pkg_list.append(line.rstrip())
+        return pkg_list
+
+    def fetch_firmware(self):
+        """
+        Download the firmware debs
+        """
+        self.log.info("Downloading firmware debs...")
+
+        # FIXME: may need a change to the download location
+        fw_root = self.cdroot['firmware'].path
+        handler = get_apt_handler(fw_root,
+                                  self.args.mirror,
+                                  self.args.distribution,
+                                  self.args.architecture,
+                                  download_jobs=self.args.download_jobs)
+        handler.download_packages(self.args.firmware.split(), fw_root)
+        handler.clean_up_apt()
+        self.log.info("... firmware deb downloads")
+
+    def fetch_isolinux(self):
+        """
+        Download the isolinux files
+        """
+        self.log.info("Performing isolinux installation...")
+        # FIXME: catch errors and cleanup.
+        self.isolinux.fetch(
+            self.cdroot['isolinux'].path,
+            self.args.mirror,
+            self.args.distribution,
+            self.args.architecture)
+
+    def install_bootloaders(self, cdroot=None, args=None):
+        """
+        Generate the boot configuration, and install it for the selected
+        bootloaders.
 
-        # Generate boot config
-        boot_timeout = self.args.boot_timeout
+        cdroot and args default to those of the build, and are set when
+        building ISO variants.
+        """
+        cdroot = cdroot or self.cdroot
+        args = args or self.args
+        boot_timeout = args.boot_timeout
         if boot_timeout is not None:
             boot_timeout = int(boot_timeout)
-        bootconfig = BootloaderConfig(self.cdroot.path, bootappend=self.args.bootappend, timeout=boot_timeout)
+        bootconfig = BootloaderConfig(cdroot.path, bootappend=args.bootappend, timeout=boot_timeout)
 
         if os.environ.get("LWR_DEBUG") is None or 'skipvm' not in os.environ['LWR_DEBUG']:
             bootconfig.add_live()
-            locallivecfg = BootloaderConfig(self.cdroot.path, bootappend=self.args.bootappend, timeout=boot_timeout)
+            locallivecfg = BootloaderConfig(cdroot.path, bootappend=args.bootappend, timeout=boot_timeout)
             locallivecfg.add_live_localisation()
             bootconfig.add_submenu('Debian Live with Localisation Support', locallivecfg)
-        if self.args.installer:
+        if args.installer:
             bootconfig.add_installer(self.kernel_path, self.ramdisk_path)
 
         # Install isolinux if selected
-        if self.args.isolinux:
-            self.log.info("Performing isolinux installation...")
-            # FIXME: catch errors and cleanup.
-            isolinux = Isolinux(os.path.join(self.args.work_dir, "isolinux"))
-            isolinux.install(
-                self.cdroot['isolinux'].path,
-                self.args.mirror,
-                self.args.distribution,
-                self.args.architecture,
-                bootconfig)
+        if args.isolinux:
+            self.isolinux.install(cdroot['isolinux'].path, bootconfig)
 
         # Install GRUB if selected
-        if self.args.grub or self.args.grub_loopback_only:
+        if args.grub or args.grub_loopback_only:
             self.log.info("Performing GRUB installation...")
-            install_grub(self.cdroot.path, bootconfig)  # FIXME: pass architecture & uefi settings.
+            install_grub(cdroot.path, bootconfig)  # FIXME: pass architecture & uefi settings.
+
+    def build_iso(self, cdroot=None, args=None, run_script="xorriso.sh"):
+        """
+        Build the ISO image out of the cdroot contents.
 
-        if self.args.customize_iso:
-            self.run_cmd([self.args.customize_iso, self.cdroot.path])
+        cdroot and args default to those of the build, and are set when
+        building ISO variants.
+        """
+        cdroot = cdroot or self.cdroot
+        args = args or self.args
+        if args.customize_iso:
+            self.run_cmd([args.customize_iso, cdroot.path])
 
         # Start the setup for building the ISO image
-        xorriso = Xorriso(self.args.image_output,
-                          self.args.volume_id,
-                          isolinux=self.args.isolinux,
-                          grub=self.args.grub)
-        xorriso_args = xorriso.build_args(self.cdroot.path)
-        if self.args.work_dir:
-            xorriso.write_run_script(os.path.join(self.args.work_dir, "xorriso.sh"))
+        xorriso = Xorriso(args.image_output,
+                          args.volume_id,
+                          isolinux=args.isolinux,
+                          grub=args.grub)
+        xorriso_args = xorriso.build_args(cdroot.path)
+        if args.work_dir:
+            xorriso.write_run_script(os.path.join(args.work_dir, run_script))
 
         # Install .disk information, including the args we just grabbed
         self.log.info("Installing the disk metadata ...")
-        install_disk_info(self.cdroot, self.args.description, ' '.join(xorriso_args))
+        install_disk_info(cdroot, args.description, ' '.join(xorriso_args), udeb_include=args.udeb_include.split())
 
         # Create ISO image
         self.log.info("Creating the ISO image with Xorriso...")
         xorriso.build_image()
 
-        # Remove the temporary directories
-        self.log.info("Removing temporary work directories...")
-        if self.args.installer:
-            apt_udeb.clean_up_apt()
-        print("If using qemu-system to test the image, use the -cdrom option.")
+    def build_iso_variant(self, variant):
+        """
+        Build the image of an ISO variant, from a copy of the cdroot that
+        shares the large, read-only directories with it, unless a
+        --customize-iso script could change them
+        """
+        args = variant_args(self.args, variant)
+        if self.args.work_dir:
+            cdroot = CDRoot(path=os.path.join(self.args.work_dir, "iso-" + variant.name))
+        else:
+            cdroot = CDRoot()
+        clone_cdroot(self.cdroot.path, cdroot.path, share=not args.customize_iso)
+        self.install_bootloaders(cdroot, args)
+        self.build_iso(cdroot, args, run_script="xorriso-{}.sh".format(variant.name))
+
+    def report_trace(self):
+        """
+        Print the resources used by each stage, and save the trace if
+        requested
+        """
+        summary = tracer.summary()
+        if summary:
+            print("Time and resources used by the build stages:")
+            for line in summary:
+                print("  " + line)
+        if self.args.trace_file:
+            tracer.write(self.args.trace_file)
+            self.log.info("Build trace written to %s", self.args.trace_file)
+
+    @contextlib.contextmanager
+    def apt_proxy(self):
+        """
+        Run the local apt proxy for the duration of the build, if requested.
+
+        The proxy is exported as ``http_proxy`` in the environment, which is
+        honored by debootstrap, apt, python-apt, curl and requests.
+        """
+        if self.args.apt_proxy_url:
+            with self.use_apt_proxy(self.args.apt_proxy_url):
+                yield None
+            return
+        if not self.args.apt_proxy:
+            yield None
+            return
+
+        store = self.args.package_store
+        if not store and self.args.cache_dir:
+            store = os.path.join(self.args.cache_dir, "packages")
+        if not store:
+            raise Fail("--apt-proxy needs --package-store or --cache-dir")
+
+        proxy = AptProxy(store, record_dir=self.args.apt_proxy_record)
+        with proxy.serve(), self.use_apt_proxy(proxy.url):
+            yield proxy
+
+    @contextlib.contextmanager
+    def use_apt_proxy(self, url):
+        """
+        Use the apt proxy at url for the duration of the context
+        """
+        old_http_proxy = os.environ.get("http_proxy")
+        self.apt_proxy_url = url
+        os.environ["http_proxy"] = url
+        try:
+            yield
+        finally:
+            self.apt_proxy_url = None
+            if old_http_proxy is None:
+                os.environ.pop("http_proxy", None)
+            else:
+                os.environ["http_proxy"] = old_http_proxy
 
     def get_parser(self):
         """
@@ -438,8 +757,43 @@ class LiveWrapper(Component):
             logging.basicConfig(level=levels[self.args.log_level], filename=self.args.log, format="")
 
         try:
-            if os.path.exists(self.args.image_output):
-                raise Fail("Image '{}' already exists".format(self.args.image_output))
+            distributions = self.args.distribution or ["trixie"]
+            architectures = self.args.architecture or [self.default_architecture]
+            matrix = None
+            if self.args.matrix:
+                if len(distributions) > 1 or len(architectures) > 1:
+                    raise Fail("--matrix cannot be used with more than one --distribution or --architecture")
+                self.args.distribution = distributions
+                self.args.architecture = architectures
+                matrix = MatrixBuild(parser, self.args, load_variants(self.args.matrix, parser, self.args),
+                                     jobs=self.args.matrix_jobs)
+            elif len(distributions) > 1 or len(architectures) > 1:
+                matrix = MatrixBuild(parser, self.args, cross_variants(distributions, architectures),
+                                     jobs=self.args.matrix_jobs)
+            else:
+                self.args.distribution = distributions[0]
+                self.args.architecture = architectures[0]
+
+            if matrix is not None:
+                matrix.check()
+            else:
+                if self.args.iso_variants:
+                    self.iso_variants = load_variants(self.args.iso_variants, parser, self.args,
+                                                      options=ISO_VARIANT_OPTIONS)
+                    outputs = [variant_args(self.args, v).image_output for v in self.iso_variants]
+                else:
+                    outputs = [self.args.image_output]
+                for output in outputs:
+                    if os.path.exists(output):
+                        raise Fail("Image '{}' already exists".format(output))
+            if self.args.ansible_resume and not self.args.work_dir:
+                raise Fail("--ansible-resume needs --work-dir")
+            if self.args.ansible_resume:
+                # The chroot and the failure report to resume from are in the
+                # work dir, which needs to be kept
+                self.args.retry = True
+            if self.args.squashfs_record_base and self.args.squashfs_delta_base:
+                raise Fail("--squashfs-record-base needs a full image, and cannot be used with --squashfs-delta-base")
             if not self.args.isolinux and not self.args.grub:
                 raise Fail("You must enable at least one bootloader!")
             if self.args.grub and self.args.grub_loopback_only:
@@ -448,7 +802,18 @@ class LiveWrapper(Component):
                 sys.exit("You need to have root privileges to run this script.")
             # FIXME: cleanup on error.
 
-            self.start_ops()
+            try:
+                if matrix is not None:
+                    with self.apt_proxy(), tracer.span("matrix"):
+                        matrix.run(self.apt_proxy_url)
+                else:
+                    with self.apt_proxy(), tracer.span("build"):
+                        try:
+                            self.start_ops()
+                        finally:
+                            release_apt_states()
+            finally:
+                self.report_trace()
         except Fail as e:
             print(e, file=sys.stderr)
             sys.exit(1)
@@ -1,8 +1,19 @@
+import contextlib
+import errno
+import hashlib
 import os
 import tempfile
 import shutil
+from .ansible import load_failure_report
+from .boot_order import write_sort_file
 from .chroot import Chroot
 from .component import Component
+from .digest import json_digest, tree_manifest
+from .squashfs_delta import (BASE_IMAGE, DELTA_IMAGE, build_delta_tree, diff_manifests, load_base,
+                             record_base, write_module_file)
+from .squashfs_tune import BLOCK_SIZES, SquashfsTuner
+from .trace import tracer
+from .utils import Fail, copy_files, transfer_file
 
 
 class Squashfs(Component):
@@ -13,57 +24,242 @@ class Squashfs(Component):
         self.sysdesc = sysdesc
 
     def build(self, dest):
-        # with self.sysdesc.cache(dest, "squashfs", self.sysdesc.cache_id_squashfs) as cache:
-        #     if not cache.hit:
+        manifest = self.sysdesc.manifest
         with self.work_dir(self.sysdesc.chroot_dir) as chroot_dir:
-            chroot = Chroot(self.sysdesc)
-            chroot.build(chroot_dir)
-            if self.sysdesc.customize_squashfs:
-                self.run_cmd([self.sysdesc.customize_squashfs, chroot_dir])
-            self.run_mksquashfs(src=chroot_dir, dest=dest)
+            chroot_inputs = self.sysdesc.checkpoint_inputs_chroot
+            if manifest is not None and manifest.is_done("chroot", chroot_inputs):
+                self.log.info("%s was already built with the same inputs: reusing it", chroot_dir)
+            else:
+                if manifest is not None:
+                    manifest.invalidate("chroot")
+                start_at_task = self.resume_task(chroot_dir)
+                if start_at_task is None:
+                    self.clear_dir(chroot_dir)
+                with tracer.span("chroot", "step"):
+                    chroot = Chroot(self.sysdesc)
+                    chroot.build(chroot_dir, start_at_task=start_at_task)
+                    if self.sysdesc.customize_squashfs:
+                        self.run_cmd([self.sysdesc.customize_squashfs, chroot_dir])
+                if manifest is not None:
+                    manifest.record("chroot", chroot_inputs, [chroot_dir])
 
-    def run_mksquashfs(self, src, dest):
+            # The digest of the chroot is only needed to look up or reuse an
+            # existing squashfs, or to record it as a base for delta images
+            chroot_manifest = None
+            squashfs_inputs = None
+            if manifest is not None or self.sysdesc.cache_dir or self.sysdesc.squashfs_record_base:
+                self.log.info("Computing the digest of %s", chroot_dir)
+                with tracer.span("chroot digest", "step"):
+                    chroot_manifest = tree_manifest(chroot_dir, memo=manifest.memo if manifest is not None else None)
+                    chroot_digest = json_digest(chroot_manifest)
+                squashfs_inputs = {"options": self.sysdesc.cache_id_squashfs, "chroot": chroot_digest}
+            if manifest is not None and manifest.is_done("squashfs", squashfs_inputs):
+                self.log.info("%s was already generated from the same chroot: reusing it", dest)
+            else:
+                if manifest is not None:
+                    manifest.invalidate("squashfs")
+                self.clear_dir(dest)
+
+                with tracer.span("squashfs", "step"):
+                    if not self.sysdesc.cache_dir:
+                        self.run_mksquashfs(src=chroot_dir, dest=dest, chroot_manifest=chroot_manifest)
+                    else:
+                        cache_dir = os.path.join(self.sysdesc.cache_dir, "squashfs-" + self.cache_id(chroot_digest))
+                        if os.path.isdir(cache_dir):
+                            self.log.info("%s found: reusing it", cache_dir)
+                            self.link_files(cache_dir, dest)
+                        else:
+                            self.log.info("%s not found: (re)creating it", cache_dir)
+                            self.run_mksquashfs(src=chroot_dir, dest=dest, chroot_manifest=chroot_manifest)
+                            self.store(dest, cache_dir)
+
+                if manifest is not None:
+                    manifest.record("squashfs", squashfs_inputs, [dest])
+
+            if self.sysdesc.squashfs_record_base:
+                self.record_base(dest, chroot_manifest)
+
+    def resume_task(self, chroot_dir):
+        """
+        Return the ansible task to resume from on the existing chroot, or
+        None to build it from scratch
+        """
+        if not self.sysdesc.ansible_resume or self.sysdesc.ansible_failure_report is None:
+            return None
+        report = load_failure_report(self.sysdesc.ansible_failure_report)
+        if report is None or not report.get("failed_task"):
+            self.log.info("No failed ansible task to resume from: building the chroot from scratch")
+            return None
+        if report.get("chroot") != os.path.abspath(chroot_dir) or not os.path.isdir(os.path.join(chroot_dir, "etc")):
+            self.log.warning("The chroot where ansible failed is gone: building the chroot from scratch")
+            return None
+        return report["failed_task"]
+
+    def clear_dir(self, path):
+        """
+        Remove leftovers of a previous run from path, and make sure it
+        exists
+        """
+        if os.path.isdir(path) and os.listdir(path):
+            if os.path.ismount(os.path.join(path, "proc")):
+                raise Fail("{}/proc is still mounted: unmount it before retrying".format(path))
+            self.log.info("Removing the previous contents of %s", path)
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+
+    def cache_id(self, chroot_digest):
+        """
+        Compute the squashfs cache key from the mksquashfs options and the
+        digest of the contents of the chroot
+        """
+        sha = hashlib.sha1()
+        sha.update(self.sysdesc.cache_id_squashfs.encode())
+        sha.update(chroot_digest.encode())
+        return sha.hexdigest()
+
+    def store(self, dest, cache_dir):
+        """
+        Store the squashfs and the boot files in dest into the cache
+        """
+        # Concurrent builds may store the same squashfs, which only depends
+        # on the cache id: use a unique temporary name, and keep the entry
+        # stored first
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir), prefix=os.path.basename(cache_dir) + ".",
+                                   suffix=".tmp")
+        try:
+            self.link_files(dest, tmp_dir)
+            os.rename(tmp_dir, cache_dir)
+        except OSError as e:
+            shutil.rmtree(tmp_dir)
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY) or not os.path.isdir(cache_dir):
+                raise
+            self.log.info("%s was stored by another build meanwhile", cache_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir)
+            raise
+
+    def run_mksquashfs(self, src, dest, chroot_manifest=None):
         if not os.path.exists(dest):
             os.makedirs(dest)
-        suffixed = os.path.join(dest, "filesystem.squashfs")
-        if os.path.exists(suffixed):
-            self.log.info("%s already exists: reusing it", suffixed)
-            return
 
         if not self.mksquashfs:
             self.log.warn("mksquashfs not found: you may need to install squashfs-tools")
 
-        with tempfile.NamedTemporaryFile(mode="wt") as fd:
-            print("/proc", file=fd)
-            print("/dev", file=fd)
-            print("/sys", file=fd)
-            print("/run", file=fd)
+        options = self.sysdesc.squashfs_options
+        if self.sysdesc.squashfs_compression == "auto":
+            options = self.tune(src)
 
-            self.log.info("Running mksquashfs on %s", src)
-            self.run_cmd(
-                ['nice', self.mksquashfs, src, suffixed,
-                 '-no-progress', '-comp', self.sysdesc.squashfs_compression,
-                 '-e', fd.name], eatmydata=False)
+        if self.sysdesc.squashfs_delta_base:
+            self.make_delta(src, dest, options, chroot_manifest)
+        else:
+            suffixed = os.path.join(dest, "filesystem.squashfs")
+            self.make_image(src, suffixed, options)
             check_size = os.path.getsize(suffixed)
-            self.log.debug("Created squashfs: %s (%d bytes)", suffixed, check_size)
             if check_size < (1024 * 1024):
                 self.log.warning(
                     "%s appears to be too small: %s bytes",
                     suffixed, check_size)
 
-            bootdir = os.path.join(src, 'boot')
-            # copying the boot/* files
-            self.log.debug("Copying boot files out of squashfs")
-            self.copy_files(bootdir, dest)
+        bootdir = os.path.join(src, 'boot')
+        # copying the boot/* files
+        self.log.debug("Copying boot files out of squashfs")
+        copied = self.copy_files(bootdir, dest)
+        self.log.debug("Copied %d bytes of boot files", copied)
+
+    def make_image(self, src, image, options):
+        """
+        Run mksquashfs to create image out of the tree at src
+        """
+        with contextlib.ExitStack() as stack:
+            fd = stack.enter_context(tempfile.NamedTemporaryFile(mode="wt"))
+            print("/proc", file=fd)
+            print("/dev", file=fd)
+            print("/sys", file=fd)
+            print("/run", file=fd)
+
+            sort_args = []
+            if self.sysdesc.squashfs_sort_trace:
+                sortfd = stack.enter_context(tempfile.NamedTemporaryFile(mode="wt", suffix=".sort"))
+                count = write_sort_file(self.sysdesc.squashfs_sort_trace, src, sortfd)
+                sortfd.flush()
+                self.log.info("Placing %d files from %s at the start of the squashfs",
+                              count, self.sysdesc.squashfs_sort_trace)
+                sort_args = ['-sort', sortfd.name]
+
+            self.log.info("Running mksquashfs on %s", src)
+            with tracer.span("mksquashfs", "step"):
+                self.run_cmd(
+                    ['nice', self.mksquashfs, src, image,
+                     '-no-progress'] + options + self.sysdesc.mksquashfs_resource_options + sort_args
+                    + ['-e', fd.name],
+                    eatmydata=False)
+            self.log.debug("Created squashfs: %s (%d bytes)", image, os.path.getsize(image))
+
+    def make_delta(self, src, dest, options, chroot_manifest):
+        """
+        Create a squashfs layer with the differences between the chroot at
+        src and the recorded base, and stack it on top of the base image
+        """
+        base_dir = self.sysdesc.squashfs_delta_base
+        base_manifest = load_base(base_dir)
+        if chroot_manifest is None:
+            chroot_manifest = tree_manifest(src)
+        changed, removed = diff_manifests(base_manifest, chroot_manifest)
+        self.log.info("%s: %d entries changed and %d removed since the base image in %s",
+                      src, len(changed), len(removed), base_dir)
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(src)), prefix=".delta-") as delta_dir:
+            build_delta_tree(src, delta_dir, changed, removed)
+            self.make_image(delta_dir, os.path.join(dest, DELTA_IMAGE), options)
+        self.link_files(base_dir, dest, names=[BASE_IMAGE])
+        write_module_file(dest)
+
+    def record_base(self, dest, chroot_manifest):
+        """
+        Record the squashfs in dest as a base for later delta images
+        """
+        self.log.info("Recording %s as a base for delta images in %s",
+                      os.path.join(dest, BASE_IMAGE), self.sysdesc.squashfs_record_base)
+        record_base(self.sysdesc.squashfs_record_base, os.path.join(dest, BASE_IMAGE), chroot_manifest,
+                    link=self.sysdesc.squashfs_link)
+
+    def tune(self, src):
+        """
+        Choose the compression options for the squashfs of src, saving the
+        results next to the chroot if it is in a work directory
+        """
+        tuner = SquashfsTuner(
+                sample_size=self.sysdesc.squashfs_tune_sample,
+                max_decompress_time=self.sysdesc.squashfs_max_decompress_time,
+                block_sizes=(self.sysdesc.squashfs_block_size,) if self.sysdesc.squashfs_block_size else BLOCK_SIZES,
+                extra_args=self.sysdesc.mksquashfs_resource_options)
+        report = None
+        if self.sysdesc.chroot_dir:
+            report = os.path.join(os.path.dirname(os.path.abspath(src)), "squashfs-tuning.json")
+        with tracer.span("squashfs tuning", "step"):
+            options = tuner.tune(src, report=report)
+        self.log.info("Chosen squashfs options: %s", " ".join(options))
+        return options
 
     def copy_files(self, src, dest):
         """
-        Copy all files in src to dest
+        Copy all files in src to dest, returning the number of bytes
+        actually copied
+        """
+        # Do not hardlink, since the chroot is reused by later builds
+        return copy_files(src, dest, link=False)
+
+    def link_files(self, src, dest, names=None):
+        """
+        Hardlink (or reflink) all files in src, or only those in names, to
+        dest, copying them if they are on different filesystems.
+
+        Files are not hardlinked if sysdesc.squashfs_link is False.
         """
-        for filename in os.listdir(src):
+        copied = 0
+        for filename in names if names is not None else os.listdir(src):
             src_path = os.path.join(src, filename)
             if os.path.isdir(src_path) or os.path.islink(src_path):
                 continue
-            shutil.copyfile(
-                src_path,
-                os.path.join(dest, filename))
+            copied += transfer_file(src_path, os.path.join(dest, filename), link=self.sysdesc.squashfs_link)
+        if copied:
+            self.log.debug("Copied %d bytes from %s to %s", copied, src, dest)
@@ -0,0 +1,127 @@
+"""
+Build the live system as a small squashfs layer on top of a previously
+built base image.
+
+live-boot stacks all the images listed in ``live/filesystem.module`` with
+overlayfs, later ones on top: the delta layer contains the files that were
+added or changed since the base image, and overlayfs whiteouts (character
+devices with device number 0/0) for the files that were removed.
+
+A base is recorded as a directory with its ``filesystem.squashfs``, and a
+``manifest.json`` describing the chroot it was built from.
+"""
+
+import json
+import os
+import stat
+from .utils import Fail, transfer_file
+
+BASE_IMAGE = "filesystem.squashfs"
+DELTA_IMAGE = "filesystem-delta.squashfs"
+MODULE_FILE = "filesystem.module"
+
+
+def record_base(record_dir, image, manifest, link=True):
+    """
+    Record image, built from a chroot described by manifest (see
+    :any:`lwr.digest.tree_manifest`), as a base for delta images.
+
+    image is hardlinked into record_dir if link is True, and it is never
+    changed in place.
+    """
+    os.makedirs(record_dir, exist_ok=True)
+    pathname = os.path.join(record_dir, BASE_IMAGE)
+    transfer_file(image, pathname + ".tmp", link=link)
+    manifest_pathname = os.path.join(record_dir, "manifest.json")
+    with open(manifest_pathname + ".tmp", "wt") as fd:
+        json.dump({"manifest": manifest}, fd)
+    # Replace the manifest last, since it identifies the base
+    os.rename(pathname + ".tmp", pathname)
+    os.rename(manifest_pathname + ".tmp", manifest_pathname)
+
+
+def load_base(record_dir):
+    """
+    Return the chroot manifest of a recorded base
+    """
+    try:
+        with open(os.path.join(record_dir, "manifest.json"), "rt") as fd:
+            manifest = json.load(fd)["manifest"]
+    except (OSError, ValueError, KeyError) as e:
+        raise Fail("{} is not a recorded squashfs base: {}".format(record_dir, e))
+    if not os.path.exists(os.path.join(record_dir, BASE_IMAGE)):
+        raise Fail("{} is not a recorded squashfs base: {} is missing".format(record_dir, BASE_IMAGE))
+    return manifest
+
+
+def _same(old, new):
+    # The link count changes with unrelated files
+    return {k: v for k, v in old.items() if k != "nlink"} == {k: v for k, v in new.items() if k != "nlink"}
+
+
+def _parents(relpath):
+    parts = relpath.split("/")[:-1]
+    return ["/".join(parts[:idx]) for idx in range(1, len(parts) + 1)]
+
+
+def diff_manifests(base, new):
+    """
+    Compare two chroot manifests, returning the list of paths that were
+    added or changed in new, and the list of paths that were removed from
+    base and need a whiteout
+    """
+    changed = [relpath for relpath, entry in new.items()
+               if relpath not in base or not _same(base[relpath], entry)]
+    removed = []
+    gone = {relpath for relpath in base if relpath not in new}
+    for relpath in sorted(gone):
+        hidden = False
+        for parent in _parents(relpath):
+            # A whiteout for the parent, or a non-directory replacing it,
+            # already hides this path
+            if parent in gone or (parent in new and not stat.S_ISDIR(new[parent]["mode"])):
+                hidden = True
+                break
+        if not hidden:
+            removed.append(relpath)
+    return sorted(changed), removed
+
+
+def _copy_entry(root, dest, relpath):
+    src = os.path.join(root, relpath)
+    target = os.path.join(dest, relpath)
+    st = os.lstat(src)
+    if stat.S_ISDIR(st.st_mode):
+        os.makedirs(target, exist_ok=True)
+    elif stat.S_ISREG(st.st_mode):
+        transfer_file(src, target)
+    elif stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), target)
+    else:
+        os.mknod(target, st.st_mode, st.st_rdev)
+    os.lchown(target, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(target, stat.S_IMODE(st.st_mode))
+
+
+def build_delta_tree(root, dest, changed, removed):
+    """
+    Fill dest with the changed entries of the tree at root, and whiteouts
+    for the removed ones
+    """
+    paths = set(changed)
+    for relpath in list(changed) + list(removed):
+        paths.update(_parents(relpath))
+    for relpath in sorted(paths):
+        _copy_entry(root, dest, relpath)
+    for relpath in removed:
+        os.mknod(os.path.join(dest, relpath), stat.S_IFCHR, os.makedev(0, 0))
+
+
+def write_module_file(dest):
+    """
+    Tell live-boot to stack the delta image on top of the base
+    """
+    with open(os.path.join(dest, MODULE_FILE), "wt") as fd:
+        print(BASE_IMAGE, file=fd)
+        print(DELTA_IMAGE, file=fd)
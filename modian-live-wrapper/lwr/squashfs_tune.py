@@ -0,0 +1,212 @@
+"""
+Choose the mksquashfs compression settings for an image, by compressing a
+sample of the chroot with several compressors, levels and block sizes, and
+measuring the resulting size, compression time and decompression speed.
+"""
+
+import json
+import math
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+from .component import Component
+from .digest import walk_tree
+from .utils import Fail
+
+# Range of -Xcompression-level for the compressors that support it
+COMPRESSION_LEVELS = {
+    "gzip": (1, 9),
+    "lzo": (1, 9),
+    "zstd": (1, 22),
+}
+
+# Compressors and levels tried when tuning, None meaning the compressor
+# default. For lz4, any level enables its high compression mode.
+CANDIDATES = (
+    ("gzip", None),
+    ("gzip", 9),
+    ("lzo", None),
+    ("lz4", None),
+    ("lz4", 1),
+    ("xz", None),
+    ("zstd", 3),
+    ("zstd", 15),
+    ("zstd", 19),
+)
+
+# Block sizes tried when tuning
+BLOCK_SIZES = ("128K", "1M")
+
+# Top-level directories of the chroot that are not part of the image
+SKIP_DIRS = ("proc", "sys", "dev", "run")
+
+
+def compression_args(compression, level=None, block_size=None):
+    """
+    Return the mksquashfs options selecting a compressor, compression level
+    and block size
+    """
+    args = ["-comp", compression]
+    if block_size:
+        args += ["-b", str(block_size)]
+    if level is not None:
+        if compression == "lz4":
+            args.append("-Xhc")
+        elif compression in COMPRESSION_LEVELS:
+            low, high = COMPRESSION_LEVELS[compression]
+            if not low <= int(level) <= high:
+                raise Fail("{} compression level must be between {} and {}".format(compression, low, high))
+            args += ["-Xcompression-level", str(level)]
+        else:
+            raise Fail("{} compression does not support compression levels".format(compression))
+    return args
+
+
+class SquashfsTuner(Component):
+    """
+    Trial-compress a sample of a tree, and pick the compression settings
+    giving the smallest image whose estimated decompression time is within
+    max_decompress_time seconds, or the smallest image if it is None
+    """
+    mksquashfs = shutil.which("mksquashfs")
+    unsquashfs = shutil.which("unsquashfs")
+
+    def __init__(self, sample_size=128 * 1024 * 1024, max_decompress_time=None, block_sizes=BLOCK_SIZES,
+                 extra_args=()):
+        super().__init__()
+        self.sample_size = sample_size
+        self.max_decompress_time = max_decompress_time
+        self.block_sizes = block_sizes
+        # Options like -processors and -mem, used for all runs
+        self.extra_args = list(extra_args)
+
+    def sample(self, root, dest):
+        """
+        Hardlink (or copy) an evenly spread selection of the regular files in
+        root into dest, up to sample_size bytes. Return the total size of the
+        regular files in root.
+        """
+        files = []
+        total = 0
+        for relpath, st in walk_tree(root):
+            if relpath.split(os.sep)[0] in SKIP_DIRS or not stat.S_ISREG(st.st_mode):
+                continue
+            files.append((relpath, st.st_size))
+            total += st.st_size
+        stride = max(1, math.ceil(total / self.sample_size))
+        size = 0
+        for relpath, file_size in files[::stride]:
+            if size >= self.sample_size:
+                break
+            src = os.path.join(root, relpath)
+            pathname = os.path.join(dest, relpath)
+            os.makedirs(os.path.dirname(pathname), exist_ok=True)
+            try:
+                os.link(src, pathname)
+            except OSError:
+                shutil.copyfile(src, pathname)
+            size += file_size
+        return total
+
+    def trial(self, sample_dir, work_dir, compression, level, block_size):
+        """
+        Compress sample_dir with the given settings, and return a dict with
+        the results
+        """
+        image = os.path.join(work_dir, "trial.squashfs")
+        if os.path.exists(image):
+            os.unlink(image)
+        options = compression_args(compression, level, block_size)
+        start = time.monotonic()
+        self.run_cmd([self.mksquashfs, sample_dir, image, "-no-progress"] + options + self.extra_args,
+                     stdout=subprocess.DEVNULL, eatmydata=False)
+        compress_seconds = time.monotonic() - start
+        res = {
+            "compression": compression,
+            "level": level,
+            "block_size": block_size,
+            "options": options,
+            "size": os.path.getsize(image),
+            "compress_seconds": round(compress_seconds, 3),
+            "decompress_seconds": None,
+        }
+        if self.unsquashfs:
+            # Decompress with a single thread, like a boot reading files
+            # one after the other
+            out = os.path.join(work_dir, "out")
+            start = time.monotonic()
+            self.run_cmd([self.unsquashfs, "-n", "-p", "1", "-d", out, image],
+                         stdout=subprocess.DEVNULL, eatmydata=False)
+            res["decompress_seconds"] = round(time.monotonic() - start, 3)
+            shutil.rmtree(out)
+        return res
+
+    def choose(self, results):
+        """
+        Return the best of the trial results
+        """
+        fitting = results
+        if self.max_decompress_time is not None:
+            if any(r["estimated_decompress_seconds"] is None for r in results):
+                self.log.warning("unsquashfs not found: cannot estimate decompression times")
+            else:
+                fitting = [r for r in results if r["estimated_decompress_seconds"] <= self.max_decompress_time]
+                if not fitting:
+                    self.log.warning("No compression decompresses within %.1fs: using the fastest one",
+                                     self.max_decompress_time)
+                    return min(results, key=lambda r: r["estimated_decompress_seconds"])
+        return min(fitting, key=lambda r: (r["size"], r["compress_seconds"]))
+
+    def tune(self, root, report=None):
+        """
+        Return the mksquashfs options for the best compression settings for
+        the tree at root, optionally saving all the results as JSON to
+        report
+        """
+        if not self.mksquashfs:
+            raise Fail("mksquashfs not found: you may need to install squashfs-tools")
+        results = []
+        unsupported = set()
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(root)),
+                                         prefix=".squashfs-tune-") as work_dir:
+            sample_dir = os.path.join(work_dir, "sample")
+            os.makedirs(sample_dir)
+            total = self.sample(root, sample_dir)
+            sample = sum(st.st_size for relpath, st in walk_tree(sample_dir) if stat.S_ISREG(st.st_mode))
+            self.log.info("Trying squashfs compressions on %d of %d bytes", sample, total)
+            for compression, level in CANDIDATES:
+                for block_size in self.block_sizes:
+                    if compression in unsupported:
+                        continue
+                    try:
+                        res = self.trial(sample_dir, work_dir, compression, level, block_size)
+                    except subprocess.CalledProcessError:
+                        self.log.warning("mksquashfs does not support %s compression: skipping it", compression)
+                        unsupported.add(compression)
+                        continue
+                    # Extrapolate to the whole tree
+                    scale = total / sample if sample else 1
+                    res["estimated_size"] = int(res["size"] * scale)
+                    res["estimated_decompress_seconds"] = (
+                        round(res["decompress_seconds"] * scale, 1) if res["decompress_seconds"] is not None else None)
+                    results.append(res)
+        if not results:
+            raise Fail("mksquashfs failed with all compressions")
+
+        best = self.choose(results)
+        self.log.info("%-6s %5s %5s  %12s  %9s  %11s", "comp", "level", "block", "est. size", "compress", "decompress")
+        for res in results:
+            self.log.info("%-6s %5s %5s  %12d  %8.1fs  %10s%s",
+                          res["compression"], res["level"] if res["level"] is not None else "-", res["block_size"],
+                          res["estimated_size"], res["compress_seconds"],
+                          "{:.1f}s".format(res["estimated_decompress_seconds"])
+                          if res["estimated_decompress_seconds"] is not None else "-",
+                          "  <- chosen" if res is best else "")
+        if report:
+            with open(report, "wt") as fd:
+                json.dump({"total_bytes": total, "sample_bytes": sample, "results": results, "chosen": best},
+                          fd, indent=1)
+        return best["options"]
@@ -0,0 +1,100 @@
+"""
+Run the steps of a build as a graph of stages, running independent stages
+concurrently.
+"""
+
+import concurrent.futures
+from .component import Component
+from .trace import tracer
+from .utils import Fail
+
+
+class Stage:
+    """
+    A step of the build, run once all the stages it depends on are done.
+
+    If outputs is set, it lists the files and directories produced by the
+    stage, and inputs is a JSON-serializable description of what they
+    depend on: the stage is skipped if the manifest shows that it already
+    ran with the same inputs, and its outputs are intact.
+    """
+    def __init__(self, name, func, deps=(), inputs=None, outputs=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def __repr__(self):
+        return "Stage({})".format(self.name)
+
+
+class StageScheduler(Component):
+    """
+    Run stages in threads, starting each one as soon as its dependencies are
+    done, with at most ``jobs`` stages running at the same time
+    """
+    def __init__(self, jobs=None, manifest=None):
+        super().__init__()
+        self.jobs = jobs or 1
+        self.manifest = manifest
+        self.stages = {}
+
+    def add(self, name, func, deps=(), inputs=None, outputs=None):
+        """
+        Add a stage running func(). Dependencies that are not stages of this
+        scheduler are ignored, so that optional stages can be listed
+        unconditionally.
+        """
+        if name in self.stages:
+            raise RuntimeError("stage {} added twice".format(name))
+        stage = Stage(name, func, [dep for dep in deps if dep in self.stages], inputs=inputs, outputs=outputs)
+        self.stages[name] = stage
+        return stage
+
+    def _run_stage(self, stage, parents):
+        checkpoint = self.manifest is not None and stage.outputs is not None
+        if checkpoint:
+            if self.manifest.is_done(stage.name, stage.inputs):
+                self.log.info("%s: already done with the same inputs: skipping", stage.name)
+                return
+            self.manifest.invalidate(stage.name)
+        self.log.info("%s: started", stage.name)
+        with tracer.span(stage.name, parents=parents) as span:
+            stage.func()
+        self.log.info("%s: done in %.1fs", stage.name, span.wall)
+        if checkpoint:
+            self.manifest.record(stage.name, stage.inputs, stage.outputs)
+
+    def run(self):
+        """
+        Run all stages. If a stage fails, no new stages are started, and
+        the exception is raised once the stages already running have ended.
+        """
+        done = set()
+        running = {}
+        pending = list(self.stages.values())
+        error = None
+        parents = tracer.current_spans()
+        with concurrent.futures.ThreadPoolExecutor(self.jobs, thread_name_prefix="stage") as pool:
+            while pending or running:
+                if error is None:
+                    for stage in [s for s in pending if all(dep in done for dep in s.deps)]:
+                        pending.remove(stage)
+                        running[pool.submit(self._run_stage, stage, parents)] = stage
+                if not running:
+                    if error is None:
+                        raise Fail("Stages {} cannot be started".format(", ".join(s.name for s in pending)))
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    exc = future.exception()
+                    if exc is not None:
+                        self.log.error("%s: failed: %s", stage.name, exc)
+                        if error is None:
+                            error = exc
+                    else:
+                        done.add(stage.name)
+        if error is not None:
+            raise error
@@ -0,0 +1,235 @@
+"""
+Trace of the time and resources used by the build stages and by the
+commands they run, which can be saved in the Chrome trace event format and
+opened with chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import contextlib
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+# Commands that only run another command, skipped when naming command events
+WRAPPER_COMMANDS = ("eatmydata", "nice", "ionice", "chroot", "env")
+
+
+def command_name(args):
+    """
+    Return a short name for a command line, skipping wrapper commands and
+    their options
+    """
+    names = [os.path.basename(str(x)) for x in args]
+    for idx, name in enumerate(names):
+        if name in WRAPPER_COMMANDS or name.startswith("-") or name.isdigit():
+            continue
+        # The first argument of chroot is the chroot directory
+        if idx > 0 and names[idx - 1] == "chroot":
+            continue
+        return name
+    return names[0] if names else "?"
+
+
+def read_proc_io(pid):
+    """
+    Return the I/O counters of a process from /proc/<pid>/io, or an empty
+    dict if they are not available
+    """
+    res = {}
+    try:
+        with open("/proc/{}/io".format(pid), "rt") as fd:
+            for line in fd:
+                name, value = line.split(":", 1)
+                res[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return res
+
+
+class TracedPopen(subprocess.Popen):
+    """
+    Popen that records the resource usage of the process in the tracer when
+    it is waited for
+    """
+    def __init__(self, args, **kw):
+        self.trace_start = time.time()
+        self.trace_end = None
+        self.rusage = None
+        self.io = {}
+        super().__init__(args, **kw)
+
+    def _try_wait(self, wait_flags):
+        # Wait for the process to exit without reaping it, to read its I/O
+        # counters while they still exist, then reap it with wait4 to get its
+        # resource usage, which includes that of its own children
+        try:
+            if not wait_flags & os.WNOHANG:
+                os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT)
+                self.io = read_proc_io(self.pid)
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.trace_end = time.time()
+            self.rusage = rusage
+            tracer.add_command(self, os.waitstatus_to_exitcode(sts))
+        return (pid, sts)
+
+
+class Span:
+    """
+    Resources used by a stage, and by the commands run inside it
+    """
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+        self.start = time.time()
+        self.end = None
+        self.thread_cpu = time.thread_time()
+        self.children_cpu = 0.0
+        self.max_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.commands = 0
+
+    def add_command(self, proc):
+        self.children_cpu += proc.rusage.ru_utime + proc.rusage.ru_stime
+        self.max_rss = max(self.max_rss, proc.rusage.ru_maxrss)
+        self.read_bytes += proc.io.get("read_bytes", 0)
+        self.write_bytes += proc.io.get("write_bytes", 0)
+        self.commands += 1
+
+    def finish(self):
+        self.end = time.time()
+        self.thread_cpu = time.thread_time() - self.thread_cpu
+
+    @property
+    def wall(self):
+        return (self.end or time.time()) - self.start
+
+    @property
+    def cpu(self):
+        return self.thread_cpu + self.children_cpu
+
+
+class Tracer:
+    """
+    Collect trace events for stages and commands
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.events = []
+        self.spans = []
+        self.threads = {}
+        self.local = threading.local()
+
+    def _add_event(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": int((start - self.origin) * 1000000),
+                "dur": int((end - start) * 1000000),
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": args,
+            })
+
+    def current_spans(self):
+        """
+        Return the spans open in the current thread
+        """
+        return list(getattr(self.local, "stack", ()))
+
+    @contextlib.contextmanager
+    def span(self, name, category="stage", parents=None):
+        """
+        Trace the time and resources used inside the context.
+
+        When starting a span in a new thread, parents can be the
+        current_spans() of the thread that started it, so that they also
+        account for the commands run inside the span.
+        """
+        span = Span(name, category)
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        if not stack and parents:
+            stack.extend(parents)
+        stack.append(span)
+        with self.lock:
+            self.spans.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            if parents and stack == parents:
+                stack.clear()
+            span.finish()
+            self._add_event(name, category, span.start, span.end, {
+                "cpu": round(span.cpu, 3),
+                "children_cpu": round(span.children_cpu, 3),
+                "max_rss_kb": span.max_rss,
+                "read_bytes": span.read_bytes,
+                "write_bytes": span.write_bytes,
+                "commands": span.commands,
+            })
+
+    def add_command(self, proc, returncode):
+        """
+        Record a command run by a TracedPopen
+        """
+        for span in getattr(self.local, "stack", ()):
+            span.add_command(proc)
+        args = proc.args if isinstance(proc.args, (list, tuple)) else [proc.args]
+        self._add_event(command_name(args), "command", proc.trace_start, proc.trace_end, {
+            "cmd": " ".join(shlex.quote(str(x)) for x in args),
+            "returncode": returncode,
+            "user_cpu": round(proc.rusage.ru_utime, 3),
+            "sys_cpu": round(proc.rusage.ru_stime, 3),
+            "max_rss_kb": proc.rusage.ru_maxrss,
+            "read_bytes": proc.io.get("read_bytes"),
+            "write_bytes": proc.io.get("write_bytes"),
+        })
+
+    def write(self, pathname):
+        """
+        Write the trace to a file in the Chrome trace event format
+        """
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        for tid, name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}})
+        with open(pathname + ".tmp", "wt") as fd:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fd)
+        os.rename(pathname + ".tmp", pathname)
+
+    def summary(self):
+        """
+        Return a table with the resources used by each traced stage, as a
+        list of lines
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        if not spans:
+            return []
+        mib = 1024 * 1024
+        width = max([len("stage")] + [len(s.name) for s in spans])
+        lines = ["{:{w}}  {:>9}  {:>9}  {:>9}  {:>10}  {:>10}".format(
+            "stage", "wall", "cpu", "max rss", "read", "written", w=width)]
+        for span in spans:
+            lines.append("{:{w}}  {:>8.1f}s  {:>8.1f}s  {:>6.0f}MiB  {:>7.0f}MiB  {:>7.0f}MiB".format(
+                span.name, span.wall, span.cpu, span.max_rss / 1024, span.read_bytes / mib, span.write_bytes / mib,
+                w=width))
+        return lines
+
+
+# Tracer for the whole process
+tracer = Tracer()
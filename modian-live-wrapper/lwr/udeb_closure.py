@@ -0,0 +1,137 @@
+"""
+Compute the udebs that the installer needs from the image, instead of
+copying the whole debian-installer component.
+
+The installer loads the udebs of priority standard or higher for its
+kernel, the udebs listed in ``.disk/udeb_include``, and their
+dependencies. Udebs already in the initrd do not need to be on the image.
+"""
+
+import gzip
+import re
+
+# Priorities of the udebs that anna loads without asking
+DEFAULT_PRIORITIES = ("required", "important", "standard")
+
+# Status file of the udebs installed in the initrd
+INITRD_STATUS = "var/lib/dpkg/status"
+
+_re_kernel_image = re.compile(r"^kernel-image-(.+)-di$")
+
+
+def read_cpio_file(pathname, name):
+    """
+    Return the contents of the file name in a gzipped newc cpio archive, like
+    an initrd, or None if it is not there
+    """
+    def pad(size):
+        return (4 - size % 4) % 4
+
+    with gzip.open(pathname, "rb") as fd:
+        while True:
+            header = fd.read(110)
+            if len(header) < 110 or header[:6] not in (b"070701", b"070702"):
+                return None
+            file_size = int(header[54:62], 16)
+            name_size = int(header[94:102], 16)
+            entry = fd.read(name_size)[:-1].decode("utf8", "replace")
+            fd.read(pad(110 + name_size))
+            if entry == "TRAILER!!!":
+                return None
+            data = fd.read(file_size)
+            fd.read(pad(file_size))
+            if entry.lstrip("./") == name:
+                return data
+
+
+def parse_initrd_status(text):
+    """
+    Return the set of package names (including virtual ones) installed in a
+    dpkg status file, and the kernel version of its kernel-image udeb, or
+    None
+    """
+    installed = set()
+    kernel_version = None
+    for stanza in text.split("\n\n"):
+        fields = {}
+        for line in stanza.splitlines():
+            if line and not line[0].isspace() and ":" in line:
+                key, value = line.split(":", 1)
+                fields[key.strip().lower()] = value.strip()
+        name = fields.get("package")
+        if not name:
+            continue
+        installed.add(name)
+        for provided in fields.get("provides", "").split(","):
+            provided = provided.split("(")[0].strip()
+            if provided:
+                installed.add(provided)
+        mo = _re_kernel_image.match(name)
+        if mo:
+            kernel_version = mo.group(1)
+    return installed, kernel_version
+
+
+def read_initrd(pathname):
+    """
+    Return the udebs installed in an initrd, and its kernel version, as
+    parse_initrd_status
+    """
+    status = read_cpio_file(pathname, INITRD_STATUS)
+    if status is None:
+        return set(), None
+    return parse_initrd_status(status.decode("utf8", "replace"))
+
+
+def udeb_closure(packages, seeds, installed=(), kernel_version=None):
+    """
+    Return the set of udebs needed to install seeds and the udebs of default
+    priority, and the set of dependencies that cannot be satisfied.
+
+    packages maps udeb names to dicts with ``depends`` (a list of lists of
+    alternative names), ``provides``, ``priority`` and ``kernel_version``.
+    Udebs built for a kernel other than kernel_version, if set, are never
+    selected.
+    """
+    installed = set(installed)
+
+    def usable(name):
+        version = packages[name]["kernel_version"]
+        return kernel_version is None or version is None or version == kernel_version
+
+    providers = {}
+    for name, info in packages.items():
+        for provided in info["provides"]:
+            providers.setdefault(provided, []).append(name)
+
+    def candidates(name):
+        res = [name] if name in packages and usable(name) else []
+        return res + sorted(p for p in providers.get(name, ()) if p != name and usable(p))
+
+    todo = sorted(seeds, reverse=True)
+    todo += sorted((name for name, info in packages.items()
+                    if info["priority"] in DEFAULT_PRIORITIES and usable(name)), reverse=True)
+    selected = set()
+    missing = set()
+    while todo:
+        name = todo.pop()
+        if name in selected or name in installed:
+            continue
+        options = candidates(name)
+        if not options:
+            missing.add(name)
+            continue
+        if any(option in selected for option in options):
+            continue
+        selected.add(options[0])
+        for alternatives in packages[options[0]]["depends"]:
+            if any(alt in installed for alt in alternatives):
+                continue
+            options = [c for alt in alternatives for c in candidates(alt)]
+            if any(option in selected for option in options):
+                continue
+            if options:
+                todo.append(options[0])
+            else:
+                missing.add(" | ".join(alternatives))
+    return selected, missing
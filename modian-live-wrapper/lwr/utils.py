@@ -10,36 +10,78 @@ suites, architectures or other variants.
 """
 
 from six.moves.urllib.parse import urljoin
+import concurrent.futures
+import errno
+import fcntl
 import requests
+import requests.adapters
 import os
 import shutil
+import threading
 
 KERNEL = 'vmlinuz'
 RAMDISK = 'initrd.gz'
 CD_INFO = 'debian-cd_info.tar.gz'
 
+# ioctl sharing the data of a file with another, on filesystems like btrfs
+# and xfs
+FICLONE = 0x40049409
+
+# Errors meaning that a way of copying data is not supported for a pair of
+# files
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM)
+
 
 class Fail(BaseException):
     pass
 
 
+# Session shared by all URL checks, to reuse connections to the mirrors
+_session = requests.Session()
+_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+
+# URL checks, started or done, by URL
+_url_checks = {}
+_url_checks_lock = threading.Lock()
+_url_checks_executor = concurrent.futures.ThreadPoolExecutor(8, thread_name_prefix="check-url")
+
+
+def _check_url(url):
+    res = _session.head(url, allow_redirects=True, timeout=30)
+    if res.status_code != requests.codes.OK:  # pylint: disable=no-member
+        # try using (the slower) get for services with broken redirect support
+        with _session.get(url, allow_redirects=True, stream=True, timeout=30) as res:
+            if res.status_code != requests.codes.OK:  # pylint: disable=no-member
+                raise Fail("Resources not available at '{}'".format(url))
+
+
+def check_url_async(url):
+    """
+    Start checking that url gives a HTTP 200 in the background.
+    Returns a Future, whose result() raises Fail if it does not. Each URL is
+    checked only once per process.
+    """
+    with _url_checks_lock:
+        future = _url_checks.get(url)
+        if future is None:
+            future = _url_checks_executor.submit(_check_url, url)
+            _url_checks[url] = future
+    return future
+
+
 def check_url(url):
     """
     Check that constructed URLs actually give a HTTP 200.
     """
-    res = requests.head(url, allow_redirects=True, timeout=30)
-    if res.status_code != requests.codes.OK:  # pylint: disable=no-member
-        # try using (the slower) get for services with broken redirect support
-        res = requests.get(
-            url, allow_redirects=True, stream=True, timeout=30)
-        if res.status_code != requests.codes.OK:  # pylint: disable=no-member
-            raise Fail("Resources not available at '{}'".format(url))
+    check_url_async(url).result()
 
 
-def cdrom_image_url(mirror, suite, architecture, gtk=False, daily=False):
+def cdrom_image_url(mirror, suite, architecture, gtk=False, daily=False, check=True):
     """
     Create checked URLs for the di helpers.
     Returns a tuple of base_url, kernel, ramdisk, cd_info in that order.
+    If check is False, the URLs are not checked.
     """
     if not daily:
         # urljoin refuses to use existing subdirs which start with /
@@ -61,31 +103,131 @@ def cdrom_image_url(mirror, suite, architecture, gtk=False, daily=False):
     kernel = urljoin(base_url, KERNEL)
     ramdisk = urljoin(base_url, RAMDISK)
     cd_info = urljoin(base_url, CD_INFO)
-    check_url(base_url)
-    check_url(kernel)
-    check_url(ramdisk)
+    if check:
+        checks = [check_url_async(url) for url in (base_url, kernel, ramdisk)]
+        for future in checks:
+            future.result()
     return (base_url, kernel, ramdisk, cd_info)
 
 
-def copytree(source, target):
+def installer_sums_url(base_url):
+    """
+    Return the URL of the SHA256SUMS file listing the di helpers found at
+    a base_url returned by cdrom_image_url
+    """
+    return base_url[:base_url.rindex('/cdrom/') + 1] + 'SHA256SUMS'
+
+
+def _reflink(src, dest):
+    """
+    Try to make dest a reflinked copy of src, returning True on success
+    """
+    try:
+        with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        return False
+    return True
+
+
+def _copy_data(src, dest):
+    """
+    Copy the contents of src to dest, in the kernel if possible. Return the
+    number of bytes copied.
+    """
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        for name in "copy_file_range", "sendfile":
+            if not hasattr(os, name):
+                continue
+            copied = 0
+            try:
+                while True:
+                    if name == "sendfile":
+                        count = os.sendfile(outfd, infd, None, 8 * 1024 * 1024)
+                    else:
+                        count = os.copy_file_range(infd, outfd, 8 * 1024 * 1024)
+                    if count == 0:
+                        return copied
+                    copied += count
+            except OSError as e:
+                # Fall back to the next way only if nothing was written yet
+                if e.errno not in _UNSUPPORTED or copied:
+                    raise
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        return fdst.tell()
+
+
+def transfer_file(src, dest, move=False, link=False):
+    """
+    Make dest a file with the contents of src, replacing it if it exists,
+    copying as little data as possible: rename src if move is True, then try
+    a reflink, a hardlink if link is True, copying in the kernel with
+    copy_file_range or sendfile, and finally a plain copy.
+
+    Only use link=True when neither src nor dest are ever changed in place.
+
+    Returns the number of bytes actually copied.
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    if move:
+        try:
+            os.rename(src, dest)
+            return 0
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    if _reflink(src, dest):
+        copied = 0
+    else:
+        if link and not move:
+            try:
+                os.link(src, dest)
+                return 0
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+        copied = _copy_data(src, dest)
+    shutil.copystat(src, dest)
+    if move:
+        os.unlink(src)
+    return copied
+
+
+def copytree(source, target, move=False):
+    """
+    Copy the contents of source into target, with transfer_file. Returns the
+    number of bytes actually copied.
+    """
     if not os.path.exists(target):
         os.makedirs(target)
         shutil.copystat(source, target)
+    copied = 0
     entries = os.listdir(source)
     for entry in entries:
         src = os.path.join(source, entry)
         tgt = os.path.join(target, entry)
         if os.path.isdir(src):
-            copytree(src, tgt)
+            copied += copytree(src, tgt, move=move)
         else:
-            shutil.copy2(src, tgt)
+            copied += transfer_file(src, tgt, move=move)
+    return copied
 
 
-def copy_files(src, dest):
+def copy_files(src, dest, link=False):
+    """
+    Copy the files in src, but not its subdirectories, to dest, with
+    transfer_file. Returns the number of bytes actually copied.
+    """
+    copied = 0
     for filename in os.listdir(src):
         src_path = os.path.join(src, filename)
         if os.path.isdir(src_path) or os.path.islink(src_path):
             continue
-        shutil.copyfile(
-            src_path,
-            os.path.join(dest, filename))
+        copied += transfer_file(src_path, os.path.join(dest, filename), link=link)
+    return copied
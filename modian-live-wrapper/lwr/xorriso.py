@@ -14,6 +14,7 @@ image creation process.
 
 from lwr.utils import Fail
 from .component import Component
+from .trace import tracer
 import os
 import shlex
 
@@ -75,4 +76,5 @@ class Xorriso(Component):
         """
         if len(self.args) == 1:
             Fail("Attempted to run xorriso before building arguments!")
-        self.run_cmd(self.args)
+        with tracer.span("xorriso", "step"):
+            self.run_cmd(self.args)
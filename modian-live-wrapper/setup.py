@@ -36,11 +36,13 @@ setup(
     ],
     package_data={
         'live-wrapper': ['README.md', 'COPYING'],
+        'lwr': ['callback_plugins/*.py'],
     },
     install_requires=[
         'requests',
         'pycurl',
-        'python-apt'
+        'python-apt',
+        'PyYAML',
     ],
     entry_points={
         'console_scripts': [